@@ -2,17 +2,15 @@
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-
-# mpl.use("Agg")
-from stl import mesh
-from matplotlib import colors
-from mpl_toolkits import mplot3d
-from array import array
 import time
 import os
 
+from .mesh_lod import allocate_budget, lod_vectors
+from . import profiling
+
+# matplotlib, mpl_toolkits and numpy-stl are imported by the plotting methods,
+# so analysis runs without plots never import them
+
 
 class analysis_manager:
     """
@@ -120,7 +118,8 @@ class analysis_manager:
         self.seed = seed
         self.particle_histories = histories
         self.selected_plots = selected_plots
-        self.get_tallies()
+        with profiling.stage("tallies"):
+            self.get_tallies()
         self.plots = selected_plots
         self.geometry_data_path = f"/workspace/data_files/data/{self.experiment_name}/geometry_components_{self.experiment_name}.csv"
 
@@ -145,7 +144,8 @@ class analysis_manager:
         os.makedirs(self.plot_dir, exist_ok=True)
 
         if len(selected_plots) > 0:
-            self.preprocess_tracks()
+            with profiling.stage("preprocess_tracks"):
+                self.preprocess_tracks()
             self.end_time = time.time()
             self.execute_plots()
         else:
@@ -222,7 +222,7 @@ class analysis_manager:
                 self.filtered_scattered_tracks.append(curr_positions)
                 self.filtered_scattered_indices.append(idx)
 
-    def plot_tracks(self, tracks, track_indices, title, plot_geometry, linewidth=1):
+    def plot_tracks(self, tracks, track_indices, title, plot_geometry, linewidth=1, max_triangles=50_000):
         """
         Plots the photon tracks in 3D.
 
@@ -238,7 +238,12 @@ class analysis_manager:
             Color of the tracks (default is 'tab:blue').
         linewidth : int, optional
             Line width of the tracks (default is 1).
+        max_triangles : int, optional
+            Triangle budget for the geometry, meshes are drawn simplified to fit it (default is 50,000).
+            None draws every triangle.
         """
+        import matplotlib.pyplot as plt
+        from mpl_toolkits import mplot3d
 
         figure = plt.figure()
         axes = mplot3d.Axes3D(figure)
@@ -275,6 +280,11 @@ class analysis_manager:
             y_displacement = geometry_df["displacement y"]
             z_displacement = geometry_df["displacement z"]
 
+            budgets = allocate_budget(
+                [filename for filename in stl_names if filename not in self.gm.exclude], max_triangles
+            )
+            budgets = iter(budgets)
+
             for (
                 curr_filename,
                 curr_color,
@@ -282,19 +292,16 @@ class analysis_manager:
                 current_z_displacement,
             ) in zip(stl_names, colors, y_displacement, z_displacement):
                 if curr_filename not in self.gm.exclude:
-                    your_mesh = mesh.Mesh.from_file(curr_filename)
-                    mesh_dimension = np.shape(your_mesh.vectors)
-                    for i in range(mesh_dimension[1]):
-                        your_mesh.vectors[:, i, 1] += current_y_displacement
-                    for k in range(mesh_dimension[1]):
-                        your_mesh.vectors[:, i, 2] += current_z_displacement
-                    poly3d = mplot3d.art3d.Poly3DCollection(your_mesh.vectors)
+                    vectors = lod_vectors(curr_filename, next(budgets)) + [
+                        0, current_y_displacement, current_z_displacement
+                    ]
+                    poly3d = mplot3d.art3d.Poly3DCollection(vectors)
                     poly3d.set_alpha(0.2)
                     poly3d.set_edgecolor(None)
                     poly3d.set_facecolor(curr_color)
                     axes.add_collection3d(poly3d)
             # Auto scale to the mesh size
-            scale = your_mesh.points.flatten()
+            scale = vectors.flatten()
 
             axes.auto_scale_xyz(scale, scale, scale)
         axes.set_xlabel("x position (mm)")
@@ -333,6 +340,8 @@ class analysis_manager:
         return steps
             
     def plot_photon_step_hist(self):
+        import matplotlib.pyplot as plt
+
         steps = [self.step_length(self.photon_tracks[:,i,:]) for i in range(self.num_particles)]
         plt.hist(steps,bins=15)
         plt.title("Histogram of Photon Step Count")
@@ -412,6 +421,8 @@ class analysis_manager:
         diffuse_only : bool, optional
             Whether to include only diffusely reflected photons (default is False).
         """
+        import matplotlib.pyplot as plt
+
         if num_tracks == None:
             num_tracks = len(self.photon_tracks[0])
 
@@ -472,6 +483,9 @@ class analysis_manager:
         reflected_diffuse_only : bool, optional
             Whether to include only diffusely reflected photons (default is False).
         """
+        import matplotlib.pyplot as plt
+        from matplotlib import colors
+
         if num_tracks == None:
             num_tracks = len(self.photon_tracks[0])
 
@@ -565,6 +579,7 @@ class analysis_manager:
         ndarray
             Array of histogram values.
         """
+        import matplotlib.pyplot as plt
 
         fig = plt.figure()
 
@@ -589,6 +604,8 @@ class analysis_manager:
         """
         Plots a 2D histogram of the detected photon positions.
         """
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         plt.hist2d(
             self.detected_positions[:, 0],
@@ -614,6 +631,8 @@ class analysis_manager:
         density : bool, optional
             Whether to normalize the histogram (default is True).
         """
+        import matplotlib.pyplot as plt
+
         bins = [x for x in range(10)]
         spec_reflection_data = self.particle_histories["REFLECT_SPECULAR"]
         spec_reflection_data_det = spec_reflection_data[self.tallies["SURFACE_DETECT"]]
@@ -647,6 +666,9 @@ class analysis_manager:
         high_angle : int, optional
             Upper bound for the angle histogram (default is 91).
         """
+        import matplotlib.pyplot as plt
+        import matplotlib as mpl
+
         bins_refl = [x for x in range(10)]
         bins_angle = [x for x in range(low_angle, high_angle)]
         spec_reflection_data = self.particle_histories["REFLECT_SPECULAR"]
@@ -751,7 +773,8 @@ class analysis_manager:
         for plot_name in self.plots:
             print(f"Making {plot_name}")
             if plot_name in self.plot_functions:
-                self.plot_functions[plot_name]()
+                with profiling.stage(plot_name):
+                    self.plot_functions[plot_name]()
             else:
                 print(
                     f"Plot '{plot_name}' is not recognized. Available plots are: {', '.join(self.plot_functions.keys())}"
@@ -0,0 +1,177 @@
+'''
+Picks the photon batch size of a run from a memory budget, and watches for memory pressure while it runs.
+
+The host memory of a run is estimated from what run_manager keeps:
+
+- per photon of a batch in flight: the photons of every recorded step (photon_steps), the float64 arrays
+  photon_generator draws before building Photons, and the histories and index rows the writer packs;
+- per photon of the whole run: the last step of every photon and its histories, kept for analysis
+  (unless run_manager is given keep_photons=False);
+- per track: the track positions, kept for analysis.
+
+Up to run_manager.QUEUE_SIZE batches wait in each queue of the pipeline, besides the batch being generated,
+the one being propagated and the one being written, so all of them count against the budget.
+
+The memory available is the smaller of the host's MemAvailable and what is left under the memory limit of the
+job's cgroup (v2 or v1), so batch jobs are sized for their own limit rather than for the whole node.
+'''
+import os
+
+from .profiling import _rss_bytes
+
+
+# Host bytes of one photon in a chroma Photons object:
+# pos, dir and pol (3 float32 each), wavelengths, t, last_hit_triangles, flags, weights, evidx and channel
+PHOTON_BYTES = 64
+
+# Bytes per photon of the float64 positions, directions, polarizations and wavelengths photon_generator draws
+GENERATOR_BYTES = 3 * 3 * 8 + 8
+
+# Bytes per photon of the histories the writer packs, and of the index rows it appends for them
+WRITER_BYTES = 96
+
+# Bytes per photon of the histories run_manager keeps for analysis
+HISTORY_BYTES = 24
+
+# Largest batch propagate handles without risking the GPU
+MAX_BATCH_SIZE = 2_000_000
+MIN_BATCH_SIZE = 10_000
+
+# Fraction of the budget batches may use, the rest is left for the geometry, the interpreter and fragmentation
+BUDGET_FRACTION = 0.7
+
+CGROUP_DIR = '/sys/fs/cgroup'
+
+# (limit, usage) files of the cgroup memory controller, v2 then v1
+CGROUP_MEMORY_FILES = (
+    ('memory.max', 'memory.current'),
+    (os.path.join('memory', 'memory.limit_in_bytes'), os.path.join('memory', 'memory.usage_in_bytes')),
+)
+
+# cgroup v1 reports no limit as a number close to 2^63
+CGROUP_UNLIMITED = 2**60
+
+
+def _read_int(path):
+    with open(path) as f:
+        value = f.read().strip()
+    return None if value == 'max' else int(value)
+
+
+def cgroup_memory(cgroup_dir = CGROUP_DIR):
+    '''
+    Returns the bytes left under the memory limit of the process's cgroup, or None if there is no limit (or no cgroup)
+    '''
+    for limit_file, usage_file in CGROUP_MEMORY_FILES:
+        try:
+            limit = _read_int(os.path.join(cgroup_dir, limit_file))
+            usage = _read_int(os.path.join(cgroup_dir, usage_file))
+        except (OSError, ValueError):
+            continue
+        if limit is None or limit >= CGROUP_UNLIMITED:
+            return None
+        return max(limit - usage, 0)
+    return None
+
+
+def host_memory():
+    '''
+    Returns the memory of the host available to new allocations in bytes (MemAvailable), or None if it can't be read
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def available_memory(memory_budget = None):
+    '''
+    Returns the memory available to new allocations in bytes: the smallest of the host's available memory, what is left
+    under the cgroup limit, and what is left of memory_budget (if given) after the memory the process already uses.
+    None if none of them can be read.
+    '''
+    limits = [host_memory(), cgroup_memory()]
+    if memory_budget is not None:
+        limits.append(max(memory_budget - _rss_bytes(), 0))
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def batch_photon_bytes(num_steps, queue_size = 2):
+    '''
+    Returns the host bytes one photon of the batch size costs, counting every batch the pipeline holds at once
+    '''
+    generated = (queue_size + 1) * (PHOTON_BYTES + GENERATOR_BYTES)
+    propagated = (queue_size + 2) * (num_steps + 1) * PHOTON_BYTES
+    return generated + propagated + WRITER_BYTES
+
+
+def run_bytes(num_particles, num_steps, num_tracks, keep_photons = True):
+    '''
+    Returns the host bytes kept for the whole run, whatever the batch size
+    '''
+    # tracks are kept per batch and concatenated at the end, so twice
+    tracks_bytes = 2 * num_tracks * (num_steps + 1) * 3 * 4
+    if not keep_photons:
+        return tracks_bytes
+    return num_particles * (PHOTON_BYTES + HISTORY_BYTES) + tracks_bytes
+
+
+def batch_size_for(num_particles, num_steps = 15, num_tracks = 1000, memory_budget = None, queue_size = 2, keep_photons = True):
+    '''
+    Returns the largest batch size whose run fits in a memory budget, after what the run keeps as a whole (see run_bytes).
+
+    :param memory_budget: Bytes the run may use, the available memory (see available_memory) if None
+    :type memory_budget: int
+    :param keep_photons: Whether the run keeps the last step and histories of every photon
+    :type keep_photons: bool
+    :return: The batch size, between MIN_BATCH_SIZE and MAX_BATCH_SIZE, and at most num_particles
+    :rtype: int
+    '''
+    if memory_budget is None:
+        memory_budget = available_memory()
+        if memory_budget is None:
+            print(f'WARNING: Available memory could not be read, using batches of {MIN_BATCH_SIZE} photons')
+            return min(MIN_BATCH_SIZE, num_particles)
+
+    kept = run_bytes(num_particles, num_steps, num_tracks, keep_photons)
+    usable = memory_budget * BUDGET_FRACTION - kept
+    if usable <= 0:
+        print(f'WARNING: The run keeps {kept / 2**30:.2f} GiB in memory whatever the batch size, more than a memory budget of '
+              f'{memory_budget / 2**30:.2f} GiB allows' + (', write the results to a file with keep_photons=False' if keep_photons else ''))
+    batch_size = int(usable // batch_photon_bytes(num_steps, queue_size)) if usable > 0 else 0
+    if batch_size < MIN_BATCH_SIZE:
+        print(f'WARNING: A memory budget of {memory_budget / 2**30:.2f} GiB leaves room for batches of {max(batch_size, 0)} photons, '
+              f'using {MIN_BATCH_SIZE}')
+
+    return max(1, min(max(batch_size, MIN_BATCH_SIZE), MAX_BATCH_SIZE, num_particles))
+
+
+def adapt_batch_size(batch_size, num_steps = 15, memory_budget = None):
+    '''
+    Returns the batch size to continue a run with. The batches already in the pipeline are accounted for in the memory
+    used, so the next batch only needs room for one more batch (twice over, to leave a margin). The batch size is
+    halved, down to MIN_BATCH_SIZE, until it has that room, and kept otherwise.
+
+    :param memory_budget: Bytes the run may use, if the run was given a budget (see available_memory)
+    :type memory_budget: int
+    '''
+    available = available_memory(memory_budget)
+    if available is None:
+        return batch_size
+
+    photon_bytes = (num_steps + 1) * PHOTON_BYTES + GENERATOR_BYTES + WRITER_BYTES
+    new_size = batch_size
+    while new_size > MIN_BATCH_SIZE and 2 * new_size * photon_bytes > available:
+        new_size = max(MIN_BATCH_SIZE, new_size // 2)
+
+    if new_size != batch_size:
+        print(f'WARNING: Only {available / 2**30:.2f} GiB of memory available, reducing the batch size from {batch_size} to {new_size}')
+    return new_size
@@ -0,0 +1,425 @@
+'''
+Benchmarks of the CPU side of the simulation, run on synthetic photons so they need no GPU and no geometry.
+
+The fixtures mimic propagated batches: every photon ends in a detection, absorption or escape after a geometrically
+distributed number of steps, reflects, scatters and transmits along the way with realistic probabilities, and stops moving
+once it ended. Every benchmark runs at several scales, and records its throughput (items per second, best of a few repeats)
+and peak traced memory. Results are saved as JSON and can be compared with a stored baseline:
+
+    python -m PocarChroma.benchmark [--scales 10000,100000] [--repeat 3] [--only filter_update,tracks_write]
+                                    [--output results.json] [--baseline baseline.json] [--save-baseline baseline.json]
+                                    [--threshold 0.2] [--memory-threshold 0.2]
+
+Exits with status 1 if a benchmark is slower than its baseline throughput by more than threshold, or uses more than
+memory-threshold more memory. Benchmarks of modules that can't be imported (e.g. without chroma) are skipped.
+'''
+import io
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from .cache import cache_dir
+
+
+# Interaction bits, as in photons.Interaction
+NO_HIT = 0x1 << 0
+BULK_ABSORB = 0x1 << 1
+SURFACE_DETECT = 0x1 << 2
+SURFACE_ABSORB = 0x1 << 3
+RAYLEIGH_SCATTER = 0x1 << 4
+REFLECT_DIFFUSE = 0x1 << 5
+REFLECT_SPECULAR = 0x1 << 6
+SURFACE_TRANSMIT = 0x1 << 8
+
+# How photons end, and how likely each ending is
+FATES = {SURFACE_DETECT: 0.30, SURFACE_ABSORB: 0.35, BULK_ABSORB: 0.10, NO_HIT: 0.25}
+
+# Probability of every non-terminal interaction in each step a photon is alive
+STEP_PROBABILITIES = {REFLECT_SPECULAR: 0.25, REFLECT_DIFFUSE: 0.15, RAYLEIGH_SCATTER: 0.05, SURFACE_TRANSMIT: 0.20}
+
+FINAL_COLUMNS = {'NO_HIT': NO_HIT, 'BULK_ABSORB': BULK_ABSORB, 'SURFACE_DETECT': SURFACE_DETECT, 'SURFACE_ABSORB': SURFACE_ABSORB}
+STEP_COLUMNS = {'RAYLEIGH_SCATTER': RAYLEIGH_SCATTER, 'REFLECT_DIFFUSE': REFLECT_DIFFUSE,
+                'REFLECT_SPECULAR': REFLECT_SPECULAR, 'SURFACE_TRANSMIT': SURFACE_TRANSMIT}
+
+DEFAULT_SCALES = (10_000, 100_000)
+
+# Tracks are kept for at most this many photons, like the num_tracks of a run
+MAX_TRACKS = 10_000
+
+
+def synthetic_steps(n_photons, num_steps = 15, seed = 0, n_triangles = 100_000):
+    '''
+    Makes the photon steps of a synthetic propagated batch, see the module description.
+
+    :return: A list of num_steps + 1 Photons-like objects (pos, dir, pol, wavelengths, t, last_hit_triangles, flags),
+        the initial photons first
+    :rtype: list
+    '''
+    rng = np.random.default_rng(seed)
+
+    # photons end in step end_step, with one of FATES
+    end_step = np.minimum(rng.geometric(0.25, n_photons), num_steps)
+    fate = rng.choice(np.array(list(FATES.keys()), dtype=np.uint32), size=n_photons, p=list(FATES.values()))
+    step = np.arange(num_steps + 1)[:, None]
+    moving = (step >= 1) & (step <= end_step)
+
+    flags = np.zeros((num_steps + 1, n_photons), dtype=np.uint32)
+    for interaction, probability in STEP_PROBABILITIES.items():
+        happened = (step >= 1) & (step < end_step) & (rng.random((num_steps + 1, n_photons)) < probability)
+        flags |= np.where(happened, np.uint32(interaction), np.uint32(0))
+    flags |= np.where(step >= end_step, fate, np.uint32(0))
+
+    lengths = rng.exponential(50.0, (num_steps + 1, n_photons, 1)).astype(np.float32)
+    directions = rng.normal(size=(num_steps + 1, n_photons, 3)).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=2, keepdims=True)
+    pos = np.cumsum(np.where(moving[:, :, None], lengths * directions, np.float32(0)), axis=0, dtype=np.float32)
+
+    hits = rng.integers(0, n_triangles, (num_steps + 1, n_photons), dtype=np.int32)
+    # photons keep the triangle of the last step they moved in
+    last_moved = np.maximum.accumulate(np.where(moving, step, 0), axis=0)
+    last_hit_triangles = np.where(last_moved > 0, np.take_along_axis(hits, last_moved, axis=0), np.int32(-1))
+
+    pol = np.cross(directions, rng.normal(size=(num_steps + 1, n_photons, 3)).astype(np.float32))
+    wavelengths = np.full(n_photons, 178.0, dtype=np.float32)
+    return [
+        types.SimpleNamespace(
+            pos=pos[i], dir=directions[i], pol=pol[i], wavelengths=wavelengths,
+            t=np.zeros(n_photons, dtype=np.float32), last_hit_triangles=last_hit_triangles[i], flags=flags[i],
+        )
+        for i in range(num_steps + 1)
+    ]
+
+
+def synthetic_histories(photon_steps):
+    '''
+    Returns the particle histories of synthetic steps, in the layout run_manager writes:
+    booleans for the final interactions and per-step counts for the others
+    '''
+    histories = {name: (photon_steps[-1].flags & bit) != 0 for name, bit in FINAL_COLUMNS.items()}
+    for name, bit in STEP_COLUMNS.items():
+        histories[name] = np.sum([(step.flags & bit) != 0 for step in photon_steps[1:]], axis=0, dtype=np.uint16)
+    return histories
+
+
+def synthetic_tracks(photon_steps, n_tracks):
+    '''
+    Returns the tracks of the first n_tracks photons, shape (steps + 1, n_tracks, 3)
+    '''
+    return np.stack([step.pos[:n_tracks] for step in photon_steps])
+
+
+class fixture:
+    '''
+    The synthetic data of one scale, shared by every benchmark of that scale
+    '''
+
+    def __init__(self, n_photons, num_steps = 15, seed = 0, runs = 4):
+        self.n_photons = n_photons
+        self.runs = runs
+        self.num_steps = num_steps
+        self.steps = synthetic_steps(n_photons, num_steps, seed)
+        self.histories = synthetic_histories(self.steps)
+        self.n_tracks = min(n_photons, MAX_TRACKS)
+        self.tracks = synthetic_tracks(self.steps, self.n_tracks)
+        self.track_flags = np.stack([step.flags[:self.n_tracks] for step in self.steps])
+        self.track_triangles = np.stack([step.last_hit_triangles[:self.n_tracks] for step in self.steps])
+        self.tmp_dir = tempfile.mkdtemp(prefix='pocarchroma_benchmark_')
+
+    def results_files(self, name, tracks_layout = 'chunked'):
+        '''
+        Makes an empty results file for every run of a benchmark, so writes are timed without creating files
+        '''
+        return iter([self.results_file(f'{name}_{i}', tracks_layout) for i in range(self.runs)])
+
+    def results_file(self, name, tracks_layout = 'chunked'):
+        '''
+        Makes an empty results file for the fixture
+        '''
+        from .save_load_sim import make_HDF5_file
+
+        path = os.path.join(self.tmp_dir, f'{name}.h5')
+        columns = {name: np.bool_ for name in FINAL_COLUMNS}
+        columns.update({name: np.uint16 for name in STEP_COLUMNS})
+        bounds = (self.tracks.reshape(-1, 3).min(axis=0) - 1, self.tracks.reshape(-1, 3).max(axis=0) + 1)
+        with redirect_stdout(io.StringIO()):
+            make_HDF5_file(path, {}, (self.num_steps + 1, self.n_tracks, 3), self.n_photons, columns,
+                           max_count=self.num_steps, tracks_layout=tracks_layout, bounds=bounds)
+        return path
+
+    def written_file(self):
+        '''
+        Returns a results file holding the fixture's histories and tracks, written once
+        '''
+        if not hasattr(self, '_written'):
+            from .save_load_sim import particle_histories_write, tracks_write
+
+            self._written = self.results_file('written')
+            particle_histories_write(self._written, self.histories)
+            tracks_write(self._written, self.tracks)
+        return self._written
+
+
+### BENCHMARKS
+
+# Every benchmark takes a fixture, and returns a function running the benchmarked code once and the number of items it processes.
+# Setup that shouldn't be timed happens before the function is returned. The function is run fixture.runs times.
+
+def bench_photon_generator(fx):
+    from .photons import photon_generator
+
+    def run():
+        for photons in photon_generator(seed=1, max_photons=fx.n_photons, batch_size=fx.n_photons):
+            pass
+    return run, fx.n_photons
+
+
+def bench_filter_update(fx):
+    from .photons import Filter
+
+    def run():
+        Filter(None, SURFACE_DETECT | REFLECT_SPECULAR).update(fx.steps)
+    return run, fx.n_photons * len(fx.steps)
+
+
+def _analysis(fx):
+    from .analysis_manager import analysis_manager
+
+    ana_man = analysis_manager.__new__(analysis_manager)
+    ana_man.photons = fx.steps[-1]
+    ana_man.num_particles = fx.n_photons
+    ana_man.particle_histories = fx.histories
+    ana_man.photon_tracks = fx.tracks
+    return ana_man
+
+
+def bench_get_tallies(fx):
+    ana_man = _analysis(fx)
+
+    def run():
+        with redirect_stdout(io.StringIO()):
+            ana_man.get_tallies()
+    return run, fx.n_photons
+
+
+def bench_preprocess_tracks(fx):
+    ana_man = _analysis(fx)
+    with redirect_stdout(io.StringIO()):
+        ana_man.get_tallies()
+
+    def run():
+        ana_man.preprocess_tracks()
+    return run, fx.n_tracks
+
+
+def bench_particle_histories_write(fx):
+    from .save_load_sim import particle_histories_write
+
+    paths = fx.results_files('histories')
+
+    def run():
+        particle_histories_write(next(paths), fx.histories)
+    return run, fx.n_photons
+
+
+def _bench_tracks_write(tracks_layout):
+    def bench(fx):
+        from .save_load_sim import tracks_write
+
+        paths = fx.results_files('tracks_' + tracks_layout, tracks_layout)
+
+        def run():
+            tracks_write(next(paths), fx.tracks)
+        return run, fx.n_tracks
+    return bench
+
+
+def bench_vertices_write(fx):
+    from .save_load_sim import vertices_write, _vertices_from_tracks
+
+    paths = fx.results_files('vertices', 'vertex')
+    vertices = _vertices_from_tracks(fx.tracks, fx.track_flags, fx.track_triangles)
+
+    def run():
+        vertices_write(next(paths), vertices)
+    return run, fx.n_tracks
+
+
+def bench_select_tracks(fx):
+    from .save_load_sim import select_tracks
+
+    path = fx.written_file()
+
+    def run():
+        select_tracks(path, 'SURFACE_DETECT', return_type='both')
+    return run, fx.n_tracks
+
+
+def bench_select_tracks_callable(fx):
+    from .save_load_sim import select_tracks
+
+    path = fx.written_file()
+
+    def run():
+        select_tracks(path, lambda tallies: tallies['REFLECT_SPECULAR'] > 1, return_type='both')
+    return run, fx.n_tracks
+
+
+BENCHMARKS = {
+    'photon_generator': bench_photon_generator,
+    'filter_update': bench_filter_update,
+    'get_tallies': bench_get_tallies,
+    'preprocess_tracks': bench_preprocess_tracks,
+    'particle_histories_write': bench_particle_histories_write,
+    'tracks_write': _bench_tracks_write('chunked'),
+    'tracks_write_delta': _bench_tracks_write('delta'),
+    'vertices_write': bench_vertices_write,
+    'select_tracks': bench_select_tracks,
+    'select_tracks_callable': bench_select_tracks_callable,
+}
+
+
+def run_benchmark(bench, fx, repeat = 3):
+    '''
+    Runs one benchmark on a fixture.
+
+    :return: The best time in seconds, the throughput in items per second, the peak traced memory in MB and the number of items
+    :rtype: dict
+    '''
+    run, items = bench(fx)
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    # memory is measured in a separate run, tracing slows the code down
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': best, 'throughput': items / max(best, 1e-12), 'peak_mb': peak / 2**20, 'items': items}
+
+
+def run_benchmarks(scales = DEFAULT_SCALES, names = None, repeat = 3, num_steps = 15):
+    '''
+    Runs the benchmarks at every scale and prints their results.
+
+    :param names: Benchmarks to run, all of BENCHMARKS if None
+    :type names: list
+    :return: The results, keyed by '<benchmark>@<scale>', and the benchmarks skipped with the reason
+    :rtype: dict
+    '''
+    names = list(BENCHMARKS) if names is None else names
+    results = {}
+    skipped = {}
+    for scale in scales:
+        # repeat timed runs and one traced run
+        fx = fixture(scale, num_steps, runs=repeat + 1)
+        for name in names:
+            key = f'{name}@{scale}'
+            try:
+                results[key] = run_benchmark(BENCHMARKS[name], fx, repeat)
+            except ImportError as e:
+                skipped[key] = repr(e)
+                print(f'skip  {key:36s}  {e}')
+                continue
+            result = results[key]
+            print(f'      {key:36s}  {result["seconds"]:8.4f} s  {result["throughput"]:12.0f} items/s  {result["peak_mb"]:8.1f} MB')
+        shutil.rmtree(fx.tmp_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'node': platform.node(),
+            'repeat': repeat,
+            'num_steps': num_steps,
+        },
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def compare(results, baseline, threshold = 0.2, memory_threshold = 0.2):
+    '''
+    Compares results with a baseline and prints the regressions.
+
+    :param threshold: Largest allowed relative drop in throughput
+    :type threshold: float
+    :param memory_threshold: Largest allowed relative increase in peak memory
+    :type memory_threshold: float
+    :return: The keys of the benchmarks that regressed
+    :rtype: list
+    '''
+    regressions = []
+    for key, result in results['results'].items():
+        if key not in baseline['results']:
+            continue
+        base = baseline['results'][key]
+        speed = result['throughput'] / base['throughput']
+        memory = result['peak_mb'] / max(base['peak_mb'], 1e-9)
+        slow = speed < 1 - threshold
+        heavy = memory > 1 + memory_threshold and result['peak_mb'] - base['peak_mb'] > 1.0
+        status = 'FAIL' if slow or heavy else 'ok  '
+        print(f'{status}  {key:36s}  throughput x{speed:5.2f}  memory x{memory:5.2f}')
+        if slow or heavy:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark the CPU side of the PocarChroma simulation on synthetic photons')
+    parser.add_argument('--scales', default=','.join(str(scale) for scale in DEFAULT_SCALES), help='comma separated numbers of photons')
+    parser.add_argument('--only', default=None, help=f'comma separated benchmarks to run, of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest is used')
+    parser.add_argument('--num-steps', type=int, default=15, help='propagation steps of the synthetic photons')
+    parser.add_argument('--output', default=None, help='results file, by default a new file in the PocarChroma cache')
+    parser.add_argument('--baseline', default=None, help='results file to compare with')
+    parser.add_argument('--save-baseline', default=None, help='also save the results to this baseline file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='largest allowed relative drop in throughput')
+    parser.add_argument('--memory-threshold', type=float, default=0.2, help='largest allowed relative increase in peak memory')
+    args = parser.parse_args(argv)
+
+    names = None
+    if args.only:
+        names = [name.strip() for name in args.only.split(',')]
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    results = run_benchmarks(scales, names, args.repeat, args.num_steps)
+
+    output = args.output or os.path.join(cache_dir('benchmarks'), time.strftime('%Y%m%d_%H%M%S') + '.json')
+    for path in filter(None, (output, args.save_baseline)):
+        save_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(save_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Benchmark results written to {path}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold, args.memory_threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import os
+import hashlib
+
+
+# Bump this when the layout of anything stored in the cache changes, so old entries are no longer used
+CACHE_VERSION = 1
+
+_file_digests = {}
+
+
+def cache_dir(*parts):
+    '''
+    Returns (and creates) a directory in the PocarChroma cache.
+    The cache lives in $POCARCHROMA_CACHE if set, otherwise in ~/.cache/PocarChroma.
+    '''
+    base = os.environ.get('POCARCHROMA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'PocarChroma'))
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_digest(path):
+    '''
+    Returns the sha256 hex digest of the contents of a file.
+    Digests are remembered per process by path, size and modification time, so unchanged files are only hashed once.
+    '''
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _file_digests[memo_key] = digest.hexdigest()
+
+    return _file_digests[memo_key]
+
+
+def digest(*items):
+    '''
+    Returns a sha256 hex digest of items, which may be bytes, strings or anything with a stable repr
+    '''
+    h = hashlib.sha256(str(CACHE_VERSION).encode())
+    for item in items:
+        if isinstance(item, str):
+            item = item.encode()
+        elif not isinstance(item, bytes):
+            item = repr(item).encode()
+        h.update(len(item).to_bytes(8, 'little'))
+        h.update(item)
+
+    return h.hexdigest()
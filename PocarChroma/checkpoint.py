@@ -0,0 +1,197 @@
+import os
+import json
+
+import h5py
+import numpy as np
+
+
+def checkpoint_path(file_path):
+    '''
+    Path of the checkpoint kept next to a results file
+    '''
+    return file_path + '.ckpt.json'
+
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return {key: _to_json(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_checkpoint(file_path, state:dict):
+    '''
+    Records the state of a run after its last completed batch, together with how far the results file was written.
+
+    The write positions (next_writable of particle_history and tracks, the length of every interaction index and the
+    column totals) are read back from the closed results file, so the checkpoint always describes data that is on disk.
+    The checkpoint is written to a temporary file and moved into place, so an interrupted write leaves the previous one intact.
+
+    :param state: json-able run state, e.g. the batch counter, photons generated, bit generator state and accumulated tallies
+    :type state: dict
+    '''
+    checkpoint = {'state': _to_json(state)}
+
+    with h5py.File(file_path, 'r') as f:
+        hist_ds = f['particle_history']
+        checkpoint['hist_next_writable'] = int(hist_ds.attrs['next_writable'])
+        checkpoint['tracks_next_writable'] = int(f['tracks'].attrs['next_writable'])
+        # delta and vertex tracks also append to tables of their own
+        for key in ('next_delta', 'next_vertex'):
+            if key in f['tracks'].attrs:
+                checkpoint['tracks_' + key] = int(f['tracks'].attrs[key])
+        if 'column_totals' in hist_ds.attrs:
+            checkpoint['column_totals'] = hist_ds.attrs['column_totals'].tolist()
+        if 'index' in f:
+            checkpoint['index_lengths'] = {name: ds.shape[0] for name, ds in f['index'].items()}
+
+    path = checkpoint_path(file_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    return
+
+
+def read_checkpoint(file_path):
+    '''
+    Returns the checkpoint of a results file, or None if there is none
+    '''
+    path = checkpoint_path(file_path)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def rollback_to_checkpoint(file_path, checkpoint:dict):
+    '''
+    Resets the write positions of a results file to those recorded in checkpoint,
+    discarding anything a pre-empted run wrote after its last checkpoint. The rows themselves are overwritten when the run resumes.
+    '''
+    with h5py.File(file_path, 'r+') as f:
+        hist_ds = f['particle_history']
+        hist_ds.attrs['next_writable'] = checkpoint['hist_next_writable']
+        f['tracks'].attrs['next_writable'] = checkpoint['tracks_next_writable']
+        for key in ('next_delta', 'next_vertex'):
+            if 'tracks_' + key in checkpoint:
+                length = checkpoint['tracks_' + key]
+                f['tracks'].attrs[key] = length
+                for ds in f['tracks'].values():
+                    if ds.maxshape[0] is None:
+                        ds.resize((length,) + ds.shape[1:])
+        if 'column_totals' in checkpoint:
+            hist_ds.attrs['column_totals'] = np.asarray(checkpoint['column_totals'], dtype=np.int64)
+        for name, length in checkpoint.get('index_lengths', {}).items():
+            f['index'][name].resize((length,))
+
+    return
+
+
+class run_checkpoint:
+    '''
+    Periodic checkpoints of a batched run writing to one results file, so a pre-empted run can be resumed.
+
+    A run sets itself up with start(), which either starts fresh or, when resuming, rolls the results file back to
+    the last checkpoint and returns the state needed to continue: the random number generator for photon_generator
+    (with the bit generator state restored), the number of photons and batches already done, the tallies accumulated so far,
+    and the batch size the run was continuing with. After the results of each batch are written, call batch_done().
+    With the same seed, and the batch size restored from the checkpoint, the resumed run writes exactly what an
+    uninterrupted run would have written.
+
+    :param file_path: Path of the results file made by save_load_sim.make_HDF5_file
+    :type file_path: str
+    :param seed: Seed of the run's photon generator
+    :type seed: int
+    :param every: Write a checkpoint every this many batches
+    :type every: int
+    '''
+
+    def __init__(self, file_path, seed, every = 1):
+        self.file_path = file_path
+        self.seed = seed
+        self.every = every
+
+    def start(self, resume = False):
+        '''
+        :param resume: Continue from the last checkpoint if there is one
+        :type resume: bool
+        :return: A dict with rng, photons_done, batches_done, tallies, batch_size (None unless resuming a checkpoint that has one)
+            and resumed (whether the run was resumed)
+        :rtype: dict
+        '''
+        checkpoint = read_checkpoint(self.file_path) if resume and os.path.exists(self.file_path) else None
+
+        if checkpoint is None:
+            self.clear()
+            return {
+                'rng': np.random.default_rng(seed=self.seed),
+                'photons_done': 0,
+                'batches_done': 0,
+                'tallies': {},
+                'batch_size': None,
+                'resumed': False,
+            }
+
+        state = checkpoint['state']
+        if state['seed'] != self.seed:
+            raise ValueError(f'Checkpoint of {self.file_path} was made with seed {state["seed"]}, not {self.seed}')
+
+        rollback_to_checkpoint(self.file_path, checkpoint)
+
+        rng = np.random.default_rng(seed=self.seed)
+        rng.bit_generator.state = state['rng_state']
+
+        print(f'Resuming {self.file_path} after batch {state["batches_done"]} ({state["photons_done"]} photons)')
+
+        return {
+            'rng': rng,
+            'photons_done': state['photons_done'],
+            'batches_done': state['batches_done'],
+            'tallies': {key: np.asarray(value) for key, value in state['tallies'].items()},
+            'batch_size': state.get('batch_size'),
+            'resumed': True,
+        }
+
+    def batch_done(self, batches_done, photons_done, rng_state, tallies = None, batch_size = None, force = False):
+        '''
+        Call once the results of a batch are written, writes a checkpoint every self.every batches.
+
+        :param rng_state: The bit generator state right after the batch was generated (rng.bit_generator.state)
+        :type rng_state: dict
+        :param tallies: Accumulated tallies to restore on resume, e.g. interaction totals
+        :type tallies: dict
+        :param batch_size: Size of the batches generated after this one, to continue with on resume
+        :type batch_size: int
+        :param force: Write a checkpoint regardless of self.every
+        :type force: bool
+        '''
+        if not force and batches_done % self.every != 0:
+            return
+
+        write_checkpoint(self.file_path, {
+            'seed': self.seed,
+            'batches_done': batches_done,
+            'photons_done': photons_done,
+            'rng_state': rng_state,
+            'tallies': {} if tallies is None else tallies,
+            'batch_size': batch_size,
+        })
+
+    def clear(self):
+        '''
+        Removes the checkpoint, e.g. once the run has finished
+        '''
+        try:
+            os.remove(checkpoint_path(self.file_path))
+        except FileNotFoundError:
+            pass
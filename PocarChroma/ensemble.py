@@ -0,0 +1,192 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+from .spectral_tables import is_table
+
+
+# Material properties perturbed by default, and the columns of the material table holding their (absolute) errors
+MATERIAL_ERRORS = {
+    'refractive_index': 'abs(r_i_error)',
+    'eta': 'abs(eta_error)',
+    'k': 'abs(k_error)',
+}
+
+
+def default_parameters(mat_manager):
+    '''
+    Returns the constants to perturb by default: every material property of MATERIAL_ERRORS that has a
+    nonzero error in the material table and is not a spectral table, as {('material', material name, property): error}
+    '''
+    parameters = {}
+    for name, props in mat_manager.material_props.items():
+        for prop, error_column in MATERIAL_ERRORS.items():
+            error = props.get(error_column)
+            if prop in props and not is_table(props[prop]) and error is not None and np.isfinite(error) and error != 0:
+                parameters[('material', name, prop)] = abs(float(error))
+
+    return parameters
+
+
+def draw_perturbations(nominal, errors, n_variants, seed, include_nominal = True):
+    '''
+    Draws the constants of n_variants variants in one call, each uniformly within +-error of its nominal value.
+
+    :param nominal: Nominal value of every constant, shape (n_constants,)
+    :type nominal: np.ndarray
+    :param errors: Half width of every constant's range, shape (n_constants,)
+    :type errors: np.ndarray
+    :param include_nominal: Make variant 0 the unperturbed nominal constants
+    :type include_nominal: bool
+    :return: The constants of every variant, shape (n_variants, n_constants)
+    :rtype: np.ndarray
+    '''
+    rng = np.random.default_rng(seed)
+    offsets = rng.uniform(-1.0, 1.0, size=(n_variants, len(nominal))) * np.asarray(errors, dtype=np.float64)
+    if include_nominal and n_variants > 0:
+        offsets[0] = 0.0
+
+    return np.asarray(nominal, dtype=np.float64) + offsets
+
+
+class geometry_ensemble:
+    '''
+    Variants of a geometry with perturbed optical constants, so a whole systematic band runs in one job.
+
+    The constants of all variants are drawn at once from a seeded generator (see draw_perturbations).
+    Every variant is a shallow copy of the geometry_manager whose global_geometry is a shallow copy of the Detector:
+    the meshes, the BVH and every other array are shared, and only the materials and surfaces whose constants
+    changed are replaced with copies. The surfaces computed from material properties (dichroic and dielectric-metal)
+    are rebuilt in every variant, the nominal one included, from the variant's exact constants: the geometry_manager
+    builds dichroic surfaces with unseeded random perturbations, which would make the variants irreproducible.
+    Variants can be passed to photons.propagate like the geometry_manager itself, and carry their variant number and
+    constants in variant and variant_constants, to tag their results with (see tag).
+
+    :param geometry_manager: The nominal geometry
+    :type geometry_manager: geometry_manager
+    :param n_variants: Number of variants
+    :type n_variants: int
+    :param seed: Seed of the perturbations
+    :type seed: int
+    :param parameters: Constants to perturb, as {(kind, name, property): half width} with kind 'material' or 'surface',
+        e.g. {('material', 'silica', 'refractive_index'): 0.01, ('surface', 'teflon', 'reflect_diffuse'): 0.05}.
+        Defaults to the material errors of the material table, see default_parameters.
+    :type parameters: dict
+    :param include_nominal: Make variant 0 the unperturbed nominal geometry
+    :type include_nominal: bool
+    '''
+
+    def __init__(self, geometry_manager, n_variants, seed, parameters = None, include_nominal = True):
+        self.gm = geometry_manager
+        self.n_variants = n_variants
+        self.seed = seed
+        self.parameters = default_parameters(geometry_manager.mat_manager) if parameters is None else dict(parameters)
+
+        keys = list(self.parameters.keys())
+        nominal = np.array([self.nominal_value(key) for key in keys], dtype=np.float64)
+        errors = np.array([self.parameters[key] for key in keys], dtype=np.float64)
+        values = draw_perturbations(nominal, errors, n_variants, seed, include_nominal)
+
+        self.constants = pd.DataFrame(values, columns=[':'.join(key) for key in keys])
+        self.constants.insert(0, 'variant', np.arange(n_variants))
+
+        self.variants = [self.build_variant(i) for i in range(n_variants)]
+
+    def nominal_value(self, key):
+        '''
+        Returns the nominal value of a constant, given as (kind, name, property)
+        '''
+        kind, name, prop = key
+        if kind == 'material':
+            value = self.gm.mat_manager.material_props[name][prop]
+            if is_table(value):
+                raise ValueError(f'{prop} of {name} is a spectral table and cannot be perturbed as a scalar')
+            return float(value)
+        elif kind == 'surface':
+            surfaces_df = self.gm.surf_manager.surfaces_df
+            return float(surfaces_df.loc[surfaces_df['name'] == name, prop].iloc[0])
+        else:
+            raise ValueError(f'Constants must be of a material or a surface, not {kind}')
+
+    def build_variant(self, i):
+        '''
+        Builds variant i, see the class description
+        '''
+        mat_manager = self.gm.mat_manager
+        surf_manager = self.gm.surf_manager
+
+        material_props = {name: dict(props) for name, props in mat_manager.material_props.items()}
+        material_values = {}
+        surface_values = {}
+        for (kind, name, prop), value in zip(self.parameters.keys(), self.constants.iloc[i, 1:]):
+            if kind == 'material':
+                material_props[name][prop] = value
+                material_values.setdefault(name, {})[prop] = value
+            else:
+                surface_values.setdefault(name, {})[prop] = value
+
+        materials = {}
+        for name, props in material_values.items():
+            material = copy.copy(mat_manager.get_material(name))
+            for prop, value in props.items():
+                if prop == 'density':
+                    material.density = value
+                elif hasattr(material, prop):
+                    material.set(prop, value)
+            materials[name] = material
+
+        surfaces = {}
+        for index, row in surf_manager.surfaces_using(list(material_props)).iterrows():
+            surfaces[row['name']] = surf_manager.build_surface(row, material_props)
+        for name, props in surface_values.items():
+            surface = surfaces[name] if name in surfaces else copy.copy(surf_manager.get_surface(name))
+            for prop, value in props.items():
+                surface.set(prop, value)
+            surfaces[name] = surface
+
+        geometry = copy.copy(self.gm.global_geometry)
+        geometry.unique_materials = [
+            materials.get(material.name, material) if material is not None else None
+            for material in geometry.unique_materials
+        ]
+        geometry.unique_surfaces = [
+            surfaces.get(surface.name, surface) if surface is not None else None
+            for surface in geometry.unique_surfaces
+        ]
+        detector_material = getattr(geometry, 'detector_material', None)
+        if detector_material is not None:
+            geometry.detector_material = materials.get(detector_material.name, detector_material)
+
+        variant = copy.copy(self.gm)
+        variant.global_geometry = geometry
+        variant.variant = i
+        variant.variant_constants = self.variant_constants(i)
+        return variant
+
+    def variant_constants(self, i):
+        '''
+        Returns the seed, variant number and constants of variant i as a dict, e.g. to append to a run_ledger
+        '''
+        constants = {'ensemble_seed': self.seed}
+        constants.update(self.constants.iloc[i].to_dict())
+        constants['variant'] = int(constants['variant'])
+        return constants
+
+    def tag(self, data, i):
+        '''
+        Adds the variant number and constants of variant i to results, a dict or a dataframe
+        '''
+        constants = self.variant_constants(i)
+        if isinstance(data, pd.DataFrame):
+            return data.assign(**constants)
+        return {**data, **constants}
+
+    def __len__(self):
+        return self.n_variants
+
+    def __getitem__(self, i):
+        return self.variants[i]
+
+    def __iter__(self):
+        return iter(self.variants)
@@ -0,0 +1,101 @@
+'''
+Fresnel reflectance tables over incident angle and wavelength, for building dichroic surfaces.
+
+Tables are evaluated for all angles and wavelengths at once and memoized, in memory and on disk, keyed by the
+refractive indices and the angle grid, so rebuilding the same surfaces (e.g. every point of a sweep) costs nothing.
+Tables of indices that will not repeat, e.g. randomly perturbed ones, can skip the cache (fresnel_table(..., cache=False)).
+'''
+import os
+
+import numpy as np
+
+from .cache import cache_dir, digest
+
+
+_tables = {}
+
+
+def angle_grid(num_angles):
+    '''
+    Incident angles from 0 to 90 degrees, in radians, as used for dichroic surfaces
+    '''
+    return np.radians(np.linspace(0, 90, num_angles, dtype=np.float32))
+
+
+def fresnel_reflectance(n1, eta2, k2, theta):
+    '''
+    Unpolarized reflectance of light going from a medium of real refractive index n1 into one of complex index eta2 + i k2.
+
+    Every index may be a scalar or an array over wavelengths (dispersive media).
+
+    :param theta: Incident angles in radians
+    :type theta: np.ndarray
+    :return: Reflectance, shape (n_angles, n_wavelengths), n_wavelengths is 1 when every index is a scalar
+    :rtype: np.ndarray
+    '''
+    n1, eta2, k2 = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(n1, dtype=np.float64)),
+        np.atleast_1d(np.asarray(eta2, dtype=np.float64)),
+        np.atleast_1d(np.asarray(k2, dtype=np.float64)),
+    )
+    n2 = eta2 + 1j * k2
+
+    theta = np.asarray(theta, dtype=np.float64)[:, None]
+    cos_theta = np.cos(theta)
+    # cosine of the (complex) refraction angle
+    cos_refracted = np.sqrt(1 - np.square(n1 * np.sin(theta) / n2))
+
+    r_s = (n1 * cos_theta - n2 * cos_refracted) / (n1 * cos_theta + n2 * cos_refracted)
+    r_p = (n1 * cos_refracted - n2 * cos_theta) / (n1 * cos_refracted + n2 * cos_theta)
+
+    return 0.5 * (np.square(np.absolute(r_s)) + np.square(np.absolute(r_p)))
+
+
+def fresnel_table(n1, eta2, k2, theta, cache = True):
+    '''
+    Memoized reflectance and transmittance tables, see fresnel_reflectance.
+    The transmittance is zero, light that is not reflected is absorbed.
+
+    :param cache: Whether to memoize the table, in memory and on disk. Pass False for indices that won't be seen again.
+    :type cache: bool
+    :return: Reflectance and transmittance, both float32 arrays of shape (n_angles, n_wavelengths). They are shared, so read-only.
+    :rtype: tuple
+    '''
+    n1, eta2, k2, theta = (np.ascontiguousarray(value, dtype=np.float64) for value in (n1, eta2, k2, theta))
+    if not cache:
+        reflectance = fresnel_reflectance(n1, eta2, k2, theta).astype(np.float32)
+        return reflectance, np.zeros_like(reflectance)
+
+    key = digest('fresnel', n1.shape, n1.tobytes(), eta2.shape, eta2.tobytes(), k2.shape, k2.tobytes(), theta.tobytes())
+
+    if key not in _tables:
+        path = os.path.join(cache_dir('fresnel'), key + '.npy')
+        if os.path.exists(path):
+            table = np.load(path)
+        else:
+            reflectance = fresnel_reflectance(n1, eta2, k2, theta)
+            table = np.stack((reflectance, np.zeros_like(reflectance))).astype(np.float32)
+            tmp_path = f'{path}.tmp{os.getpid()}.npy'
+            np.save(tmp_path, table)
+            os.replace(tmp_path, path)
+
+        table.flags.writeable = False
+        _tables[key] = table
+
+    return _tables[key][0], _tables[key][1]
+
+
+def property_table(wavelengths, num_angles, values):
+    '''
+    Builds a (num_angles, n_wavelengths, 2) table of (wavelength, value) pairs, the per-angle layout chroma
+    expects for angle dependent surface properties, in one allocation.
+
+    :param values: Value at every angle and wavelength, anything that broadcasts to (num_angles, n_wavelengths)
+    :type values: float or np.ndarray
+    :return: The table, table[i] is the (n_wavelengths, 2) array of angle i
+    :rtype: np.ndarray
+    '''
+    table = np.empty((num_angles, len(wavelengths), 2), dtype=np.float32)
+    table[:, :, 0] = wavelengths
+    table[:, :, 1] = values
+    return table
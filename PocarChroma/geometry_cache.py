@@ -0,0 +1,103 @@
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+from .cache import cache_dir, digest, file_digest
+
+
+# Arrays at least this large are stored as separate .npy files and memory mapped back in
+MMAP_MIN_BYTES = 1 << 16
+
+
+def geometry_cache_key(geometry_df, mat_manager, surf_manager, exclude):
+    '''
+    Returns the cache key of a geometry: a digest of the geometry, material and surface tables, the contents
+    of every STL file that is used, the exclude list, and the built materials and surfaces
+    (which also covers files they were built from, like the SiPM reflectivity table, and properties overwritten in memory).
+    '''
+    used_rows = geometry_df[~geometry_df['name'].isin(exclude)]
+    stl_digests = [file_digest(path) for path in used_rows['stl_filepath']]
+
+    return digest(
+        geometry_df.to_csv(index=False),
+        mat_manager.materials_df.to_csv(index=False),
+        surf_manager.surfaces_df.to_csv(index=False),
+        *stl_digests,
+        sorted(exclude),
+        pickle.dumps(mat_manager.materials, protocol=pickle.HIGHEST_PROTOCOL),
+        pickle.dumps(surf_manager.surfaces, protocol=pickle.HIGHEST_PROTOCOL),
+    )
+
+
+class _ArrayPickler(pickle.Pickler):
+    '''
+    Pickler that writes large numpy arrays to their own .npy files instead of into the pickle
+    '''
+    def __init__(self, file, directory):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.saved = {}
+
+    def persistent_id(self, obj):
+        if type(obj) is np.ndarray and not obj.dtype.hasobject and obj.nbytes >= MMAP_MIN_BYTES:
+            # arrays referenced more than once are only stored once
+            if id(obj) not in self.saved:
+                name = f'array_{len(self.saved)}.npy'
+                np.save(os.path.join(self.directory, name), obj, allow_pickle=False)
+                self.saved[id(obj)] = name
+            return self.saved[id(obj)]
+        return None
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    '''
+    Unpickler that memory maps the arrays written by _ArrayPickler.
+    Maps are copy-on-write, so the arrays can still be modified in memory without touching the cache.
+    '''
+    def __init__(self, file, directory):
+        super().__init__(file)
+        self.directory = directory
+        self.loaded = {}
+
+    def persistent_load(self, name):
+        if name not in self.loaded:
+            self.loaded[name] = np.load(os.path.join(self.directory, name), mmap_mode='c')
+        return self.loaded[name]
+
+
+def save_geometry(key, detector, solids):
+    '''
+    Stores a flattened Detector (with its BVH) and the dict of its solids in the cache under key
+    '''
+    entry_dir = os.path.join(cache_dir('geometry'), key)
+    if os.path.isdir(entry_dir):
+        return
+
+    # write to a temporary directory and move it into place, so other processes never see a half written entry
+    tmp_dir = f'{entry_dir}.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        with open(os.path.join(tmp_dir, 'geometry.pkl'), 'wb') as f:
+            _ArrayPickler(f, tmp_dir).dump((detector, solids))
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    except (pickle.PicklingError, TypeError, AttributeError) as err:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f'Could not cache geometry: {err}')
+
+
+def load_geometry(key):
+    '''
+    Returns the (detector, solids) stored in the cache under key, or None if there is no such entry
+    '''
+    entry_dir = os.path.join(cache_dir('geometry'), key)
+    pickle_path = os.path.join(entry_dir, 'geometry.pkl')
+    if not os.path.exists(pickle_path):
+        return None
+
+    with open(pickle_path, 'rb') as f:
+        return _ArrayUnpickler(f, entry_dir).load()
@@ -1,129 +1,378 @@
-#!/usr/bin/env python
-from chroma.detector import Detector
-from chroma.stl import mesh_from_stl
-from chroma.geometry import Solid
-from chroma import view
-from chroma.loader import load_bvh
-
-
-import pandas as pd
-import matplotlib.colors as colors
-import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits import mplot3d
-
-from .material_manager import material_manager
-from .surface_manager import surface_manager
-
-
-class geometry_manager:
-    """
-    Manages the geometry of an experiment by reading component data from a CSV file,
-    creating solid objects, and organizing them into a detector geometry.
-
-    Attributes:
-        experiment_name (str): String used to identify each experiment.
-        mat_manager (material_manager): Instance of the material_manager class.
-        surf_manager (surface_manager): Instance of the surface_manager class.
-        global_geometry (Detector): The global detector geometry.
-        geometry_data_path (str): Path to the CSV file with geometry component data.
-        geometry_df (pd.DataFrame): DataFrame containing the geometry component data.
-        solids (dict): Dictionary of solid objects.
-    """
-
-    def __init__(self,
-                 geometry_data_path,
-                 material_data_path,
-                 surface_data_path,
-                 exclude=None,
-                 surf_manager = None,
-                 ):
-        """
-        Initializes the geometry_manager with the given experiment name and run ID.
-
-        Args:
-            experiment_name (str): String used to identify each experiment.
-        """
-        self.exclude = [] if exclude is None else exclude
-        self.geometry_data_path = geometry_data_path
-        self.mat_manager = material_manager(material_data_path) if surf_manager is None else surf_manager.mat_manager
-        self.surf_manager = surface_manager(self.mat_manager, surface_data_path) if surf_manager is None else surf_manager
-        self.global_geometry = Detector(self.mat_manager.global_material)
-        if isinstance(geometry_data_path, str):
-            self.geometry_df = pd.read_csv(self.geometry_data_path)
-        else:
-            self.geometry_df = geometry_data_path
-        self.build_geometry()
-
-        self.global_geometry.flatten()
-        self.global_geometry.bvh = load_bvh(self.global_geometry)
-
-    def build_geometry(self):
-        """
-        Builds the geometry by reading the CSV file and creating solid objects.
-        Adds the solids to the global geometry based on their type.
-        """
-
-        # iterate through all geometries and create Solid object, store into dictionary of solids
-        self.solids = {}
-        for index, row in self.geometry_df.iterrows():
-            curr_name = row["name"]
-
-            if curr_name in self.exclude:
-                continue
-
-            mesh = mesh_from_stl(
-                filename=row["stl_filepath"]
-            )  # convert the stl files to mesh used in Chroma?
-            inner_mat = self.mat_manager.get_material(row["inner_mat"])
-            outer_mat = self.mat_manager.get_material(row["outer_mat"])
-
-            if "killing surface" in self.geometry_df and bool(row["killing surface"]):
-                surface = self.surf_manager.get_surface("killing surface")
-            else:
-                surface = self.surf_manager.get_surface(row["surface"])
-
-            color = int(colors.cnames[row["color"]][1:], 16)
-
-            curr_displacement = (
-                row["displacement x"],
-                row["displacement y"],
-                row["displacement z"],
-            )
-            self.solids[curr_name] = Solid(
-                mesh=mesh,
-                material1=inner_mat,
-                material2=outer_mat,
-                surface=surface,
-                color=color,
-            )
-            # check to see if it is a detecting volume, add to geometry, (pmt and other solid will be treated differently?)
-            if row["solid_type"] == "pmt":
-                self.global_geometry.add_pmt(
-                    pmt=self.solids[curr_name],
-                    rotation=None,
-                    displacement=curr_displacement,
-                )
-            elif row["solid_type"] == "solid":
-                self.global_geometry.add_solid(
-                    solid=self.solids[curr_name],
-                    rotation=None,
-                    displacement=curr_displacement,
-                )
-
-    def get_solid_center(self, name):
-        """
-        Gets the center of a solid object.
-
-        Args:
-            name (str): The name of the solid.
-
-        Returns:
-            list: Coordinates of the center of the solid.
-        """
-        curr_mesh_triangles = self.solids[name].mesh.get_triangle_centers()
-        return [
-            np.mean(curr_mesh_triangles[:, 0]),
-            np.mean(curr_mesh_triangles[:, 1]),
-            np.mean(curr_mesh_triangles[:, 2]),
-        ]
+#!/usr/bin/env python
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from chroma.detector import Detector
+from chroma.stl import mesh_from_stl
+from chroma.geometry import Solid
+
+
+import pandas as pd
+import numpy as np
+
+from .material_manager import material_manager
+from .surface_manager import surface_manager
+from .geometry_cache import geometry_cache_key, load_geometry, save_geometry
+from . import profiling
+
+
+def _load_stl(path):
+    """
+    Loads one STL file, returning the mesh and the seconds it took. Module level so it can run in a process pool.
+    """
+    start = time.perf_counter()
+    mesh = mesh_from_stl(filename=path)
+    return mesh, time.perf_counter() - start
+
+
+class geometry_manager:
+    """
+    Manages the geometry of an experiment by reading component data from a CSV file,
+    creating solid objects, and organizing them into a detector geometry.
+
+    Attributes:
+        experiment_name (str): String used to identify each experiment.
+        mat_manager (material_manager): Instance of the material_manager class.
+        surf_manager (surface_manager): Instance of the surface_manager class.
+        global_geometry (Detector): The global detector geometry.
+        geometry_data_path (str): Path to the CSV file with geometry component data.
+        geometry_df (pd.DataFrame): DataFrame containing the geometry component data.
+        solids (dict): Dictionary of solid objects.
+        cache_key (str): Key of the geometry in the geometry cache, None if the cache is not used.
+        stl_load_times (dict): Seconds spent loading each STL file, keyed by path. Empty if the geometry came from the cache.
+        solid_ids (dict): Solid id (index into solid_metrics and the flattened geometry's solid_id) of every solid, keyed by name.
+        solid_metrics (np.ndarray): Structured array of per-solid metrics indexed by solid id, see build_solid_metrics.
+        triangle_normals (np.ndarray): Unit normal of every triangle of the flattened geometry, shape (n_triangles, 3).
+        triangle_areas (np.ndarray): Area of every triangle of the flattened geometry.
+    """
+
+    def __init__(self,
+                 geometry_data_path,
+                 material_data_path,
+                 surface_data_path,
+                 exclude=None,
+                 surf_manager = None,
+                 use_cache = True,
+                 load_workers = None,
+                 load_pool = "thread",
+                 ):
+        """
+        Initializes the geometry_manager with the given experiment name and run ID.
+
+        The flattened geometry and its BVH are cached on disk (see geometry_cache), keyed on the contents of the
+        geometry, material and surface tables, the STL files and the exclude list. When nothing changed, they are
+        memory mapped back in instead of rebuilt.
+
+        Args:
+            experiment_name (str): String used to identify each experiment.
+            use_cache (bool): Whether to load the geometry from, and store it in, the geometry cache.
+            load_workers (int): Number of workers loading STL files, see build_geometry.
+            load_pool (str): "thread" or "process", the kind of pool loading STL files, see build_geometry.
+        """
+        self.exclude = [] if exclude is None else exclude
+        self.geometry_data_path = geometry_data_path
+        self.mat_manager = material_manager(material_data_path) if surf_manager is None else surf_manager.mat_manager
+        self.surf_manager = surface_manager(self.mat_manager, surface_data_path) if surf_manager is None else surf_manager
+        if isinstance(geometry_data_path, str):
+            self.geometry_df = pd.read_csv(self.geometry_data_path)
+        else:
+            self.geometry_df = geometry_data_path
+
+        self.stl_load_times = {}
+
+        with profiling.stage("geometry"):
+            with profiling.stage("cache_load"):
+                self.cache_key = geometry_cache_key(self.geometry_df, self.mat_manager, self.surf_manager, self.exclude) if use_cache else None
+                cached = load_geometry(self.cache_key) if use_cache else None
+
+            if cached is not None:
+                self.global_geometry, self.solids = cached
+                self.relink_cached_geometry()
+            else:
+                # building the BVH needs the GPU, so chroma.loader is only imported when there is no cached geometry
+                from chroma.loader import load_bvh
+
+                self.global_geometry = Detector(self.mat_manager.global_material)
+                with profiling.stage("build"):
+                    self.build_geometry(load_workers=load_workers, load_pool=load_pool)
+
+                with profiling.stage("flatten"):
+                    self.global_geometry.flatten()
+                with profiling.stage("bvh"):
+                    self.global_geometry.bvh = load_bvh(self.global_geometry)
+
+                if use_cache:
+                    with profiling.stage("cache_save"):
+                        save_geometry(self.cache_key, self.global_geometry, self.solids)
+
+            with profiling.stage("solid_metrics"):
+                self.build_solid_metrics()
+
+    def relink_cached_geometry(self):
+        """
+        Points the materials and surfaces of a geometry loaded from the cache back at the objects of
+        this geometry_manager's material and surface managers (matched by name), so changes made through
+        the managers, like surface_manager.overwrite_property, still reach the geometry.
+        """
+        materials = self.mat_manager.materials
+        surfaces = self.surf_manager.surfaces
+
+        self.global_geometry.unique_materials = [
+            materials.get(material.name, material) if material is not None else None
+            for material in self.global_geometry.unique_materials
+        ]
+        self.global_geometry.unique_surfaces = [
+            surfaces.get(surface.name, surface) if surface is not None else None
+            for surface in self.global_geometry.unique_surfaces
+        ]
+        if getattr(self.global_geometry, "detector_material", None) is not None:
+            self.global_geometry.detector_material = self.mat_manager.global_material
+
+    def build_geometry(self, load_workers=None, load_pool="thread"):
+        """
+        Builds the geometry by reading the CSV file and creating solid objects.
+        Adds the solids to the global geometry based on their type.
+
+        The STL files are parsed concurrently first, each file once even if several solids use it.
+        The solids are then created and added to the detector serially in the order of the CSV,
+        so the flattened geometry is the same whatever order the files finish loading in.
+
+        Args:
+            load_workers (int): Number of workers loading STL files. None lets the executor choose, 1 loads serially.
+            load_pool (str): "thread" or "process". Processes avoid the GIL for the Python parts of the parser,
+                at the cost of sending every mesh back to this process.
+        """
+        # only needed for the color names, imported here so headless jobs that load a cached geometry never import matplotlib
+        import matplotlib.colors as colors
+
+        rows = self.geometry_df[~self.geometry_df["name"].isin(self.exclude)]
+        stl_paths = list(dict.fromkeys(rows["stl_filepath"]))
+
+        start = time.perf_counter()
+        with profiling.stage("load_stl"):
+            if load_workers == 1 or len(stl_paths) <= 1:
+                loaded = [_load_stl(path) for path in stl_paths]
+            else:
+                if load_pool == "thread":
+                    executor = ThreadPoolExecutor(max_workers=load_workers)
+                elif load_pool == "process":
+                    executor = ProcessPoolExecutor(max_workers=load_workers)
+                else:
+                    raise ValueError(f'load_pool must be "thread" or "process", not {load_pool!r}')
+                with executor:
+                    loaded = list(executor.map(_load_stl, stl_paths))
+        elapsed = time.perf_counter() - start
+        profiling.count("stl_files", len(stl_paths))
+
+        meshes = {path: mesh for path, (mesh, _) in zip(stl_paths, loaded)}
+        self.stl_load_times = {path: seconds for path, (_, seconds) in zip(stl_paths, loaded)}
+
+        slowest = sorted(self.stl_load_times.items(), key=lambda item: item[1], reverse=True)[:5]
+        print(f"Loaded {len(stl_paths)} STL files in {elapsed:.2f} s, slowest:")
+        for path, seconds in slowest:
+            print(f"    {seconds:8.3f} s  {path}")
+
+        # iterate through all geometries and create Solid object, store into dictionary of solids
+        self.solids = {}
+        for index, row in rows.iterrows():
+            curr_name = row["name"]
+
+            mesh = meshes[row["stl_filepath"]]
+            inner_mat = self.mat_manager.get_material(row["inner_mat"])
+            outer_mat = self.mat_manager.get_material(row["outer_mat"])
+
+            if "killing surface" in self.geometry_df and bool(row["killing surface"]):
+                surface = self.surf_manager.get_surface("killing surface")
+            else:
+                surface = self.surf_manager.get_surface(row["surface"])
+
+            color = int(colors.cnames[row["color"]][1:], 16)
+
+            curr_displacement = (
+                row["displacement x"],
+                row["displacement y"],
+                row["displacement z"],
+            )
+            self.solids[curr_name] = Solid(
+                mesh=mesh,
+                material1=inner_mat,
+                material2=outer_mat,
+                surface=surface,
+                color=color,
+            )
+            # check to see if it is a detecting volume, add to geometry, (pmt and other solid will be treated differently?)
+            if row["solid_type"] == "pmt":
+                self.global_geometry.add_pmt(
+                    pmt=self.solids[curr_name],
+                    rotation=None,
+                    displacement=curr_displacement,
+                )
+            elif row["solid_type"] == "solid":
+                self.global_geometry.add_solid(
+                    solid=self.solids[curr_name],
+                    rotation=None,
+                    displacement=curr_displacement,
+                )
+
+    def apply_changes(self, displacements=None, surfaces=None, material_properties=None, surface_properties=None):
+        """
+        Applies changes to the built geometry in place, for parameter sweeps that change only a few solids or properties.
+
+        No STL file is read again, and only the affected parts of the flattened geometry are patched:
+        a moved solid rewrites its own vertices (followed by a new BVH), a swapped surface rewrites the surface
+        index of its own triangles, and a changed material property rebuilds only the surfaces computed from it.
+        The geometry table is updated to match. The patched geometry is not stored in the geometry cache.
+
+        Args:
+            displacements (dict): New (x, y, z) displacement, keyed by solid name.
+            surfaces (dict): Name of the new surface ("None" for no surface), keyed by solid name.
+            material_properties (dict): {material name: {property: value}}, e.g. {"silica": {"refractive_index": 1.6}}.
+            surface_properties (dict): {surface name: {property: value}}, e.g. {"teflon": {"reflect_diffuse": 0.9}}.
+        """
+        geometry = self.global_geometry
+        solid_names = list(self.solids.keys())
+        rows = {name: index for index, name in zip(self.geometry_df.index, self.geometry_df["name"])}
+
+        # vertex and triangle ranges of every solid in the flattened mesh, in the order they were added
+        nv = np.cumsum([0] + [len(solid.mesh.vertices) for solid in geometry.solids])
+        nt = np.cumsum([0] + [len(solid.mesh.triangles) for solid in geometry.solids])
+
+        for material_name, properties in (material_properties or {}).items():
+            for property, value in properties.items():
+                self.mat_manager.set_property(material_name, property, value)
+            for old_surface, new_surface in self.surf_manager.rebuild_surfaces(material_name).values():
+                self._replace_surface(old_surface, new_surface)
+
+        for surface_name, properties in (surface_properties or {}).items():
+            for property, value in properties.items():
+                self.surf_manager.overwrite_property(surface_name, property, value)
+
+        for name, surface_name in (surfaces or {}).items():
+            i = solid_names.index(name)
+            surface = self.surf_manager.get_surface(surface_name)
+            geometry.solids[i].surface[:] = surface
+
+            if surface is None:
+                surface_index = -1
+            else:
+                if surface not in geometry.unique_surfaces:
+                    geometry.unique_surfaces.append(surface)
+                surface_index = geometry.unique_surfaces.index(surface)
+            geometry.surface_index[nt[i]:nt[i + 1]] = surface_index
+            self.geometry_df.loc[rows[name], "surface"] = surface_name
+
+        if displacements:
+            for name, displacement in displacements.items():
+                i = solid_names.index(name)
+                solid = geometry.solids[i]
+                geometry.solid_displacements[i] = np.asarray(displacement, dtype=np.float32)
+                geometry.mesh.vertices[nv[i]:nv[i + 1]] = (
+                    np.inner(solid.mesh.vertices, geometry.solid_rotations[i]) + geometry.solid_displacements[i]
+                )
+                self.geometry_df.loc[rows[name], ["displacement x", "displacement y", "displacement z"]] = list(displacement)
+
+            from chroma.loader import load_bvh
+
+            geometry.bvh = load_bvh(geometry)
+            self.build_solid_metrics()
+
+        # the geometry no longer matches its cache entry
+        self.cache_key = None
+
+    def _replace_surface(self, old_surface, new_surface):
+        """
+        Points every triangle using old_surface at new_surface, keeping the surface indices of the flattened geometry.
+        """
+        for solid in self.global_geometry.solids:
+            solid.surface[solid.surface == old_surface] = new_surface
+
+        unique_surfaces = self.global_geometry.unique_surfaces
+        for i, surface in enumerate(unique_surfaces):
+            if surface is old_surface:
+                unique_surfaces[i] = new_surface
+
+    def build_solid_metrics(self):
+        """
+        Computes the per-triangle normals and areas of the flattened geometry, and a table of per-solid metrics,
+        so analysis and source placement code can look them up instead of recomputing them from the meshes.
+
+        The table is a structured array indexed by solid id (the order of self.solids) with the fields
+            first_triangle, n_triangles: the range of the solid's triangles in the flattened geometry
+            area: total surface area
+            centroid: area weighted centroid of the surface, in the global frame
+            aabb_min, aabb_max: corners of the axis aligned bounding box, in the global frame
+            center: mean of the triangle centers in the frame of the solid's mesh, as returned by get_solid_center
+        """
+        geometry = self.global_geometry
+        vertices = np.asarray(geometry.mesh.vertices, dtype=np.float64)
+        triangles = np.asarray(geometry.mesh.triangles)
+
+        v0 = vertices[triangles[:, 0]]
+        v1 = vertices[triangles[:, 1]]
+        v2 = vertices[triangles[:, 2]]
+        cross = np.cross(v1 - v0, v2 - v0)
+        double_areas = np.linalg.norm(cross, axis=1)
+        triangle_centers = (v0 + v1 + v2) / 3
+
+        self.triangle_areas = (double_areas / 2).astype(np.float32)
+        # degenerate triangles get a zero normal
+        self.triangle_normals = np.divide(
+            cross, double_areas[:, None], out=np.zeros_like(cross), where=double_areas[:, None] > 0
+        ).astype(np.float32)
+
+        n_solids = len(geometry.solids)
+        self.solid_ids = {name: i for i, name in enumerate(self.solids)}
+        self.solid_metrics = np.zeros(n_solids, dtype=[
+            ("first_triangle", np.int64),
+            ("n_triangles", np.int64),
+            ("area", np.float64),
+            ("centroid", np.float64, (3,)),
+            ("aabb_min", np.float64, (3,)),
+            ("aabb_max", np.float64, (3,)),
+            ("center", np.float64, (3,)),
+        ])
+
+        # the triangles of every solid are contiguous, in the order the solids were added
+        n_triangles = np.array([len(solid.mesh.triangles) for solid in geometry.solids], dtype=np.int64)
+        first_triangle = np.concatenate(([0], np.cumsum(n_triangles)[:-1]))
+        self.solid_metrics["first_triangle"] = first_triangle
+        self.solid_metrics["n_triangles"] = n_triangles
+
+        areas = np.add.reduceat(self.triangle_areas.astype(np.float64), first_triangle)
+        self.solid_metrics["area"] = areas
+        weighted_centers = np.add.reduceat(triangle_centers * (double_areas[:, None] / 2), first_triangle)
+        self.solid_metrics["centroid"] = weighted_centers / np.where(areas > 0, areas, 1)[:, None]
+
+        corners = np.stack((v0, v1, v2), axis=1)
+        self.solid_metrics["aabb_min"] = np.minimum.reduceat(corners.min(axis=1), first_triangle)
+        self.solid_metrics["aabb_max"] = np.maximum.reduceat(corners.max(axis=1), first_triangle)
+
+        # undo the displacement and rotation of every solid to get the center in the frame of its mesh
+        global_centers = np.add.reduceat(triangle_centers, first_triangle) / n_triangles[:, None]
+        for i in range(n_solids):
+            rotation = np.asarray(geometry.solid_rotations[i], dtype=np.float64)
+            self.solid_metrics["center"][i] = (global_centers[i] - geometry.solid_displacements[i]) @ rotation
+
+    def get_solid_metrics(self, name):
+        """
+        Gets the metrics of a solid object, see build_solid_metrics.
+
+        Args:
+            name (str): The name of the solid.
+
+        Returns:
+            np.void: The solid's row of solid_metrics, with fields first_triangle, n_triangles, area, centroid, aabb_min, aabb_max and center.
+        """
+        return self.solid_metrics[self.solid_ids[name]]
+
+    def get_solid_center(self, name):
+        """
+        Gets the center of a solid object.
+
+        Args:
+            name (str): The name of the solid.
+
+        Returns:
+            list: Coordinates of the center of the solid.
+        """
+        return self.get_solid_metrics(name)["center"].tolist()
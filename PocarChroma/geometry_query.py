@@ -0,0 +1,389 @@
+import numpy as np
+import pandas as pd
+
+
+# Rays are cast in chunks of this many, which bounds the memory used by the (ray, node) pairs of the traversal
+RAY_CHUNK = 1 << 15
+
+# Direction used to cast rays for point-in-solid tests, skewed so rays are unlikely to run along edges or faces
+_PARITY_DIRECTION = np.array([0.5773, 0.5771, 0.5779]) / np.linalg.norm([0.5773, 0.5771, 0.5779])
+
+
+def _expand_bits(v):
+    '''
+    Spreads the lower 10 bits of v so there are two zero bits between each of them
+    '''
+    v = v.astype(np.uint64)
+    v = (v * np.uint64(0x00010001)) & np.uint64(0xFF0000FF)
+    v = (v * np.uint64(0x00000101)) & np.uint64(0x0F00F00F)
+    v = (v * np.uint64(0x00000011)) & np.uint64(0xC30C30C3)
+    v = (v * np.uint64(0x00000005)) & np.uint64(0x49249249)
+    return v
+
+
+def morton_codes(points, lower, upper):
+    '''
+    Returns the 30 bit Morton code of every point, on a 1024^3 grid spanning the box from lower to upper
+    '''
+    extent = np.maximum(upper - lower, 1e-12)
+    grid = np.clip((points - lower) / extent * 1023, 0, 1023).astype(np.uint32)
+    return (_expand_bits(grid[:, 0]) << np.uint64(2)) | (_expand_bits(grid[:, 1]) << np.uint64(1)) | _expand_bits(grid[:, 2])
+
+
+class geometry_query:
+    '''
+    CPU queries on a flattened geometry: ray casts, point-in-solid tests, and overlap and watertightness checks,
+    for validating source placement and geometries without the GPU.
+
+    The triangles are sorted along a Morton curve and grouped into leaves of leaf_size triangles, and a complete binary
+    tree of bounding boxes is built over the leaves (a linear BVH). As the tree is complete it is stored implicitly,
+    one array of boxes per level, and queries walk it one level at a time for all rays of a chunk at once.
+
+    :param vertices: Vertices of the flattened mesh, shape (n_vertices, 3)
+    :type vertices: np.ndarray
+    :param triangles: Vertex indices of every triangle, shape (n_triangles, 3)
+    :type triangles: np.ndarray
+    :param solid_id: Solid id of every triangle
+    :type solid_id: np.ndarray
+    :param solid_names: Name of every solid, in the order of the solid ids
+    :type solid_names: list
+    :param leaf_size: Number of triangles in every leaf of the tree
+    :type leaf_size: int
+    '''
+
+    def __init__(self, vertices, triangles, solid_id, solid_names = None, leaf_size = 4):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        self.solid_id = np.asarray(solid_id, dtype=np.int64)
+        self.n_solids = int(self.solid_id.max()) + 1 if len(self.solid_id) else 0
+        self.solid_names = list(solid_names) if solid_names is not None else [str(i) for i in range(self.n_solids)]
+        self.leaf_size = leaf_size
+
+        self.build()
+
+    @classmethod
+    def from_geometry_manager(cls, geometry_manager, leaf_size = 4):
+        '''
+        Builds the queries for the flattened geometry of a geometry_manager
+        '''
+        geometry = geometry_manager.global_geometry
+        return cls(
+            geometry.mesh.vertices,
+            geometry.mesh.triangles,
+            geometry.solid_id,
+            solid_names=list(geometry_manager.solids.keys()),
+            leaf_size=leaf_size,
+        )
+
+    def build(self):
+        '''
+        Builds the linear BVH over the triangles
+        '''
+        corners = self.vertices[self.triangles]
+        tri_min = corners.min(axis=1)
+        tri_max = corners.max(axis=1)
+        centers = corners.mean(axis=1)
+
+        self.bounds = (tri_min.min(axis=0), tri_max.max(axis=0))
+        self.order = np.argsort(morton_codes(centers, *self.bounds), kind='stable')
+
+        # triangles in Morton order, stored as a vertex and two edges for the intersection tests
+        ordered = corners[self.order].astype(np.float32)
+        self.v0 = ordered[:, 0]
+        self.edge1 = ordered[:, 1] - ordered[:, 0]
+        self.edge2 = ordered[:, 2] - ordered[:, 0]
+        self.ordered_solid_id = self.solid_id[self.order]
+
+        n_triangles = len(self.order)
+        n_leaves = max(1, -(-n_triangles // self.leaf_size))
+        self.depth = int(np.ceil(np.log2(n_leaves))) if n_leaves > 1 else 0
+        n_slots = (1 << self.depth) * self.leaf_size
+
+        # padding triangles have empty boxes, so they are never hit
+        padded_min = np.full((n_slots, 3), np.inf, dtype=np.float32)
+        padded_max = np.full((n_slots, 3), -np.inf, dtype=np.float32)
+        padded_min[:n_triangles] = tri_min[self.order]
+        padded_max[:n_triangles] = tri_max[self.order]
+
+        level_min = [padded_min.reshape(-1, self.leaf_size, 3).min(axis=1)]
+        level_max = [padded_max.reshape(-1, self.leaf_size, 3).max(axis=1)]
+        while len(level_min[-1]) > 1:
+            level_min.append(level_min[-1].reshape(-1, 2, 3).min(axis=1))
+            level_max.append(level_max[-1].reshape(-1, 2, 3).max(axis=1))
+
+        # level 0 is the root, level depth the leaves. Every box is stored as (min x, y, z, max x, y, z)
+        self.level_boxes = [np.hstack((lo, hi)) for lo, hi in zip(level_min[::-1], level_max[::-1])]
+
+        # smallest box first when a point is inside several solids
+        self.solid_volume = np.full(self.n_solids, np.inf)
+        for sid in range(self.n_solids):
+            in_solid = self.solid_id == sid
+            if in_solid.any():
+                self.solid_volume[sid] = np.prod(tri_max[in_solid].max(axis=0) - tri_min[in_solid].min(axis=0))
+
+    def _leaf_candidates(self, origins, inv_directions, max_t):
+        '''
+        Walks the tree level by level, returning the (ray, leaf) pairs whose leaf boxes the rays pass through,
+        and the distance at which each ray enters the leaf box
+        '''
+        ray = np.arange(len(origins))
+        node = np.zeros(len(origins), dtype=np.int64)
+        origins = origins.astype(np.float32)
+        inv_directions = inv_directions.astype(np.float32)
+
+        for level in range(self.depth + 1):
+            box = self.level_boxes[level][node]
+            o = origins[ray]
+            inv = inv_directions[ray]
+            t1 = (box[:, :3] - o) * inv
+            t2 = (box[:, 3:] - o) * inv
+            t_min = np.minimum(t1, t2)
+            t_max = np.maximum(t1, t2)
+            # reducing over the short axis by hand is much faster than .max(axis=1)
+            t_near = np.maximum(np.maximum(t_min[:, 0], t_min[:, 1]), t_min[:, 2])
+            t_far = np.minimum(np.minimum(t_max[:, 0], t_max[:, 1]), t_max[:, 2])
+            keep = (t_near <= t_far) & (t_far >= 0) & (t_near <= max_t[ray])
+            ray, node, t_near = ray[keep], node[keep], t_near[keep]
+
+            if level < self.depth:
+                ray = np.repeat(ray, 2)
+                node = (node[:, None] * 2 + np.arange(2)).ravel()
+
+        return ray, node, t_near
+
+    def _intersect(self, origins, directions, ray, tri, t_min, max_t):
+        '''
+        Moller-Trumbore intersection of the given (ray, triangle) pairs, both faces of the triangles count.
+        Returns the pairs that hit and their distances, in units of the direction length.
+        '''
+        d = directions[ray]
+        e1 = self.edge1[tri].astype(np.float64)
+        e2 = self.edge2[tri].astype(np.float64)
+
+        pvec = np.cross(d, e2)
+        det = np.einsum('ij,ij->i', e1, pvec)
+        hit = np.abs(det) > 1e-12
+        inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=hit)
+
+        tvec = origins[ray] - self.v0[tri]
+        u = np.einsum('ij,ij->i', tvec, pvec) * inv_det
+        hit &= (u >= 0) & (u <= 1)
+
+        qvec = np.cross(tvec, e1)
+        v = np.einsum('ij,ij->i', d, qvec) * inv_det
+        hit &= (v >= 0) & (u + v <= 1)
+
+        t = np.einsum('ij,ij->i', e2, qvec) * inv_det
+        hit &= (t > t_min) & (t <= max_t[ray])
+
+        return ray[hit], tri[hit], t[hit]
+
+    def _leaf_hits(self, origins, directions, ray, leaf, t_min, max_t):
+        '''
+        Intersects the rays with every triangle of the given (ray, leaf) pairs
+        '''
+        tri = (leaf[:, None] * self.leaf_size + np.arange(self.leaf_size)).ravel()
+        ray = np.repeat(ray, self.leaf_size)
+        valid = tri < len(self.order)
+        return self._intersect(origins, directions, ray[valid], tri[valid], t_min, max_t)
+
+    def _cast_chunk(self, origins, directions, max_t, t_min, all_hits):
+        # keep 1 / direction finite in float32, so rays on the plane of a box face don't produce 0 * inf
+        safe = np.where(np.abs(directions) < 1e-30, 1e-30, directions)
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            inv_directions = 1.0 / safe
+
+            ray, leaf, t_near = self._leaf_candidates(origins, inv_directions, max_t)
+
+        if all_hits:
+            return self._leaf_hits(origins, directions, ray, leaf, t_min, max_t)
+
+        # Closest hits: visit the leaves of every ray nearest first, in rounds of growing size,
+        # and drop the leaves a ray enters beyond its closest hit so far
+        order = np.lexsort((t_near, ray))
+        ray, leaf, t_near = ray[order], leaf[order], t_near[order]
+        starts = np.flatnonzero(np.r_[True, ray[1:] != ray[:-1]]) if len(ray) else np.zeros(0, dtype=np.int64)
+        rank = np.arange(len(ray)) - np.repeat(starts, np.diff(np.r_[starts, len(ray)]))
+
+        best_t = max_t.astype(np.float64).copy()
+        best_tri = np.full(len(origins), -1, dtype=np.int64)
+        round_size = 2
+        while len(ray):
+            now = rank < round_size
+            hit_ray, hit_tri, hit_t = self._leaf_hits(origins, directions, ray[now], leaf[now], t_min, best_t)
+            if len(hit_ray):
+                closest = np.lexsort((hit_t, hit_ray))
+                hit_ray, hit_tri, hit_t = hit_ray[closest], hit_tri[closest], hit_t[closest]
+                first = np.r_[True, hit_ray[1:] != hit_ray[:-1]]
+                better = hit_t[first] < best_t[hit_ray[first]]
+                best_t[hit_ray[first][better]] = hit_t[first][better]
+                best_tri[hit_ray[first][better]] = hit_tri[first][better]
+
+            later = ~now & (t_near <= best_t[ray])
+            ray, leaf, t_near, rank = ray[later], leaf[later], t_near[later], rank[later] - round_size
+            round_size *= 2
+
+        found = np.flatnonzero(best_tri >= 0)
+        return found, best_tri[found], best_t[found]
+
+    def _cast(self, origins, directions, max_t, t_min, all_hits):
+        '''
+        Casts rays without normalising their directions, so distances are in units of the direction length.
+        Yields the hits of every chunk of rays, with ray indices into the full arrays and triangle indices in Morton order.
+        '''
+        for start in range(0, len(origins), RAY_CHUNK):
+            stop = min(start + RAY_CHUNK, len(origins))
+            ray, tri, t = self._cast_chunk(origins[start:stop], directions[start:stop], max_t[start:stop], t_min, all_hits)
+            yield ray + start, tri, t
+
+    def ray_cast(self, origins, directions, max_distance = np.inf, all_hits = False):
+        '''
+        Casts rays through the geometry.
+
+        :param origins: Ray origins, shape (n, 3)
+        :type origins: np.ndarray
+        :param directions: Ray directions, shape (n, 3), normalised here
+        :type directions: np.ndarray
+        :param max_distance: Ignore hits further than this, a scalar or one value per ray
+        :type max_distance: float or np.ndarray
+        :param all_hits: Return every hit instead of the closest hit of every ray
+        :type all_hits: bool
+        :return: If all_hits, a dataframe with the ray, distance, triangle and solid of every hit, sorted by ray and distance.
+            Otherwise the distance, triangle and solid id of the closest hit of every ray (inf, -1, -1 for rays that miss)
+        :rtype: pd.DataFrame or tuple
+        '''
+        origins = np.atleast_2d(np.asarray(origins, dtype=np.float64))
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float64))
+        directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+        directions = np.broadcast_to(directions, origins.shape)
+        max_t = np.broadcast_to(np.asarray(max_distance, dtype=np.float64), (len(origins),))
+
+        hits = list(self._cast(origins, directions, max_t, 1e-9, all_hits))
+        ray = np.concatenate([h[0] for h in hits]) if hits else np.zeros(0, dtype=np.int64)
+        tri = np.concatenate([h[1] for h in hits]) if hits else np.zeros(0, dtype=np.int64)
+        t = np.concatenate([h[2] for h in hits]) if hits else np.zeros(0)
+        triangle = self.order[tri]
+
+        if all_hits:
+            order = np.lexsort((t, ray))
+            return pd.DataFrame({
+                'ray': ray[order],
+                'distance': t[order],
+                'triangle': triangle[order],
+                'solid': self.solid_id[triangle[order]],
+            })
+
+        distance = np.full(len(origins), np.inf)
+        hit_triangle = np.full(len(origins), -1, dtype=np.int64)
+        hit_solid = np.full(len(origins), -1, dtype=np.int64)
+        distance[ray] = t
+        hit_triangle[ray] = triangle
+        hit_solid[ray] = self.solid_id[triangle]
+        return distance, hit_triangle, hit_solid
+
+    def _crossings(self, points):
+        '''
+        Returns the (point, solid) pairs of every surface crossing of a ray cast from each point, and how often each pair crosses
+        '''
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        directions = np.broadcast_to(_PARITY_DIRECTION, points.shape)
+        max_t = np.full(len(points), np.inf)
+
+        keys = [ray * self.n_solids + self.ordered_solid_id[tri] for ray, tri, _ in self._cast(points, directions, max_t, 0.0, True)]
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        pairs, counts = np.unique(keys, return_counts=True)
+        return pairs // self.n_solids, pairs % self.n_solids, counts
+
+    def point_in_solid(self, points, name):
+        '''
+        Returns whether each point is inside the named solid, by the parity of the surface crossings of a ray from the point.
+        The solid must be closed, see check_watertight.
+        '''
+        sid = self.solid_names.index(name)
+        point, solid, counts = self._crossings(points)
+        inside = np.zeros(len(np.atleast_2d(points)), dtype=bool)
+        inside[point[(solid == sid) & (counts % 2 == 1)]] = True
+        return inside
+
+    def locate(self, points):
+        '''
+        Returns the id of the solid containing each point, -1 for points outside every solid.
+        Points inside nested solids are given the innermost one (the one with the smallest bounding box).
+        '''
+        point, solid, counts = self._crossings(points)
+        odd = counts % 2 == 1
+        point, solid = point[odd], solid[odd]
+
+        located = np.full(len(np.atleast_2d(points)), -1, dtype=np.int64)
+        # write the largest solids first, so smaller (inner) solids overwrite them
+        order = np.argsort(-self.solid_volume[solid], kind='stable')
+        located[point[order]] = solid[order]
+        return located
+
+    def find_overlaps(self, tolerance = 1e-6):
+        '''
+        Finds pairs of solids whose surfaces intersect, by casting every triangle edge of each solid as a segment
+        against all other solids. Intersections within tolerance (relative to the edge length) of an edge's ends are
+        ignored, so solids that only touch are not reported.
+
+        :return: A dataframe with solid_a, solid_b (names) and the number of edge intersections, one row per overlapping pair
+        :rtype: pd.DataFrame
+        '''
+        edges = np.concatenate([self.triangles[:, [0, 1]], self.triangles[:, [1, 2]], self.triangles[:, [2, 0]]])
+        edge_solid = np.tile(self.solid_id, 3)
+        edges, first = np.unique(np.sort(edges, axis=1), axis=0, return_index=True)
+        edge_solid = edge_solid[first]
+
+        origins = self.vertices[edges[:, 0]]
+        directions = self.vertices[edges[:, 1]] - origins
+        max_t = np.full(len(edges), 1 - tolerance)
+
+        keys = []
+        for ray, tri, _ in self._cast(origins, directions, max_t, tolerance, True):
+            other = self.ordered_solid_id[tri]
+            crossing = other != edge_solid[ray]
+            a = np.minimum(edge_solid[ray][crossing], other[crossing])
+            b = np.maximum(edge_solid[ray][crossing], other[crossing])
+            keys.append(a * self.n_solids + b)
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+
+        pairs, counts = np.unique(keys, return_counts=True)
+        return pd.DataFrame({
+            'solid_a': [self.solid_names[i] for i in pairs // self.n_solids],
+            'solid_b': [self.solid_names[i] for i in pairs % self.n_solids],
+            'intersections': counts,
+        })
+
+    def check_watertight(self, tolerance = 1e-4):
+        '''
+        Checks that every solid is a closed surface: after welding vertices closer than tolerance,
+        every edge of a solid must be shared by exactly two of its triangles.
+
+        :return: A dataframe with, for every solid, the number of triangles, boundary edges (used once),
+            non-manifold edges (used more than twice) and whether it is watertight
+        :rtype: pd.DataFrame
+        '''
+        grid = np.round(self.vertices / tolerance).astype(np.int64)
+        _, welded = np.unique(grid, axis=0, return_inverse=True)
+        welded = welded.ravel()
+        n_welded = int(welded.max()) + 1 if len(welded) else 0
+
+        tri = welded[self.triangles]
+        edges = np.concatenate([tri[:, [0, 1]], tri[:, [1, 2]], tri[:, [2, 0]]])
+        edge_solid = np.tile(self.solid_id, 3)
+        edges = np.sort(edges, axis=1)
+        # edges collapsed by the welding are ignored
+        proper = edges[:, 0] != edges[:, 1]
+        edge_keys = np.stack((edge_solid[proper], edges[proper, 0] * n_welded + edges[proper, 1]), axis=1)
+
+        unique_edges, counts = np.unique(edge_keys, axis=0, return_counts=True)
+        boundary = np.bincount(unique_edges[counts == 1, 0], minlength=self.n_solids)
+        nonmanifold = np.bincount(unique_edges[counts > 2, 0], minlength=self.n_solids)
+
+        return pd.DataFrame({
+            'solid': self.solid_names,
+            'triangles': np.bincount(self.solid_id, minlength=self.n_solids),
+            'boundary_edges': boundary,
+            'nonmanifold_edges': nonmanifold,
+            'watertight': (boundary == 0) & (nonmanifold == 0),
+        })
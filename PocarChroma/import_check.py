@@ -0,0 +1,110 @@
+'''
+Checks that importing the PocarChroma modules stays cheap, for the many short headless jobs that import them.
+
+Every module is imported in a fresh interpreter, a few times, and the fastest import is compared with its budget.
+The check also fails if importing a module pulls in plotting, viewer or GPU modules, which belong in the functions that use them.
+
+    python -m PocarChroma.import_check [--repeat 3] [--scale 1.0]
+
+Exits with status 1 if a module is over budget, imports a heavy module, or fails to import.
+The same check runs with the test suite, in tests/test_import_budget.py.
+'''
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Seconds each module may take to import in a fresh interpreter, most of which is numpy, pandas, h5py and chroma itself
+IMPORT_BUDGETS = {
+    'PocarChroma.save_load_sim': 1.0,
+    'PocarChroma.checkpoint': 1.0,
+    'PocarChroma.run_ledger': 1.0,
+    'PocarChroma.result_catalog': 1.0,
+    'PocarChroma.material_manager': 1.5,
+    'PocarChroma.surface_manager': 1.5,
+    'PocarChroma.geometry_manager': 1.5,
+    'PocarChroma.photons': 1.5,
+    'PocarChroma.analysis_manager': 1.0,
+    'PocarChroma.plotter': 1.0,
+}
+
+# Modules only plotting, viewing or propagating photons should import
+HEAVY_MODULES = ('matplotlib', 'mpl_toolkits', 'stl', 'pygame', 'chroma.view', 'chroma.camera', 'chroma.gpu', 'pycuda')
+
+_MEASURE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = sorted(name for name in sys.modules if any(name == h or name.startswith(h + '.') for h in {heavy!r}))
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+'''
+
+
+def measure_import(module, repeat = 3):
+    '''
+    Imports module in repeat fresh interpreters.
+
+    :return: The fastest import time in seconds and the heavy modules it imported, or None and the error if the import failed
+    :rtype: tuple
+    '''
+    code = _MEASURE.format(module=module, heavy=HEAVY_MODULES)
+
+    best = None
+    heavy = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        if best is None or measured['seconds'] < best:
+            best = measured['seconds']
+        heavy = measured['heavy']
+
+    return best, heavy
+
+
+def check_imports(budgets = None, repeat = 3, scale = 1.0):
+    '''
+    Measures the import time of every module in budgets and prints a report.
+
+    :param budgets: Seconds each module may take to import, IMPORT_BUDGETS if None
+    :type budgets: dict
+    :param scale: Factor applied to every budget, e.g. for slow shared file systems
+    :type scale: float
+    :return: True if every module imported within budget and without heavy modules
+    :rtype: bool
+    '''
+    budgets = IMPORT_BUDGETS if budgets is None else budgets
+
+    passed = True
+    for module, budget in budgets.items():
+        seconds, heavy = measure_import(module, repeat)
+        if seconds is None:
+            print(f'FAIL  {module:32s}  import failed: {heavy}')
+            passed = False
+            continue
+
+        ok = seconds <= budget * scale and not heavy
+        passed = passed and ok
+        print(f'{"ok  " if ok else "FAIL"}  {module:32s}  {seconds:6.3f} s  (budget {budget * scale:.2f} s)')
+        if heavy:
+            print(f'      imports {", ".join(heavy)}')
+
+    return passed
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Check the import time of the PocarChroma modules')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per module, the fastest is used')
+    parser.add_argument('--scale', type=float, default=1.0, help='factor applied to every budget')
+    parser.add_argument('modules', nargs='*', help='modules to check, all of them if none are given')
+    args = parser.parse_args(argv)
+
+    budgets = {module: IMPORT_BUDGETS.get(module, 1.0) for module in args.modules} if args.modules else None
+    return 0 if check_imports(budgets, args.repeat, args.scale) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
-from chroma.geometry import Material
+from chroma.geometry import Material, standard_wavelengths
 
+import os
 import pandas as pd
 import random
 
+from .spectral_tables import SPECTRAL_PROPERTIES, is_table, spectral_table, table_source
+
 class material_manager:
 	"""
     Manages materials by reading their properties from a CSV file and creating Material objects.
@@ -41,18 +44,25 @@ class material_manager:
         
         Args:
             curr_material (Material): The Material object to which attributes are added.
-            refractive_index (float): Refractive index of the material.
-            absorption_length (float): Absorption length of the material.
-            scattering_length (float): Scattering length of the material.
+            refractive_index (float or np.ndarray): Refractive index of the material.
+            absorption_length (float or np.ndarray): Absorption length of the material.
+            scattering_length (float or np.ndarray): Scattering length of the material.
             density (float): Density of the material.
+        
+        The optical properties may also be spectral tables of (wavelength, value) pairs (see spectral_tables),
+        which are shared with every other material using the same table rather than copied.
         """
 		#set the optical index grabbed from csv file for simulation
-		if refractive_index is not None:
-			curr_material.set('refractive_index', refractive_index) 
-		if absorption_length is not None:
-			curr_material.set('absorption_length', absorption_length) 
-		if scattering_length is not None:
-			curr_material.set('scattering_length', scattering_length)
+		optical_properties = {'refractive_index': refractive_index,
+							'absorption_length': absorption_length,
+							'scattering_length': scattering_length}
+		for name, value in optical_properties.items():
+			if value is None:
+				continue
+			if is_table(value):
+				setattr(curr_material, name, value)
+			else:
+				curr_material.set(name, value)
 		if density is not None:
 			curr_material.density = density
 
@@ -62,9 +72,12 @@ class material_manager:
 	def build_materials(self):
 		"""
         Reads material properties from a CSV file and creates Material objects.
+        Properties with an entry in a '<property>_table' column are wavelength dependent, see spectral_tables.
+        Their table, not the scalar column, is kept in material_props.
         """
 		# read in the csv file into dataframe
 		self.materials_df = pd.read_csv(self.material_data_path)
+		table_dir = os.path.dirname(os.path.abspath(self.material_data_path))
 
 		# iterate through all materials and create Material object, store into dictionary of materials
 		self.materials = {}
@@ -74,18 +87,53 @@ class material_manager:
 		for index, row in self.materials_df.iterrows():
 			curr_name = row['name'] #name of the material		
 			self.materials[curr_name] = Material(name = curr_name)	
+
+			# spectral tables replace the scalar value of their property
+			optical_properties = {}
+			for name in SPECTRAL_PROPERTIES:
+				source = table_source(row.get(name + '_table'))
+				if source is not None:
+					optical_properties[name] = spectral_table(source, standard_wavelengths, table_dir)
+				else:
+					optical_properties[name] = row[name]
+
 			self.add_attributes(self.materials[curr_name],
 								#refractive_index = r_i,
 								#refractive_index = row['refractive_index']+random.uniform(-row['abs(r_i_error)'],row['abs(r_i_error)']), # only used when no surface model is defined
-								refractive_index = row['refractive_index'],
-								absorption_length = row['absorption_length'],
-								scattering_length = row['scattering_length'],
+								refractive_index = optical_properties['refractive_index'],
+								absorption_length = optical_properties['absorption_length'],
+								scattering_length = optical_properties['scattering_length'],
 								density = row['density'])
 
-			self.material_props[curr_name] = dict(row)
+			self.material_props[curr_name] = {**dict(row), **optical_properties}
 
 
 
+	def set_property(self, material_name, property, value):
+		"""
+        Changes one property of a material, both in material_props and on the Material object.
+        Properties that only exist in the table (like eta and k, used to build surfaces) are only changed in material_props.
+        
+        Args:
+            material_name (str): The name of the material.
+            property (str): The name of the property, as in the material CSV.
+            value (float or np.ndarray): The new value, or a new spectral table.
+        
+        Raises:
+            ValueError: If a scalar would replace a spectral table.
+        """
+		material = self.get_material(material_name)
+		if is_table(self.material_props[material_name].get(property)) and not is_table(value):
+			raise ValueError(f'{property} of {material_name} is a spectral table and cannot be replaced by the scalar {value}')
+		self.material_props[material_name][property] = value
+
+		if property == 'density':
+			material.density = value
+		elif is_table(value):
+			setattr(material, property, value)
+		elif hasattr(material, property):
+			material.set(property, value)
+
 	def get_material(self, material_name):
 		"""
         Retrieves the Material object for a given material name from the created materials dictionary.
@@ -0,0 +1,170 @@
+'''
+Simplified (level of detail) versions of STL meshes, for plotting geometries without handing every triangle to matplotlib.
+
+Meshes are simplified by vertex clustering: vertices are snapped to a grid, every cell is replaced by the mean of its
+vertices, and triangles that collapse are dropped. The finest grid whose result fits the triangle budget
+is found by bisection. Levels are precomputed for budgets that are powers of two and cached on disk, keyed by the
+contents of the STL file, so plots only pay for the simplification once.
+'''
+import os
+
+import numpy as np
+
+from .cache import cache_dir, digest, file_digest
+
+
+# Smallest level kept, meshes are never simplified below this many triangles
+MIN_LEVEL_TRIANGLES = 16
+
+_levels = {}
+_triangle_counts = {}
+
+
+def load_vectors(stl_path):
+    '''
+    Returns the triangles of an STL file as an array of shape (n_triangles, 3, 3)
+    '''
+    from stl import mesh
+
+    return np.asarray(mesh.Mesh.from_file(stl_path).vectors)
+
+
+def triangle_count(stl_path):
+    '''
+    Returns the number of triangles in an STL file, from the header of binary files
+    '''
+    key = file_digest(stl_path)
+    if key not in _triangle_counts:
+        with open(stl_path, 'rb') as f:
+            header = f.read(84)
+        count = int(np.frombuffer(header[80:84], dtype='<u4')[0]) if len(header) == 84 else -1
+        # ascii files, and binary files whose size doesn't match the count, are counted by loading them
+        if count < 0 or os.path.getsize(stl_path) != 84 + 50 * count:
+            count = len(load_vectors(stl_path))
+        _triangle_counts[key] = count
+
+    return _triangle_counts[key]
+
+
+def cluster_vertices(vectors, resolution):
+    '''
+    Simplifies triangles by clustering their vertices on a grid with resolution cells along the longest side of the mesh.
+
+    :param vectors: Triangles, shape (n_triangles, 3, 3)
+    :type vectors: np.ndarray
+    :return: The simplified triangles
+    :rtype: np.ndarray
+    '''
+    points = vectors.reshape(-1, 3).astype(np.float64)
+    lower = points.min(axis=0)
+    cell = max(float((points.max(axis=0) - lower).max()) / resolution, 1e-12)
+
+    # one integer key per cell, which np.unique handles far faster than rows
+    grid = np.minimum(np.floor((points - lower) / cell).astype(np.int64), resolution)
+    keys = (grid[:, 0] * (resolution + 1) + grid[:, 1]) * (resolution + 1) + grid[:, 2]
+    _, cluster = np.unique(keys, return_inverse=True)
+    cluster = cluster.ravel()
+    n_clusters = int(cluster.max()) + 1
+
+    counts = np.bincount(cluster, minlength=n_clusters)
+    centers = np.stack([np.bincount(cluster, weights=points[:, axis], minlength=n_clusters) for axis in range(3)], axis=1)
+    centers /= counts[:, None]
+
+    corners = cluster.reshape(-1, 3)
+    # drop triangles whose corners share a cell, and duplicates of the same three cells
+    proper = (corners[:, 0] != corners[:, 1]) & (corners[:, 1] != corners[:, 2]) & (corners[:, 0] != corners[:, 2])
+    corners = corners[proper]
+    ordered = np.sort(corners, axis=1)
+    order = np.lexsort(ordered.T[::-1])
+    ordered = ordered[order]
+    first = np.r_[True, np.any(ordered[1:] != ordered[:-1], axis=1)]
+    corners = corners[np.sort(order[first])]
+
+    return centers[corners].astype(vectors.dtype)
+
+
+def simplify(vectors, max_triangles):
+    '''
+    Returns the most detailed vertex clustering of vectors with at most max_triangles triangles
+    '''
+    if len(vectors) <= max_triangles:
+        return vectors
+
+    best = None
+    low, high = 1, 1024
+    while low <= high:
+        resolution = (low + high) // 2
+        simplified = cluster_vertices(vectors, resolution)
+        if len(simplified) <= max_triangles:
+            best = simplified
+            low = resolution + 1
+        else:
+            high = resolution - 1
+
+    return best if best is not None else cluster_vertices(vectors, 1)
+
+
+def level_budget(max_triangles):
+    '''
+    Returns the triangle budget of the precomputed level used for max_triangles, the largest power of two not above it
+    '''
+    return max(MIN_LEVEL_TRIANGLES, 1 << int(np.floor(np.log2(max(max_triangles, 1)))))
+
+
+def lod_vectors(stl_path, max_triangles = None):
+    '''
+    Returns the triangles of an STL file simplified to at most max_triangles (rounded down to a precomputed level),
+    loaded from the cache when the level was computed before.
+
+    :param max_triangles: Triangle budget, None for the full mesh
+    :type max_triangles: int
+    :return: Triangles, shape (n_triangles, 3, 3). The array is shared with the cache, copy it before modifying it.
+    :rtype: np.ndarray
+    '''
+    if max_triangles is None or triangle_count(stl_path) <= max_triangles:
+        return load_vectors(stl_path)
+
+    budget = level_budget(max_triangles)
+    key = digest('mesh_lod', file_digest(stl_path), budget)
+    if key in _levels:
+        return _levels[key]
+
+    path = os.path.join(cache_dir('mesh_lod'), key + '.npy')
+    if os.path.exists(path):
+        vectors = np.load(path)
+    else:
+        vectors = simplify(load_vectors(stl_path), budget)
+        tmp_path = f'{path}.tmp{os.getpid()}.npy'
+        np.save(tmp_path, vectors)
+        os.replace(tmp_path, path)
+
+    vectors.flags.writeable = False
+    _levels[key] = vectors
+    return vectors
+
+
+def allocate_budget(stl_paths, max_triangles):
+    '''
+    Splits a triangle budget for one plot between meshes. Meshes smaller than their share keep all their triangles,
+    and what they leave is shared between the larger ones.
+
+    :return: The triangle budget of every mesh, None for meshes that are drawn in full
+    :rtype: list
+    '''
+    counts = np.array([triangle_count(path) for path in stl_paths])
+    if max_triangles is None or counts.sum() <= max_triangles:
+        return [None] * len(stl_paths)
+
+    budgets = [None] * len(stl_paths)
+    remaining = max_triangles
+    # hand out the budget from the smallest mesh up, each taking at most an equal share of what is left
+    order = np.argsort(counts, kind='stable')
+    for n, i in enumerate(order):
+        share = remaining // (len(order) - n)
+        if counts[i] <= share:
+            remaining -= counts[i]
+        else:
+            budgets[i] = max(share, MIN_LEVEL_TRIANGLES)
+            remaining -= min(share, counts[i])
+
+    return budgets
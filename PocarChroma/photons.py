@@ -1,18 +1,12 @@
-from chroma.sim import Simulation
 from chroma.event import Photons
 
 import numpy as np
 import math
-import h5py
-import matplotlib.pyplot as plt
-from mpl_toolkits import mplot3d
 import os
 from enum import Enum, IntEnum
 from typing import Optional
 
-from chroma import gpu
-import pycuda.tools
-from .analysis_manager import analysis_manager
+from . import profiling
 
 
 class Shape(Enum):
@@ -41,14 +35,24 @@ def photon_generator(
     source_r: Optional[float] = None,
     beam_azimuth: Optional[float] = None,
     beam_declination: Optional[float] = None,
-    cone_angle: Optional[float] = None
+    cone_angle: Optional[float] = None,
+    rng: Optional[np.random.Generator] = None,
+    start_photon: int = 0,
     ):
     '''
     Photon generator functions, return initial Chroma Photons object to be propagated.
+
+    The batch size can be changed between batches by sending the new size, generator.send(batch_size)
+    returns the next batch at that size (e.g. to shrink batches when memory runs low).
+
+    To checkpoint a run, pass in rng and save rng.bit_generator.state after each batch is yielded.
+    Resuming from a checkpoint with that state restored and start_photon set to the number of photons
+    already generated gives the same remaining batches as an uninterrupted run.
     '''
 
     # Initialize random number generator
-    rng = np.random.default_rng(seed=seed)
+    if rng is None:
+        rng = np.random.default_rng(seed=seed)
 
     # init some dicts for arguments
     position_args = {}
@@ -94,25 +98,29 @@ def photon_generator(
             direction_args['rng'] = rng
             direction_args['cone_angle'] = cone_angle
 
-    total_photons = 0
+    total_photons = start_photon
     while total_photons < max_photons:
         # Check if this next batch of photons will exceed the total number of photons requested
         n_photons = min(batch_size, max_photons - total_photons)
 
-        positions = position_function(
-            n_photons=n_photons,
-            source_location=source_location,
-            **position_args)
-        directions = direction_function(
-            n_photons=n_photons,
-            **direction_args)
+        with profiling.stage('generate'):
+            positions = position_function(
+                n_photons=n_photons,
+                source_location=source_location,
+                **position_args)
+            directions = direction_function(
+                n_photons=n_photons,
+                **direction_args)
 
-        polarizations = np.cross(directions, pg_isotropic_source(n_photons=n_photons, rng=rng))
-        wavelengths = np.ones(n_photons) * wavelength
+            polarizations = np.cross(directions, pg_isotropic_source(n_photons=n_photons, rng=rng))
+            wavelengths = np.ones(n_photons) * wavelength
 
-        photons = Photons(positions, directions, polarizations, wavelengths)
+            photons = Photons(positions, directions, polarizations, wavelengths)
+        profiling.count('photons_generated', n_photons)
         total_photons += n_photons
-        yield photons # after initialization, the generator stops here, waiting for the .send method to provide n_photons
+        requested = yield photons # after initialization, the generator stops here, waiting for the .send method to provide n_photons
+        if requested is not None:
+            batch_size = max(1, int(requested))
 
 
 ### PHOTON GENERATION SUB-FUNCTIONS
@@ -195,8 +203,18 @@ def propagate(
     # The following parameters are highly GPU dependant, change at your own risk
     n_threads = 64,
     max_blocks = 1024,
+    step_callback = None,
     ):
-    '''Propagates photons through geometry'''
+    '''Propagates photons through geometry
+
+    If given, step_callback(step, photons) is called with the initial photons (step 0) and after every step,
+    e.g. with a VertexRecorder to record tracks as the steps are made.
+    '''
+
+    # the GPU modules initialise CUDA, so they are only imported once something is propagated
+    from chroma.sim import Simulation
+    from chroma import gpu
+    import pycuda.tools
 
     # Get number of photons from Photons object
     n_photons = photons.pos.shape[0]
@@ -209,39 +227,47 @@ def propagate(
     if track_return_ct > n_photons:
         raise ValueError('More photon tracks requested than photons simulated!')
 
-    # start a simulation
-    # TODO what does this do?
-    sim = Simulation(geometry.global_geometry, seed=seed, geant4_processes=0)
+    with profiling.stage('upload'):
+        # start a simulation
+        # TODO what does this do?
+        sim = Simulation(geometry.global_geometry, seed=seed, geant4_processes=0)
 
-    # initialize GPU states
-    gpu_photons = gpu.GPUPhotons(photons)
-    gpu_geometry = gpu.GPUGeometry(geometry.global_geometry)
+        # initialize GPU states
+        gpu_photons = gpu.GPUPhotons(photons)
+        gpu_geometry = gpu.GPUGeometry(geometry.global_geometry)
 
-    rng_states = gpu.get_rng_states(n_threads * max_blocks, seed=seed)
+        rng_states = gpu.get_rng_states(n_threads * max_blocks, seed=seed)
 
     photon_steps = np.empty(num_steps + 1, dtype=Photons) # Record each step and the initial state
     photon_steps[0] = photons
+    if step_callback is not None:
+        step_callback(0, photons)
     for current_step in range(1, num_steps + 1):
-        gpu_photons.propagate(
-            gpu_geometry,
-            rng_states,
-            nthreads_per_block=n_threads,
-            max_blocks=max_blocks,
-            max_steps=1,
-        )
-
-        # Get the propagated chroma Photons object
-        photons = gpu_photons.get()
-
-        # This is reset non-terminal flags from run_manager
-        # 0b1111111111111111111000000001111
-        new_flags = photons.flags & 2147479567 # TODO why this number?
-        gpu_photons.flags[: n_photons].set(new_flags.astype(np.uint32))
+        with profiling.stage('step'):
+            gpu_photons.propagate(
+                gpu_geometry,
+                rng_states,
+                nthreads_per_block=n_threads,
+                max_blocks=max_blocks,
+                max_steps=1,
+            )
+
+        with profiling.stage('readback'):
+            # Get the propagated chroma Photons object
+            photons = gpu_photons.get()
+
+            # This is reset non-terminal flags from run_manager
+            # 0b1111111111111111111000000001111
+            new_flags = photons.flags & 2147479567 # TODO why this number?
+            gpu_photons.flags[: n_photons].set(new_flags.astype(np.uint32))
 
         photon_steps[current_step] = photons
+        if step_callback is not None:
+            step_callback(current_step, photons)
 
     # simulation done, clear GPU cache to save memory
     pycuda.tools.clear_context_caches()
+    profiling.count('photons_propagated', n_photons)
 
     return photon_steps
 
@@ -265,12 +291,9 @@ class Interaction(IntEnum):
     NAN_ABORT        = 0x1 << 31
 
 def triangles_from_name(geometry_manager, part_name):
-    # Find the index of the part_name in solids keys
-    part_idx = list(geometry_manager.solids.keys()).index(part_name)
-    # Get all triangle indices where solid_id equals part_idx
-    triangles = [i for i, val in enumerate(geometry_manager.global_geometry.solid_id)
-                   if val == part_idx]
-    return np.array(triangles)
+    # The triangles of each solid are contiguous in the flattened geometry, their range is in the solid metrics
+    metrics = geometry_manager.get_solid_metrics(part_name)
+    return np.arange(metrics['first_triangle'], metrics['first_triangle'] + metrics['n_triangles'])
 
 class Filter():
     def __init__(self, geometry_manager, interactions, parts=[]):
@@ -283,14 +306,59 @@ class Filter():
             self.triangles = np.concatenate(list_tri)
         self.interactions = int(interactions)
         self.batch_num = 0
+        self.photons_done = 0 # photons in the batches before, batches need not all be the same size
         self.res = set() # Resulting set of indices of photons which pass filter
 
     def update(self, photon_steps):
         "Update filter for each photon batch"
-        for step in photon_steps:
-            interacted = (step.flags & self.interactions) != 0
-            if self.parts:
-                collision = np.isin(step.last_hit_triangles, self.triangles)
-                interacted &= collision
-            self.res |= set(np.flatnonzero(interacted) + self.batch_num*len(step.pos))
+        with profiling.stage('filter'):
+            for step in photon_steps:
+                interacted = (step.flags & self.interactions) != 0
+                if self.parts:
+                    collision = np.isin(step.last_hit_triangles, self.triangles)
+                    interacted &= collision
+                self.res |= set(np.flatnonzero(interacted) + self.photons_done)
         self.batch_num += 1
+        self.photons_done += len(photon_steps[0].pos)
+
+
+class VertexRecorder():
+    def __init__(self, n_tracks):
+        """Record the interaction vertices of the first n_tracks photons of a batch, for the sparse vertex track format.
+        Pass update as the step_callback of propagate (or call it on each of its photon steps),
+        then get the vertex table with vertices() and write it with save_load_sim.vertices_write.
+        A vertex is the initial position of a photon, or any step after which it has moved."""
+        self.n_tracks = n_tracks
+        self.prev_pos = None
+        self.steps = []
+
+    def update(self, step, photons):
+        "Record the vertices made in one step"
+        pos = photons.pos[:self.n_tracks]
+        if self.prev_pos is None:
+            moved = np.ones(len(pos), dtype=bool)
+        else:
+            moved = np.any(pos != self.prev_pos, axis=1)
+        idx = np.flatnonzero(moved)
+        self.steps.append((
+            idx,
+            np.full(len(idx), step, dtype=np.uint16),
+            pos[idx].astype(np.float32),
+            photons.flags[:self.n_tracks][idx].astype(np.uint32),
+            photons.last_hit_triangles[:self.n_tracks][idx].astype(np.int32),
+        ))
+        self.prev_pos = pos.copy()
+
+    __call__ = update
+
+    def vertices(self):
+        "Returns the vertices grouped by photon (in step order), and the number of vertices of every photon"
+        photon, step, pos, flags, last_hit_triangles = (np.concatenate(column) for column in zip(*self.steps))
+        order = np.argsort(photon, kind='stable') # steps were recorded in order, so keep it within each photon
+        return {
+            'counts': np.bincount(photon, minlength=len(self.prev_pos)),
+            'step': step[order],
+            'pos': pos[order],
+            'flags': flags[order],
+            'last_hit_triangles': last_hit_triangles[order],
+        }
@@ -1,23 +1,17 @@
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-from mpl_toolkits.mplot3d.art3d import Poly3DCollection
-
-# mpl.use("Agg")
-from stl import mesh
-from matplotlib import colors
-from mpl_toolkits import mplot3d
-from array import array
-import time
-import os
 import itertools
 
+from .mesh_lod import allocate_budget, lod_vectors
+
+# matplotlib and numpy-stl are imported by the functions that use them, so importing this module stays cheap
+
 
 def plot_geometry(
     geometry_df,
     axes,
+    max_triangles=50_000,
 ):
     '''
     plots geometry.
@@ -25,7 +19,11 @@ def plot_geometry(
     :type geometry_df: Dataframe
     :param axes: an mpl 3d axes object (optional)
     :type axes: Axes
+    :param max_triangles: triangle budget for the whole plot, meshes are drawn simplified (see mesh_lod) to fit it.
+        None draws every triangle
+    :type max_triangles: int
     '''
+    from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
     # Get columns from geometry dataframe
     part_name = geometry_df['name']
@@ -34,6 +32,7 @@ def plot_geometry(
     x_displacement = geometry_df["displacement x"]
     y_displacement = geometry_df["displacement y"]
     z_displacement = geometry_df["displacement z"]
+    budgets = allocate_budget(list(stl_names), max_triangles)
 
     # iterate through rows
     for (
@@ -43,23 +42,23 @@ def plot_geometry(
         current_x_displacement,
         current_y_displacement,
         current_z_displacement,
-    ) in zip(part_name, stl_names, colors, x_displacement, y_displacement, z_displacement):
+        curr_budget,
+    ) in zip(part_name, stl_names, colors, x_displacement, y_displacement, z_displacement, budgets):
 
-        m = mesh.Mesh.from_file(curr_filename)
-        m.translate([
+        vectors = lod_vectors(curr_filename, curr_budget) + [
             current_x_displacement,
             current_y_displacement,
             current_z_displacement
-        ])
+        ]
 
-        poly3d = Poly3DCollection(m.vectors)
+        poly3d = Poly3DCollection(vectors)
         poly3d.set_alpha(0.1)
         poly3d.set_edgecolor(None)
         poly3d.set_facecolor(curr_color)
         axes.add_collection3d(poly3d)
 
 
-    scale = m.points.flatten()
+    scale = vectors.flatten()
 
     axes.auto_scale_xyz(scale, scale, scale)
     axes.set_xlabel("x position (mm)")
@@ -75,10 +74,18 @@ def plot_tracks(
     color = 'black',
     linewidth = 1
 ):
-    # Format photon steps into tracks which can be plotted
-    tracks = np.zeros((len(photon_steps), len(photon_steps[0].pos), 3))
-    for step in range(len(photon_steps)):
-        tracks[step, :, :] = photon_steps[step].pos
+    '''
+    plots photon tracks.
+    :param photon_steps: the photon steps returned by propagate, or a tracks array of shape (steps + 1, photons, 3)
+        such as the memory mapped array from save_load_sim.tracks_memmap, which is sliced without copying
+    '''
+    if isinstance(photon_steps, np.ndarray) and photon_steps.dtype != object:
+        tracks = photon_steps
+    else:
+        # Format photon steps into tracks which can be plotted
+        tracks = np.zeros((len(photon_steps), len(photon_steps[0].pos), 3))
+        for step in range(len(photon_steps)):
+            tracks[step, :, :] = photon_steps[step].pos
 
     if photon_filter is None:
         photon_filter = set(range(num_tracks))
@@ -95,13 +102,15 @@ def plot_tracks(
 
 
 def plot_chroma(geometry=None, tracks=None, photon_filters=None,
-                tracks_colors='black', tracks_num=1000, tracks_linewidth=1):
+                tracks_colors='black', tracks_num=1000, tracks_linewidth=1, max_triangles=50_000):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     axes = fig.add_subplot(111, projection='3d')
     plt.tight_layout()
     axes.view_init(elev=90, azim=-90) # Default view centered on XY plane
     if geometry is not None:
-        plot_geometry(geometry, axes)
+        plot_geometry(geometry, axes, max_triangles)
     if type(photon_filters) is list:
         if type(tracks_colors) is not list:
             raise ValueError("Need photon filter and tracks colors to both be lists")
@@ -0,0 +1,247 @@
+'''
+Lightweight instrumentation of the simulation: nested stage timers, counters and peak memory, with a JSON report per run.
+
+Code marks its stages with
+
+    with profiling.stage('propagate'):
+        ...
+
+and counts things with profiling.count('photons', n). Stages opened inside other stages (in the same thread) are
+reported under their parent's path, e.g. 'geometry/bvh'. While profiling is disabled, which is the default,
+stage returns a shared no-op context manager and count returns immediately, so instrumented code costs one function call.
+
+Profiling is enabled with enable() (or main.py --profile) and the report is written by disable(). Stages named in
+enable(cprofile=...) are also run under cProfile, their stats are dumped next to the report for pstats or snakeviz.
+'''
+import os
+import json
+import time
+import cProfile
+import threading
+from contextlib import nullcontext
+
+
+_active = None
+_null_stage = nullcontext()
+
+
+def _rss_bytes():
+    '''
+    Returns the current resident set size of the process in bytes, 0 if it can't be read
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+class _stage:
+    '''
+    Context manager timing one stage, made by profiler.stage
+    '''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        stack = profiler._stack()
+        self.path = '/'.join(stack + [self.name])
+        stack.append(self.name)
+
+        self.peak = _rss_bytes()
+        with profiler._lock:
+            profiler._open.add(self)
+        self.profile = None
+        if self.name in profiler.cprofile_stages or self.path in profiler.cprofile_stages:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # another profiler is already running in this thread, e.g. an enclosing cProfiled stage
+                self.profile = None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+
+        profiler = self.profiler
+        profiler._stack().pop()
+        peak = max(self.peak, _rss_bytes())
+        with profiler._lock:
+            profiler._open.discard(self)
+            record = profiler.stages.setdefault(self.path, {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0})
+            record['calls'] += 1
+            record['seconds'] += seconds
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], peak / 2**20)
+            profiler.peak_rss = max(profiler.peak_rss, peak)
+            if self.profile is not None:
+                if self.path in profiler.profiles:
+                    profiler.profiles[self.path].add(self.profile)
+                else:
+                    import pstats
+                    profiler.profiles[self.path] = pstats.Stats(self.profile)
+        return False
+
+
+class profiler:
+    '''
+    Collects the stage timings, counters and memory samples of a run, see the module description.
+
+    :param report_path: Path of the JSON report written by stop, None to not write one
+    :type report_path: str
+    :param cprofile: Names (or paths) of stages to run under cProfile
+    :type cprofile: list
+    :param memory_interval: Seconds between samples of the resident memory, which track the peak of every open stage
+    :type memory_interval: float
+    '''
+
+    def __init__(self, report_path = None, cprofile = (), memory_interval = 0.05):
+        self.report_path = report_path
+        self.cprofile_stages = set(cprofile)
+        self.memory_interval = memory_interval
+
+        self.stages = {}
+        self.counters = {}
+        self.profiles = {}
+        self.peak_rss = _rss_bytes()
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = set()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _sample_memory(self):
+        while not self._stop.wait(self.memory_interval):
+            rss = _rss_bytes()
+            with self._lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                for open_stage in self._open:
+                    open_stage.peak = max(open_stage.peak, rss)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_memory, name='memory_sampler', daemon=True)
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops sampling memory and writes the report (and the cProfile stats) if a report path was given
+        '''
+        self.wall_seconds = time.perf_counter() - self.start_time
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self.report_path is not None:
+            self.write_report(self.report_path)
+
+    def stage(self, name):
+        return _stage(self, name)
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        '''
+        Returns the report as a dict: the wall time, the peak memory, and the calls, total seconds and
+        peak memory of every stage (by path, in order), and the counters
+        '''
+        wall_seconds = getattr(self, 'wall_seconds', time.perf_counter() - self.start_time)
+        with self._lock:
+            return {
+                'wall_seconds': wall_seconds,
+                'peak_rss_mb': self.peak_rss / 2**20,
+                'stages': {path: dict(record) for path, record in sorted(self.stages.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def write_report(self, report_path):
+        '''
+        Writes the report as JSON, and the stats of every cProfiled stage to <report_path without .json>.<stage>.prof
+        '''
+        report = self.report()
+        save_dir = os.path.dirname(os.path.abspath(report_path))
+        os.makedirs(save_dir, exist_ok=True)
+
+        base = report_path[:-len('.json')] if report_path.endswith('.json') else report_path
+        report['cprofile'] = {}
+        for path, stats in self.profiles.items():
+            prof_path = f'{base}.{path.replace("/", ".")}.prof'
+            stats.dump_stats(prof_path)
+            report['cprofile'][path] = prof_path
+
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Profile report written to {report_path}')
+
+    def print_summary(self):
+        '''
+        Prints the stage timings as an indented tree
+        '''
+        report = self.report()
+        print(f'Wall time {report["wall_seconds"]:.2f} s, peak memory {report["peak_rss_mb"]:.0f} MB')
+        for path, record in report['stages'].items():
+            depth = path.count('/')
+            name = path.rsplit('/', 1)[-1]
+            print(f'{"  " * depth}{name:<{max(1, 32 - 2 * depth)}} {record["seconds"]:9.3f} s  {record["calls"]:7d} calls  '
+                  f'{record["peak_rss_mb"]:8.0f} MB')
+        for name, value in report['counters'].items():
+            print(f'{name:<32} {value}')
+
+
+def enable(report_path = None, cprofile = (), memory_interval = 0.05):
+    '''
+    Starts profiling the process, see profiler for the arguments. Returns the profiler.
+    '''
+    global _active
+    if _active is not None:
+        _active.stop()
+    _active = profiler(report_path, cprofile, memory_interval).start()
+    return _active
+
+
+def disable():
+    '''
+    Stops profiling, writing the report, and returns the profiler (None if profiling was not enabled)
+    '''
+    global _active
+    active, _active = _active, None
+    if active is not None:
+        active.stop()
+    return active
+
+
+def enabled():
+    return _active is not None
+
+
+def stage(name):
+    '''
+    Returns a context manager timing a stage, a no-op while profiling is disabled
+    '''
+    if _active is None:
+        return _null_stage
+    return _active.stage(name)
+
+
+def count(name, n = 1):
+    '''
+    Adds n to a counter, a no-op while profiling is disabled
+    '''
+    if _active is not None:
+        _active.count(name, n)
@@ -0,0 +1,250 @@
+import os
+import glob
+import json
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from . import save_load_sim
+
+
+def _to_json(value):
+    '''
+    Converts HDF5 attribute values (numpy scalars, arrays and bytes) into something json can store
+    '''
+    if isinstance(value, np.ndarray):
+        return [_to_json(v) for v in value.tolist()]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+def index_file(file_path):
+    '''
+    Reads the header information of a results file made by save_load_sim.make_HDF5_file.
+    Only attributes and dataset shapes are read, never the datasets themselves.
+    :return: A dict with the root attributes, row counts and summary tallies of the file
+    :rtype: dict
+    '''
+    stat = os.stat(file_path)
+    entry = {
+        'path': os.path.abspath(file_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+    }
+
+    with h5py.File(file_path, 'r') as f:
+        entry['attributes'] = {key: _to_json(value) for key, value in f.attrs.items()}
+
+        hist_ds = f['particle_history']
+        entry['hist_rows'] = hist_ds.shape[0]
+        entry['rows_written'] = int(hist_ds.attrs.get('next_writable', hist_ds.shape[0]))
+
+        tracks_ds = f['tracks']
+        entry['n_tracks'] = save_load_sim._tracks_shape(tracks_ds)[1]
+        entry['tracks_written'] = int(tracks_ds.attrs.get('next_writable', entry['n_tracks']))
+
+        # summary tallies kept by particle_histories_write, and the at-least-once counts from the index lengths
+        entry['totals'] = {}
+        entry['nonzero'] = {}
+        if 'column_totals' in hist_ds.attrs:
+            entry['totals'] = dict(zip(_to_json(hist_ds.attrs['columns']), _to_json(hist_ds.attrs['column_totals'])))
+        if 'index' in f:
+            entry['nonzero'] = {name: ds.shape[0] for name, ds in f['index'].items()}
+
+    return entry
+
+
+def reduce_sum(a, b):
+    '''
+    Default reducer for map_reduce, adds numbers and arrays, and dicts of those key by key
+    '''
+    if isinstance(a, dict):
+        return {key: reduce_sum(a[key], b[key]) if key in a and key in b else a.get(key, b.get(key))
+                for key in {**a, **b}}
+    return a + b
+
+
+### PER-FILE FUNCTIONS
+
+# These are functions that can be passed to result_catalog.map_reduce.
+# They take the file path as the first argument and must be defined at module level so they can be sent to worker processes.
+
+def count_selected(file_path, selection_criteria, invert_selection=False):
+    '''
+    Counts the tracks in a file passing selection_criteria, see save_load_sim.select_tracks
+    '''
+    inds = save_load_sim.select_tracks(file_path, selection_criteria, invert_selection, return_type='indices')
+    return len(inds[0])
+
+
+def tally(file_path):
+    '''
+    Returns a dict with the number of photons and the total of every particle_history column
+    '''
+    histories = save_load_sim.particle_histories_read(file_path)
+    totals = {name: int(np.sum(histories[name], dtype=np.int64)) for name in histories.dtype.names}
+    totals['NUM_PARTICLES'] = len(histories)
+    return totals
+
+
+def histogram(file_path, column, bins):
+    '''
+    Histograms a particle_history column of a file, bins has to be an array of edges so results from different files line up
+    '''
+    histories = save_load_sim.particle_histories_read(file_path)
+    hist, _ = np.histogram(histories[column], bins=bins)
+    return hist
+
+
+class _per_file_call:
+    '''
+    Picklable stand-in for lambda path: func(path, *args, **kwargs), used to send per-file calls to worker processes
+    '''
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, path):
+        return self.func(path, *self.args, **self.kwargs)
+
+
+class result_catalog:
+    '''
+    Local catalog of the HDF5 results files of a campaign.
+
+    The catalog stores, for every file, the root attributes, row counts and summary tallies read from the file header,
+    and is saved as json next to the results so it only has to re-index files that changed.
+    map_reduce runs a per-file function over a process pool and reduces the results.
+
+    :param catalog_path: Path to the json file the catalog is saved in
+    :type catalog_path: str
+    '''
+
+    def __init__(self, catalog_path):
+        self.catalog_path = catalog_path
+        self.entries = {}
+
+        if os.path.exists(catalog_path):
+            with open(catalog_path, 'r') as f:
+                self.entries = {entry['path']: entry for entry in json.load(f)}
+
+    def add(self, paths):
+        '''
+        Indexes the given files, skipping files that have not changed since they were last indexed.
+
+        :param paths: A path or list of paths to results files
+        :type paths: str or list
+        :return: The number of files that were (re)indexed
+        :rtype: int
+        '''
+        if isinstance(paths, str):
+            paths = [paths]
+
+        n_indexed = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            old_entry = self.entries.get(path)
+            if old_entry is not None and old_entry['mtime_ns'] == stat.st_mtime_ns and old_entry['size'] == stat.st_size:
+                continue
+            try:
+                self.entries[path] = index_file(path)
+                n_indexed += 1
+            except (OSError, KeyError) as err:
+                print(f'Could not index {path}: {err}')
+
+        return n_indexed
+
+    def scan(self, directory, pattern='**/*.hdf5'):
+        '''
+        Indexes every file in directory matching the glob pattern, and drops entries of files that no longer exist.
+
+        :return: The number of files that were (re)indexed
+        :rtype: int
+        '''
+        self.entries = {path: entry for path, entry in self.entries.items() if os.path.exists(path)}
+        return self.add(sorted(glob.glob(os.path.join(directory, pattern), recursive=True)))
+
+    def save(self):
+        '''
+        Writes the catalog to catalog_path
+        '''
+        save_dir = os.path.dirname(os.path.abspath(self.catalog_path))
+        os.makedirs(save_dir, exist_ok=True)
+
+        # write to a temporary file first so an interrupted save never leaves a broken catalog behind
+        tmp_path = self.catalog_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self.entries.values()), f, indent=1)
+        os.replace(tmp_path, self.catalog_path)
+
+    def to_df(self):
+        '''
+        Returns the catalog as a dataframe with one row per file.
+        Attributes are columns as they are named in the file, totals and at-least-once counts are prefixed with total_ and nonzero_.
+        '''
+        rows = []
+        for entry in self.entries.values():
+            row = {key: entry[key] for key in ('path', 'hist_rows', 'rows_written', 'n_tracks', 'tracks_written')}
+            row.update(entry['attributes'])
+            row.update({f'total_{key}': value for key, value in entry['totals'].items()})
+            row.update({f'nonzero_{key}': value for key, value in entry['nonzero'].items()})
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def select(self, where=None):
+        '''
+        Returns the paths of the files matching where.
+
+        :param where: None for all files, a pandas query string evaluated on to_df(), or a function taking to_df() and returning a boolean mask
+        :type where: str or function
+        :rtype: list
+        '''
+        df = self.to_df()
+        if df.empty:
+            return []
+        elif where is None:
+            return df['path'].tolist()
+        elif callable(where):
+            return df[where(df)]['path'].tolist()
+        elif isinstance(where, str):
+            return df.query(where)['path'].tolist()
+        else:
+            raise ValueError('where must be a function or a query string')
+
+    def map_reduce(self, func, *args, where=None, reduce=reduce_sum, processes=None, **kwargs):
+        '''
+        Runs func(path, *args, **kwargs) on every selected file over a process pool and reduces the results.
+
+        :param func: A module level function taking a file path as the first argument, e.g. count_selected, tally or histogram
+        :type func: function
+        :param where: Which files to run over, see select
+        :param reduce: A function combining two results, or None to get a dict of the result per path
+        :type reduce: function
+        :param processes: Number of worker processes, None to use all cores, 1 to run in this process
+        :type processes: int
+        '''
+        paths = self.select(where)
+        per_file = _per_file_call(func, args, kwargs)
+
+        if processes == 1:
+            results = [per_file(path) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(per_file, paths))
+
+        if reduce is None:
+            return dict(zip(paths, results))
+        if not results:
+            return None
+        return functools.reduce(reduce, results)
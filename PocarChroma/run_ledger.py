@@ -0,0 +1,173 @@
+import os
+import time
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+
+def _quote(name):
+    '''
+    Quotes a column name for use in SQL
+    '''
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _to_sql_value(value):
+    '''
+    sqlite3 can only store python scalars, so convert numpy scalars and NaNs
+    '''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+class run_ledger:
+    '''
+    Append-only store of run summaries backed by sqlite, replacing save_load_sim.csv_append_rows for logging runs.
+
+    Every append is a single insert, independent of how many runs were logged before, and the database is used
+    in WAL mode so many jobs can append to (and read from) the same ledger at once.
+    Columns are added the first time a run uses them. seed, experiment and config_hash are indexed for fast filtered reads.
+
+    :param db_path: Path to the sqlite database, created if it does not exist
+    :type db_path: str
+    :param timeout: Seconds to wait for another writer to release the database before giving up
+    :type timeout: float
+    '''
+
+    TABLE = 'runs'
+    INDEXED_COLUMNS = ('seed', 'experiment', 'config_hash')
+
+    def __init__(self, db_path, timeout = 60.0):
+        self.db_path = db_path
+        self.timeout = timeout
+
+        save_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(save_dir, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.TABLE} ('
+                'run_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'recorded_at REAL, '
+                + ', '.join(_quote(name) for name in self.INDEXED_COLUMNS)
+                + ')'
+            )
+            for name in self.INDEXED_COLUMNS:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_{name} ON {self.TABLE} ({_quote(name)})')
+
+    def _connect(self):
+        # autocommit mode, transactions are opened explicitly where they are needed
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return closing(conn)
+
+    def columns(self):
+        '''
+        Returns the names of the columns in the ledger
+        '''
+        with self._connect() as conn:
+            return [row[1] for row in conn.execute(f'PRAGMA table_info({self.TABLE})')]
+
+    def append(self, data):
+        '''
+        Appends one or more runs to the ledger.
+
+        :param data: A dict of column values for one run, a dict of equal length lists, or a dataframe with one row per run
+        :type data: dict or pd.DataFrame
+        '''
+        if isinstance(data, dict):
+            if all(np.ndim(value) == 0 for value in data.values()):
+                data = {key: [value] for key, value in data.items()}
+            data = pd.DataFrame(data)
+
+        columns = [str(name) for name in data.columns]
+        if not columns or data.empty:
+            return
+
+        recorded_at = time.time()
+        rows = [
+            [recorded_at] + [_to_sql_value(value) for value in row]
+            for row in data.itertuples(index=False, name=None)
+        ]
+
+        with self._connect() as conn:
+            # take the write lock first so adding columns and inserting can't interleave with other writers
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                existing = {row[1] for row in conn.execute(f'PRAGMA table_info({self.TABLE})')}
+                for name in columns:
+                    if name not in existing:
+                        conn.execute(f'ALTER TABLE {self.TABLE} ADD COLUMN {_quote(name)}')
+
+                conn.executemany(
+                    f'INSERT INTO {self.TABLE} (recorded_at, {", ".join(_quote(name) for name in columns)}) '
+                    f'VALUES ({", ".join("?" * (len(columns) + 1))})',
+                    rows,
+                )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def read(self, where = None, params = (), columns = None, **filters):
+        '''
+        Reads runs from the ledger into a dataframe.
+
+        Keyword filters select on column equality, or membership if given a list, e.g. read(experiment='sipm', seed=[1, 2]).
+        Anything more complicated can be given as an SQL where clause with ? placeholders filled from params.
+
+        :param where: SQL condition, e.g. 'efficiency > ?'
+        :type where: str
+        :param columns: Columns to read, all columns if None
+        :type columns: list
+        :rtype: pd.DataFrame
+        '''
+        conditions = []
+        values = []
+        for name, value in filters.items():
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                value = list(value)
+                conditions.append(f'{_quote(name)} IN ({", ".join("?" * len(value))})')
+                values.extend(_to_sql_value(v) for v in value)
+            else:
+                conditions.append(f'{_quote(name)} = ?')
+                values.append(_to_sql_value(value))
+        if where is not None:
+            conditions.append(f'({where})')
+            values.extend(params)
+
+        selected = '*' if columns is None else ', '.join(_quote(name) for name in columns)
+        query = f'SELECT {selected} FROM {self.TABLE}'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY run_id'
+
+        with self._connect() as conn:
+            return pd.read_sql_query(query, conn, params=values)
+
+    def contains(self, **filters):
+        '''
+        Returns True if any run matches the keyword filters, see read
+        '''
+        return not self.read(columns=['run_id'], **filters).empty
+
+    def to_csv(self, csv_path, **filters):
+        '''
+        Exports the (filtered) ledger to a CSV file, in the format written by save_load_sim.csv_append_rows
+        '''
+        df = self.read(**filters).drop(columns=['run_id', 'recorded_at'])
+        df.to_csv(csv_path, index=False)
+        print(f'Exported {len(df)} runs to {csv_path}')
+
+    def import_csv(self, csv_path):
+        '''
+        Appends every row of a CSV file (e.g. one made by save_load_sim.csv_append_rows) to the ledger
+        '''
+        self.append(pd.read_csv(csv_path))
+
@@ -0,0 +1,474 @@
+import os
+import time
+import queue
+import threading
+
+import numpy as np
+from chroma.event import Photons
+
+from .photons import photon_generator, propagate, Interaction, VertexRecorder
+from .save_load_sim import make_HDF5_file, particle_histories_write, tracks_write, vertices_write, tracks_read
+from .checkpoint import run_checkpoint
+from .batch_sizing import batch_size_for, adapt_batch_size
+from .analysis_manager import analysis_manager
+from . import profiling
+
+
+# Interactions that end a photon, tallied from the flags of its last step
+FINAL_INTERACTIONS = (
+    Interaction.NO_HIT,
+    Interaction.BULK_ABSORB,
+    Interaction.SURFACE_DETECT,
+    Interaction.SURFACE_ABSORB,
+)
+
+# Interactions that propagate resets after every step, counted over the steps
+STEP_INTERACTIONS = (
+    Interaction.RAYLEIGH_SCATTER,
+    Interaction.REFLECT_DIFFUSE,
+    Interaction.REFLECT_SPECULAR,
+    Interaction.SURFACE_REEMIT,
+    Interaction.SURFACE_TRANSMIT,
+    Interaction.BULK_REEMIT,
+    Interaction.CHERENKOV,
+    Interaction.SCINTILLATION,
+)
+
+# Number of batches that may wait between two stages of the pipeline
+QUEUE_SIZE = 2
+
+
+def experiment_paths(experiment_name, data_dir = '/workspace/data_files/data'):
+    '''
+    Returns the paths of the geometry, material and surface tables of an experiment
+    '''
+    experiment_dir = os.path.join(data_dir, experiment_name)
+    return (
+        os.path.join(experiment_dir, f'geometry_components_{experiment_name}.csv'),
+        os.path.join(experiment_dir, f'bulk_materials_{experiment_name}.csv'),
+        os.path.join(experiment_dir, f'surface_props_{experiment_name}.csv'),
+    )
+
+
+def history_columns():
+    '''
+    Returns the particle_history columns written by run_manager, for make_HDF5_file:
+    final interactions are booleans, step interactions are counts
+    '''
+    columns = {interaction.name: np.bool_ for interaction in FINAL_INTERACTIONS}
+    columns.update({interaction.name: np.uint16 for interaction in STEP_INTERACTIONS})
+    return columns
+
+
+def batch_histories(photon_steps):
+    '''
+    Returns the particle histories of a propagated batch: for every photon, whether it ended in each of
+    FINAL_INTERACTIONS, and in how many steps it underwent each of STEP_INTERACTIONS
+    '''
+    final_flags = photon_steps[-1].flags
+    histories = {interaction.name: (final_flags & interaction) != 0 for interaction in FINAL_INTERACTIONS}
+    for interaction in STEP_INTERACTIONS:
+        counts = np.zeros(len(final_flags), dtype=np.uint16)
+        for step in photon_steps[1:]:
+            counts += (step.flags & interaction) != 0
+        histories[interaction.name] = counts
+    return histories
+
+
+def batch_seed(seed, batch):
+    '''
+    Returns the seed of the propagation of a batch: the batch's child of the run seed's SeedSequence (as spawned by
+    SeedSequence(seed).spawn), so no two batches of runs with different seeds share a random stream
+    '''
+    return int(np.random.SeedSequence(seed, spawn_key=(batch,)).generate_state(1)[0])
+
+
+def _put(q, item, stop):
+    '''
+    Puts item on a bounded queue, giving up if stop is set while waiting. Returns whether the item was put.
+    '''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class run_manager:
+    '''
+    Runs a simulation as a pipeline of photon batches: generating photons with photon_generator, propagating them
+    through the geometry, and tallying and writing their histories and tracks.
+
+    Generation and writing run in background threads connected to the propagation by bounded queues, so while batch N
+    is propagated on the GPU (in the calling thread, which owns the CUDA context), batch N+1 is generated and
+    batch N-1 is tallied, filtered and written. The queues hold at most QUEUE_SIZE batches, which bounds memory.
+    Throughput is reported after every batch and at the end, with the time every stage spent busy.
+
+    Without a batch_size, batches are as large as fit in memory_budget (or the memory available), see batch_sizing.
+    With adapt_batches, the batch size is halved whenever the memory available runs low during the run, rather than
+    running out of memory.
+
+    When output_path is given, results are written to that HDF5 file, with a checkpoint after every checkpoint_every batches
+    and whenever adapt_batches changes the batch size. The checkpoint holds the batch size the run continues with, so
+    with resume, a pre-empted run continues from its last checkpoint with the same batches (whatever the memory budget)
+    and writes what an uninterrupted run would have.
+    Analysis (ana_man) then only covers the batches propagated since resuming.
+
+    For analysis, the last step and the histories of every photon are kept in memory for the whole run, which the
+    batch size is budgeted for. Runs too large for that write their results to output_path with keep_photons=False,
+    which keeps only the tracks and the totals, and makes no analysis (ana_man is None).
+
+    :param geometry_manager: The geometry to propagate through
+    :type geometry_manager: geometry_manager
+    :param experiment_name: Name of the experiment
+    :type experiment_name: str
+    :param random_seed: Seed of the photon generator, the propagation of batch i uses batch_seed(random_seed, i)
+    :type random_seed: int
+    :param num_particles: Number of photons to simulate
+    :type num_particles: int
+    :param plots: Plots to make, see analysis_manager
+    :type plots: list
+    :param batch_size: Photons per batch, None to pick it from memory_budget. Ignored when resuming a checkpoint.
+    :type batch_size: int
+    :param memory_budget: Bytes of host memory the run may use, None for the memory available
+    :type memory_budget: int
+    :param adapt_batches: Shrink batches when memory runs low during the run
+    :type adapt_batches: bool
+    :param output_path: Path of the HDF5 results file, None to not write results
+    :type output_path: str
+    :param keep_photons: Keep the last step and histories of every photon in memory for analysis, needs output_path if False
+    :type keep_photons: bool
+    :param resume: Continue from the checkpoint of output_path if there is one
+    :type resume: bool
+    :param num_steps: Propagation steps per batch
+    :type num_steps: int
+    :param num_tracks: Number of photon tracks to keep (the first photons of the run)
+    :type num_tracks: int
+    :param tracks_layout: Layout of the tracks in the results file, see save_load_sim.make_HDF5_file. With 'vertex',
+        the vertices of the tracked photons are recorded during propagation (photons.VertexRecorder) and written with
+        their interaction flags, and the tracks kept for analysis are read back from the file at the end.
+    :type tracks_layout: str
+    :param generator_args: Keyword arguments of photon_generator, e.g. the source shape and location
+    :type generator_args: dict
+    :param filters: photons.Filter objects, updated with every batch
+    :type filters: list
+    :param checkpoint_every: Write a checkpoint every this many batches
+    :type checkpoint_every: int
+    '''
+
+    def __init__(self,
+                 geometry_manager,
+                 experiment_name,
+                 random_seed,
+                 num_particles,
+                 plots = [],
+                 batch_size = None,
+                 memory_budget = None,
+                 adapt_batches = True,
+                 output_path = None,
+                 keep_photons = True,
+                 resume = False,
+                 num_steps = 15,
+                 num_tracks = 1000,
+                 tracks_layout = 'chunked',
+                 generator_args = None,
+                 filters = None,
+                 checkpoint_every = 1,
+                 ):
+        self.gm = geometry_manager
+        self.experiment_name = experiment_name
+        self.seed = random_seed
+        self.num_particles = num_particles
+        self.plots = plots
+        self.output_path = output_path
+        if not keep_photons and output_path is None:
+            raise ValueError('keep_photons=False needs an output_path, the results would be lost otherwise')
+        self.keep_photons = keep_photons
+        self.num_steps = num_steps
+        self.num_tracks = min(num_tracks, num_particles)
+        self.adapt_batches = adapt_batches
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.tracks_layout = tracks_layout
+        self.record_vertices = tracks_layout == 'vertex' and output_path is not None
+        self.generator_args = {} if generator_args is None else generator_args
+        self.filters = [] if filters is None else filters
+        self.checkpoint = run_checkpoint(output_path, random_seed, every=checkpoint_every) if output_path else None
+
+        self.run(resume=resume)
+        self.ana_man = None
+        if not self.keep_photons:
+            return
+        with profiling.stage('analysis'):
+            self.ana_man = analysis_manager(
+                self.gm,
+                self.experiment_name,
+                self.plots,
+                self.photons,
+                self.tracks,
+                seed=self.seed,
+                histories=self.histories,
+            )
+
+    def setup_output(self, resume):
+        '''
+        Starts the run: picks the batch size, creates the results file (unless resuming it) and returns the checkpoint
+        state to continue from. A resumed run continues with the batch size of its checkpoint.
+        '''
+        if self.checkpoint is None:
+            state = {'rng': np.random.default_rng(seed=self.seed), 'photons_done': 0, 'batches_done': 0, 'tallies': {},
+                     'batch_size': None, 'resumed': False}
+        else:
+            state = self.checkpoint.start(resume=resume)
+
+        if state['batch_size'] is not None:
+            if self.batch_size is not None and self.batch_size != state['batch_size']:
+                print(f'WARNING: Ignoring batch size {self.batch_size}, the resumed run continues with {state["batch_size"]}')
+            self.batch_size = state['batch_size']
+        elif self.batch_size is None:
+            self.batch_size = batch_size_for(self.num_particles, self.num_steps, self.num_tracks, self.memory_budget, QUEUE_SIZE,
+                                             keep_photons=self.keep_photons)
+            print(f'Batch size {self.batch_size} picked from the memory budget')
+
+        if self.checkpoint is not None and not state['resumed']:
+            bounds = None
+            if self.tracks_layout == 'delta':
+                vertices = self.gm.global_geometry.mesh.vertices
+                bounds = (vertices.min(axis=0) - 1.0, vertices.max(axis=0) + 1.0)
+            make_HDF5_file(
+                self.output_path,
+                {'experiment': self.experiment_name, 'seed': self.seed, 'num_particles': self.num_particles,
+                 'batch_size': self.batch_size, 'num_steps': self.num_steps},
+                tracks_shape=(self.num_steps + 1, self.num_tracks, 3),
+                hist_rows=self.num_particles,
+                hist_columns=history_columns(),
+                max_count=self.num_steps,
+                tracks_layout=self.tracks_layout,
+                bounds=bounds,
+            )
+        return state
+
+    def run(self, resume = False):
+        '''
+        Runs the pipeline, see the class description. Sets photons (the last step of every photon) and histories
+        (None without keep_photons), tracks (for the vertex layout also None without keep_photons), and totals (the summed histories of the whole run, including batches done before resuming).
+        '''
+        state = self.setup_output(resume)
+        rng = state['rng']
+        self.totals = {name: int(value) for name, value in state['tallies'].items()}
+        self.batches_done = state['batches_done']
+        self.photons_done = state['photons_done']
+        self.busy = {'generate': 0.0, 'propagate': 0.0, 'write': 0.0}
+
+        generated = queue.Queue(maxsize=QUEUE_SIZE)
+        propagated = queue.Queue(maxsize=QUEUE_SIZE)
+        stop = threading.Event()
+        errors = []
+
+        generator = photon_generator(
+            seed=self.seed,
+            max_photons=self.num_particles,
+            batch_size=self.batch_size,
+            rng=rng,
+            start_photon=self.photons_done,
+            **self.generator_args,
+        )
+
+        def generate():
+            try:
+                requested = None
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    try:
+                        photons = next(generator) if requested is None else generator.send(requested)
+                    except StopIteration:
+                        break
+                    # the bit generator state right after the batch, for its checkpoint
+                    rng_state = rng.bit_generator.state
+                    self.busy['generate'] += time.perf_counter() - start
+
+                    # shrink the next batches if memory is running low
+                    requested = None
+                    if self.adapt_batches:
+                        batch_size = adapt_batch_size(self.batch_size, self.num_steps, self.memory_budget)
+                        if batch_size != self.batch_size:
+                            self.batch_size = requested = batch_size
+                    # the size of the next batches goes with the batch, for its checkpoint
+                    if not _put(generated, (photons, rng_state, self.batch_size), stop):
+                        break
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                _put(generated, None, threading.Event())
+
+        final_steps = []
+        track_steps = []
+        histories = []
+
+        def write():
+            try:
+                tracks_done = min(self.num_tracks, self.photons_done)
+                last_batch_size = self.batch_size
+                while True:
+                    item = propagated.get()
+                    if item is None:
+                        break
+                    photon_steps, rng_state, next_batch_size, propagate_time, recorder = item
+                    start = time.perf_counter()
+                    with profiling.stage('write'):
+                        n_photons = len(photon_steps[-1].pos)
+                        batch = batch_histories(photon_steps)
+                        for name, value in batch.items():
+                            self.totals[name] = self.totals.get(name, 0) + int(np.sum(value, dtype=np.int64))
+                        for photon_filter in self.filters:
+                            photon_filter.update(photon_steps)
+
+                        n_tracks = min(self.num_tracks - tracks_done, n_photons)
+                        tracks_done += n_tracks
+                        # with a vertex recorder the dense tracks are never built
+                        tracks = None
+                        if n_tracks > 0 and recorder is None:
+                            tracks = np.stack([step.pos[:n_tracks] for step in photon_steps]).astype(np.float32)
+
+                        if self.output_path:
+                            particle_histories_write(self.output_path, batch)
+                            if recorder is not None:
+                                vertices_write(self.output_path, recorder.vertices())
+                            elif tracks is not None:
+                                tracks_write(self.output_path, tracks)
+
+                        self.batches_done += 1
+                        self.photons_done += n_photons
+                        if self.checkpoint is not None:
+                            # a changed batch size is checkpointed right away, so a resumed run never uses the wrong one
+                            self.checkpoint.batch_done(self.batches_done, self.photons_done, rng_state, self.totals,
+                                                       batch_size=next_batch_size, force=next_batch_size != last_batch_size)
+                        last_batch_size = next_batch_size
+
+                        if tracks is not None:
+                            track_steps.append(tracks)
+                        if self.keep_photons:
+                            final_steps.append(photon_steps[-1])
+                            histories.append({name: batch[name] for name in batch})
+
+                    self.busy['write'] += time.perf_counter() - start
+                    print(f'Batch {self.batches_done}: {n_photons} photons propagated in {propagate_time:.2f} s '
+                          f'({n_photons / max(propagate_time, 1e-9):.0f} photons/s), '
+                          f'{self.photons_done}/{self.num_particles} done')
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                # keep draining so the propagation never blocks on a full queue
+                while propagated.get() is not None:
+                    pass
+
+        generate_thread = threading.Thread(target=generate, name='photon_generator', daemon=True)
+        write_thread = threading.Thread(target=write, name='results_writer', daemon=True)
+        run_start = time.perf_counter()
+        generate_thread.start()
+        write_thread.start()
+
+        try:
+            batch = self.batches_done
+            tracks_propagated = min(self.num_tracks, self.photons_done)
+            while not stop.is_set():
+                item = generated.get()
+                if item is None:
+                    break
+                photons, rng_state, next_batch_size = item
+
+                # record the vertices of the batch's tracked photons as the steps are made
+                recorder = None
+                n_tracks = min(self.num_tracks - tracks_propagated, len(photons.pos))
+                tracks_propagated += n_tracks
+                if self.record_vertices and n_tracks > 0:
+                    recorder = VertexRecorder(n_tracks)
+
+                start = time.perf_counter()
+                with profiling.stage('propagate'):
+                    photon_steps = propagate(photons, self.gm, seed=batch_seed(self.seed, batch), num_steps=self.num_steps,
+                                             step_callback=recorder.update if recorder is not None else None)
+                propagate_time = time.perf_counter() - start
+                self.busy['propagate'] += propagate_time
+                batch += 1
+                if not _put(propagated, (photon_steps, rng_state, next_batch_size, propagate_time, recorder), stop):
+                    break
+        finally:
+            # the writer finishes the batches already propagated, then the generator is stopped
+            propagated.put(None)
+            write_thread.join()
+            stop.set()
+            # unblock the generator if it is waiting to hand over a batch
+            while generate_thread.is_alive():
+                try:
+                    generated.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            generate_thread.join()
+
+        if errors:
+            raise errors[0]
+
+        self.run_time = time.perf_counter() - run_start
+        self.photons_run = self.photons_done - state['photons_done']
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+        if self.record_vertices:
+            # the tracks of the photons propagated since the run started (or resumed)
+            self.tracks = tracks_read(self.output_path, start=min(self.num_tracks, state['photons_done']),
+                                      stop=min(self.num_tracks, self.photons_done)) if self.keep_photons else None
+        else:
+            self.tracks = np.concatenate(track_steps, axis=1) if track_steps else np.empty((self.num_steps + 1, 0, 3), dtype=np.float32)
+        self.photons = None
+        self.histories = None
+        if self.keep_photons:
+            self.photons = self.concatenate(final_steps)
+            self.histories = {name: np.concatenate([batch[name] for batch in histories]) for name in history_columns()} if histories else {}
+
+        self.report()
+
+    @staticmethod
+    def concatenate(photon_list):
+        '''
+        Concatenates the photons of several batches into one Photons object
+        '''
+        if not photon_list:
+            return Photons(np.empty((0, 3)), np.empty((0, 3)), np.empty((0, 3)), np.empty(0))
+        return Photons(
+            np.concatenate([photons.pos for photons in photon_list]),
+            np.concatenate([photons.dir for photons in photon_list]),
+            np.concatenate([photons.pol for photons in photon_list]),
+            np.concatenate([photons.wavelengths for photons in photon_list]),
+            t=np.concatenate([photons.t for photons in photon_list]),
+            last_hit_triangles=np.concatenate([photons.last_hit_triangles for photons in photon_list]),
+            flags=np.concatenate([photons.flags for photons in photon_list]),
+        )
+
+    def summary(self):
+        '''
+        Returns a summary of the run as a dict, e.g. to append to a run_ledger
+        '''
+        photons_run = self.photons_run
+        summary = {
+            'experiment': self.experiment_name,
+            'seed': self.seed,
+            'num_particles': self.num_particles,
+            'batch_size': self.batch_size,
+            'run_time': self.run_time,
+            'photons_per_second': photons_run / max(self.run_time, 1e-9),
+        }
+        summary.update(self.totals)
+        return summary
+
+    def report(self):
+        '''
+        Prints the throughput of the run and how long each stage of the pipeline was busy
+        '''
+        photons_run = self.photons_run
+        print(f'Simulated {photons_run} photons in {self.run_time:.2f} s: {photons_run / max(self.run_time, 1e-9):.0f} photons/s')
+        for stage, seconds in self.busy.items():
+            print(f'  {stage:<10} busy {seconds:8.2f} s ({100 * seconds / max(self.run_time, 1e-9):.0f}%)')
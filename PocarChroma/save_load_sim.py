@@ -3,8 +3,36 @@ import h5py
 import numpy as np
 import pandas as pd 
 
+from . import profiling
 
 
+# Name of the particle_history field that holds the bit-packed boolean columns
+PACKED_FIELD = 'packed_flags'
+
+# Target size in bytes of one chunk of the tracks dataset, and of the photon id index datasets
+TRACKS_CHUNK_BYTES = 1 << 20
+INDEX_CHUNK_ROWS = 1 << 16
+
+
+def _uint_dtype(max_value):
+    '''
+    Returns the smallest unsigned integer dtype that can hold max_value
+    '''
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f'{max_value} does not fit in a 64 bit unsigned integer')
+
+
+def _is_bool_column(value):
+    '''
+    A column is stored as a packed bit if it was supplied as a boolean array or dtype
+    '''
+    try:
+        return np.dtype(value) == np.bool_
+    except TypeError:
+        return np.asarray(value).dtype == np.bool_
+
 
 def make_HDF5_file(
     file_path, 
@@ -15,7 +43,12 @@ def make_HDF5_file(
 
     hist_rows:int,
     # and the tallies columns
-    hist_columns
+    hist_columns,
+    max_count:int = 255,
+    tracks_layout:str = 'chunked',
+    mode:str = 'w',
+    bounds = None,
+    precision:float = 1e-3,
     ):
     '''
     Makes an HDF5 file with the desired header information
@@ -31,9 +64,49 @@ def make_HDF5_file(
     Note, specifying dataset shape will ensure that file creation goes smoothly.
     The tracks dataset has the shape (<number of steps> + 1, <number of tracks to be saved>, 3)
     You should also specify the total number of rows (photons) in the tallies arrays
+
+    hist_columns can be a list of column names or a dict (e.g. the tallies dict of the first batch).
+    Columns given in a dict as boolean arrays (or np.bool_ dtypes) are bit-packed together into a single
+    integer field, every other column is stored as a counter using the smallest unsigned dtype that holds max_count.
+    Use particle_histories_read or tallies_read_to_df to get the unpacked columns back.
+
+    For every column an index dataset index/<column> is kept holding the sorted photon ids (rows) where the column is nonzero,
+    so select_tracks can find the photons with a given interaction without reading the whole particle_history.
+    The tracks dataset is chunked so that every chunk holds the full track of a block of photons.
+    :param tracks_layout: 'chunked', 'contiguous' to store the tracks uncompressed in one block so tracks_memmap
+        can map them straight out of the HDF5 file, 'delta' to store them quantized and delta encoded,
+        or 'vertex' to store only the interaction vertices (see below)
+    :type tracks_layout: str
+    :param bounds: (lower corner, upper corner) of the geometry bounding box, needed for tracks_layout='delta'
+    :param precision: Quantization step of the delta encoded positions, in the units of the geometry (mm, so 1 um by default)
+    :type precision: float
+
+    With tracks_layout='delta', tracks is a group instead of a dataset. Each photon's track is stored as its first position
+    in fixed point (int32, relative to the lower corner of bounds) followed by the fixed point steps to each next position,
+    up to the last step where the photon moved; the repeated positions after that are only stored as a length.
+    Steps are int16 if the bounding box is less than 2^15 precision steps across, int32 otherwise.
+    tracks_write, tracks_read and select_tracks encode and decode this transparently.
+
+    With tracks_layout='vertex', tracks is a group holding a flat table of the interaction vertices of all photons
+    (position, step, flags and last hit triangle, grouped by photon in step order) and the offset of every photon's first vertex.
+    Write it from the step loop with photons.VertexRecorder and vertices_write. tracks_read and select_tracks rebuild dense tracks
+    from it, vertices_read returns the vertex table itself.
+    :param max_count: The largest value a counter column has to hold, e.g. the number of propagation steps.
+        Writing a larger count raises a ValueError rather than clipping it.
+    :type max_count: int
+    :param mode: 'w' to overwrite an existing file, or 'w-' to raise an error instead of clobbering it
+        (e.g. the partial output of a run that should be resumed with checkpoint.run_checkpoint)
+    :type mode: str
     '''
     # I could in theory make it so the HDF5 file is configured to be dynamic, but that would take extra work that doesn't seem worth it right now
 
+    if tracks_layout not in ('chunked', 'contiguous', 'delta', 'vertex'):
+        raise ValueError('tracks_layout must be "chunked", "contiguous", "delta" or "vertex"')
+    if tracks_layout == 'delta' and bounds is None:
+        raise ValueError('bounds must be given to delta encode tracks')
+    if mode not in ('w', 'w-'):
+        raise ValueError('mode must be "w" or "w-"')
+
     save_dir = file_path.rsplit('/', 1)[0]
     if os.path.isdir(save_dir):
         pass
@@ -41,20 +114,28 @@ def make_HDF5_file(
         os.makedirs(save_dir, exist_ok=True)
 
 
-    # Convert tallies_columns into list if supplied as dict
+    # Convert tallies_columns into list if supplied as dict, remembering which ones are booleans
     if isinstance(hist_columns, dict):
+        packed_columns = [name for name, value in hist_columns.items() if _is_bool_column(value)]
         hist_columns = list(hist_columns.keys())
-    
-    # make the tallies column names into a structured dtype with columns as bools
-
-
+    else:
+        packed_columns = []
+        hist_columns = list(hist_columns)
 
-    tallies_dtype = np.dtype([(name, 'i') for name in hist_columns])
+    if PACKED_FIELD in hist_columns:
+        raise ValueError(f'{PACKED_FIELD} is reserved and cannot be used as a column name')
 
+    # make the tallies column names into a structured dtype, counters get their own compact field
+    # and all boolean columns share one bit field
+    counter_dtype = _uint_dtype(max_count)
+    fields = [(name, counter_dtype) for name in hist_columns if name not in packed_columns]
+    if packed_columns:
+        fields.append((PACKED_FIELD, _uint_dtype(2**len(packed_columns) - 1)))
 
+    tallies_dtype = np.dtype(fields)
 
     # actually make the file
-    with h5py.File(file_path, 'w') as f:
+    with h5py.File(file_path, mode) as f:
 
         # make the two datasets
         hist_ds = f.create_dataset(name='particle_history',
@@ -65,8 +146,37 @@ def make_HDF5_file(
         # set an attribute that keeps track of next writable row 
 
         hist_ds.attrs['next_writable'] = 0
+
+        # remember the column order and which columns are stored as bits so they can be unpacked
+        hist_ds.attrs['columns'] = hist_columns
+        hist_ds.attrs['packed_columns'] = packed_columns
+
+        # running sum of every column, so summary tallies can be read without reading the dataset
+        hist_ds.attrs['column_totals'] = np.zeros(len(hist_columns), dtype=np.int64)
         
-        tracks_ds = f.create_dataset('tracks', tracks_shape, dtype='f')
+        # one resizable, sorted list of photon ids per column, appended to as histories are written
+        index_group = f.create_group('index')
+        for name in hist_columns:
+            index_group.create_dataset(name,
+                shape=(0,),
+                maxshape=(None,),
+                dtype=_uint_dtype(max(hist_rows - 1, 0)),
+                chunks=(INDEX_CHUNK_ROWS,),
+                )
+
+        # chunk the tracks so that reading a photon's track only touches the chunk holding its block of photons
+        if tracks_layout == 'chunked' and tracks_shape[1] > 0:
+            chunk_photons = max(1, min(tracks_shape[1], TRACKS_CHUNK_BYTES // (tracks_shape[0] * tracks_shape[2] * 4)))
+            tracks_chunks = (tracks_shape[0], chunk_photons, tracks_shape[2])
+        else:
+            tracks_chunks = None
+
+        if tracks_layout == 'delta':
+            tracks_ds = _make_delta_tracks(f, tracks_shape, bounds, precision)
+        elif tracks_layout == 'vertex':
+            tracks_ds = _make_vertex_tracks(f, tracks_shape)
+        else:
+            tracks_ds = f.create_dataset('tracks', tracks_shape, dtype='f', chunks=tracks_chunks)
 
         tracks_ds.attrs['next_writable'] = 0
 
@@ -77,87 +187,567 @@ def make_HDF5_file(
 
     return
 
+def _pack_histories(ds, tallies_dict:dict, n_rows:int):
+    '''
+    Packs a dict of tallies arrays into one structured array matching the particle_history dtype.
+    Raises a ValueError if a counter is larger than its field can hold, see max_count of make_HDF5_file.
+    '''
+    packed_columns = list(ds.attrs.get('packed_columns', []))
+    arr = np.zeros(n_rows, dtype=ds.dtype)
+
+    for name in ds.dtype.names:
+        if name == PACKED_FIELD:
+            continue
+        value = np.asarray(tallies_dict[name])
+        field_max = np.iinfo(ds.dtype[name]).max
+        if n_rows and value.max() > field_max:
+            raise ValueError(f'{name} reaches {value.max()}, more than its field holds ({field_max}), '
+                             'make the file with a larger max_count')
+        arr[name] = value
+
+    if packed_columns:
+        bits = arr[PACKED_FIELD]
+        for bit, name in enumerate(packed_columns):
+            bits |= np.asarray(tallies_dict[name]).astype(bool).astype(bits.dtype) << bits.dtype.type(bit)
+        arr[PACKED_FIELD] = bits
+
+    return arr
+
+
+def _unpack_histories(ds, arr):
+    '''
+    Turns rows read from particle_history back into a structured array with one field per column.
+    Files written before columns were packed are returned unchanged.
+    '''
+    if 'columns' not in ds.attrs:
+        return arr
+
+    columns = list(ds.attrs['columns'])
+    packed_columns = list(ds.attrs.get('packed_columns', []))
+
+    out = np.empty(len(arr), dtype=[
+        (name, np.bool_ if name in packed_columns else ds.dtype[name]) for name in columns
+    ])
+    for name in columns:
+        if name in packed_columns:
+            out[name] = (arr[PACKED_FIELD] >> packed_columns.index(name)) & 1
+        else:
+            out[name] = arr[name]
+
+    return out
+
+
 def particle_histories_write(
     file_path:str,
     tallies_dict:dict,
 ):
     '''
+    Packs the tallies into the particle_history row format and writes them with a single hyperslab write.
     :param file_path: The path to the previously created hdf5 file
     :type file_path: str
     :param tallies_dict: A dictionary of numpy arrays
     :type tallies_dict: dict
     '''
-    
-
-
-    with h5py.File(file_path, 'r+') as f:
+    with profiling.stage('write_histories'), h5py.File(file_path, 'r+') as f:
         ds = f['particle_history']
         next_row = ds.attrs['next_writable']
 
-
         # Get the end row by getting the length of the first array in the dict
-        end_row = next_row + len(next(iter(tallies_dict.values())))
-
-        
-        for key, value in tallies_dict.items():
+        n_rows = len(next(iter(tallies_dict.values())))
+        end_row = next_row + n_rows
+
+        ds[next_row:end_row] = _pack_histories(ds, tallies_dict, n_rows)
+
+        # append the photon ids with a nonzero entry to each column's index
+        if 'index' in f:
+            for name, value in tallies_dict.items():
+                rows = np.flatnonzero(np.asarray(value)) + next_row
+                index_ds = f['index'][name]
+                n_indexed = index_ds.shape[0]
+                index_ds.resize((n_indexed + len(rows),))
+                index_ds[n_indexed:] = rows
+
+        if 'column_totals' in ds.attrs:
+            columns = list(ds.attrs['columns'])
+            totals = ds.attrs['column_totals']
+            for name, value in tallies_dict.items():
+                totals[columns.index(name)] += np.sum(np.asarray(value), dtype=np.int64)
+            ds.attrs['column_totals'] = totals
 
-
-
-            ds[key, next_row:end_row]= value
-
-        
         ds.attrs['next_writable'] = end_row
         
     return
 
 
+def particle_histories_read(file_path, start=0, stop=None):
+    '''
+    Reads rows of particle_history and returns them as a structured numpy array with one field per column
+    '''
+    with h5py.File(file_path, 'r') as f:
+        ds = f['particle_history']
+        return _unpack_histories(ds, ds[start:stop])
+
+
 def tracks_write(
     file_path,
     tracks_arr
 ):
     '''
-    Writes a tracks array to a preexisting hdf5 file that was created by make_HDF5_file
+    Writes a tracks array to a preexisting hdf5 file that was created by make_HDF5_file.
+    Files made with tracks_layout='vertex' are written with vertices_write instead, dense positions don't hold
+    the interaction flags and triangles of the vertices.
     '''
-    with h5py.File(file_path, 'r+') as f:
+    with profiling.stage('write_tracks'), h5py.File(file_path, 'r+') as f:
         ds = f['tracks']
         next_row = ds.attrs['next_writable']
         end_row = next_row + tracks_arr.shape[1]
 
-        ds[:, next_row:end_row, :] = tracks_arr
+        if isinstance(ds, h5py.Group) and ds.attrs['codec'] == 'vertex':
+            raise ValueError(f'{file_path} was made with tracks_layout="vertex", write its tracks with vertices_write')
+        elif isinstance(ds, h5py.Group):
+            _delta_tracks_write(ds, tracks_arr, next_row)
+        else:
+            ds[:, next_row:end_row, :] = tracks_arr
         ds.attrs['next_writable'] = end_row
     
     return
 
 
-def tracks_read(file_path):
+### DELTA ENCODED TRACKS
+
+def _make_delta_tracks(f, tracks_shape, bounds, precision):
+    '''
+    Creates the tracks group of a file with tracks_layout='delta', see make_HDF5_file
+    '''
+    lower, upper = (np.asarray(corner, dtype=np.float64) for corner in bounds)
+    n_steps, n_tracks, n_dims = tracks_shape
+
+    # the largest step a photon can take inside the bounding box decides how wide the stored steps have to be
+    max_delta = int(np.ceil(np.max(upper - lower) / precision))
+    delta_dtype = np.int16 if max_delta <= np.iinfo(np.int16).max else np.int32
+
+    group = f.create_group('tracks')
+    group.attrs['codec'] = 'delta'
+    group.attrs['shape'] = tracks_shape
+    group.attrs['origin'] = lower
+    group.attrs['precision'] = precision
+    group.attrs['next_delta'] = 0
+
+    group.create_dataset('start', shape=(n_tracks, n_dims), dtype=np.int32)
+    group.create_dataset('length', shape=(n_tracks,), dtype=_uint_dtype(n_steps))
+    group.create_dataset('offsets', shape=(n_tracks + 1,), dtype=np.int64)
+    group.create_dataset('deltas',
+        shape=(0, n_dims),
+        maxshape=(None, n_dims),
+        dtype=delta_dtype,
+        chunks=(max(1, TRACKS_CHUNK_BYTES // (n_dims * np.dtype(delta_dtype).itemsize)), n_dims),
+        )
+
+    return group
+
+
+def _delta_tracks_write(group, tracks_arr, next_row):
+    '''
+    Quantizes and delta encodes a tracks array of shape (steps + 1, photons, 3) and appends it to the tracks group
+    '''
+    origin = group.attrs['origin']
+    precision = group.attrs['precision']
+    deltas_ds = group['deltas']
+    n_tracks = tracks_arr.shape[1]
+
+    q = np.rint((np.asarray(tracks_arr, dtype=np.float64) - origin) / precision).astype(np.int64)
+    if np.abs(q[0]).max(initial=0) > np.iinfo(np.int32).max:
+        raise ValueError('Track starts too far outside of the bounding box to be stored')
+
+    # a photon's track is stored up to the last step where it moved, the rest just repeats that position
+    moved = np.any(q[1:] != q[:-1], axis=2)
+    last_move = moved.shape[0] - np.argmax(moved[::-1], axis=0)
+    length = np.where(moved.any(axis=0), last_move + 1, 1)
+
+    # keep the steps before each photon's tail, photon by photon
+    deltas = np.diff(q, axis=0).transpose(1, 0, 2)
+    keep = np.arange(deltas.shape[1])[None, :] < (length - 1)[:, None]
+    deltas = deltas[keep]
+
+    if np.abs(deltas).max(initial=0) > np.iinfo(deltas_ds.dtype).max:
+        raise ValueError('A track step is larger than the bounding box, check the bounds given to make_HDF5_file')
+
+    next_delta = int(group.attrs['next_delta'])
+    offsets = next_delta + np.cumsum(length - 1)
+
+    deltas_ds.resize((next_delta + len(deltas), deltas_ds.shape[1]))
+    deltas_ds[next_delta:] = deltas
+    group['start'][next_row:next_row + n_tracks] = q[0]
+    group['length'][next_row:next_row + n_tracks] = length
+    group['offsets'][next_row + 1:next_row + n_tracks + 1] = offsets
+    group.attrs['next_delta'] = next_delta + len(deltas)
+
+
+def _delta_decode(start, length, deltas, n_steps):
+    '''
+    Rebuilds the fixed point tracks, shape (n_steps, photons, 3), from photons' starts, lengths and their concatenated steps
+    '''
+    length = length.astype(np.int64)
+    n_deltas = length - 1
+    first_delta = np.cumsum(n_deltas) - n_deltas
+
+    # positions along each photon's track, restarting the running sum of steps at every photon
+    summed = np.cumsum(deltas.astype(np.int64), axis=0)
+    summed = np.concatenate([np.zeros((1, summed.shape[1]), dtype=np.int64), summed])
+    positions = summed[1:] - np.repeat(summed[first_delta], n_deltas, axis=0) + np.repeat(start, n_deltas, axis=0)
+    positions = np.concatenate([positions, np.zeros((1, start.shape[1]), dtype=np.int64)])
+
+    # step s of a photon is its start for s = 0, and its position min(s, length - 1) otherwise
+    step = np.minimum(np.arange(n_steps)[:, None], n_deltas[None, :])
+    dense = positions[np.maximum(first_delta[None, :] + step - 1, 0)]
+
+    return np.where((step > 0)[:, :, None], dense, start[None, :, :])
+
+
+def _delta_read_columns(group, cols, max_span:int = 1024):
+    '''
+    Reads and decodes the tracks of the photons in cols (sorted) from a delta encoded tracks group
+    '''
+    n_steps, _, n_dims = group.attrs['shape']
+    out = np.zeros((n_steps, len(cols), n_dims), dtype=np.float32)
+    if len(cols) == 0:
+        return out
+
+    written = cols < group.attrs['next_writable']
+    cols = cols[written]
+    decoded = np.empty((n_steps, len(cols), n_dims), dtype=np.float32)
+
+    # read the starts, lengths and steps of runs of nearby photons with one slice each
+    for run in _column_runs(cols, max_span):
+        lo = cols[run[0]]
+        hi = cols[run[-1]] + 1
+        offsets = group['offsets'][lo:hi + 1]
+        start = group['start'][lo:hi].astype(np.int64)
+        length = group['length'][lo:hi]
+        deltas = group['deltas'][offsets[0]:offsets[-1]]
+
+        q = _delta_decode(start, length, deltas, n_steps)[:, cols[run] - lo, :]
+        decoded[:, run, :] = q * group.attrs['precision'] + group.attrs['origin']
+
+    out[:, written, :] = decoded
+    return out
+
+
+### SPARSE VERTEX TRACKS
+
+VERTEX_FIELDS = {
+    'pos': (np.float32, (3,)),
+    'step': (np.uint16, ()),
+    'flags': (np.uint32, ()),
+    'last_hit_triangles': (np.int32, ()),
+}
+
+
+def _make_vertex_tracks(f, tracks_shape):
+    '''
+    Creates the tracks group of a file with tracks_layout='vertex', see make_HDF5_file
+    '''
+    n_steps, n_tracks, _ = tracks_shape
+
+    group = f.create_group('tracks')
+    group.attrs['codec'] = 'vertex'
+    group.attrs['shape'] = tracks_shape
+    group.attrs['next_vertex'] = 0
+
+    group.create_dataset('offsets', shape=(n_tracks + 1,), dtype=np.int64)
+    for name, (dtype, shape) in VERTEX_FIELDS.items():
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        group.create_dataset(name,
+            shape=(0,) + shape,
+            maxshape=(None,) + shape,
+            dtype=dtype,
+            chunks=(max(1, TRACKS_CHUNK_BYTES // (4 * row_bytes)),) + shape,
+            )
+
+    return group
+
+
+def _vertices_from_tracks(tracks_arr, flags, last_hit_triangles):
+    '''
+    Turns dense tracks, shape (steps + 1, photons, 3), and the flags and last hit triangles of every step,
+    shape (steps + 1, photons), into a vertex table like photons.VertexRecorder.vertices
+    '''
+    tracks_arr = np.asarray(tracks_arr)
+    moved = np.ones(tracks_arr.shape[:2], dtype=bool)
+    moved[1:] = np.any(tracks_arr[1:] != tracks_arr[:-1], axis=2)
+
+    # transpose so the vertices come out grouped by photon, in step order
+    photon_moved = moved.T
+    step = np.broadcast_to(np.arange(tracks_arr.shape[0]), photon_moved.shape)[photon_moved]
+
+    return {
+        'counts': photon_moved.sum(axis=1),
+        'step': step,
+        'pos': tracks_arr.transpose(1, 0, 2)[photon_moved],
+        'flags': np.asarray(flags, dtype=np.uint32).T[photon_moved],
+        'last_hit_triangles': np.asarray(last_hit_triangles, dtype=np.int32).T[photon_moved],
+    }
+
+
+def _vertex_tracks_write(group, vertices, next_row):
+    '''
+    Appends a vertex table (see photons.VertexRecorder.vertices) to the tracks group
+    '''
+    counts = np.asarray(vertices['counts'], dtype=np.int64)
+    next_vertex = int(group.attrs['next_vertex'])
+    n_vertices = int(counts.sum())
+
+    for name in VERTEX_FIELDS:
+        ds = group[name]
+        ds.resize((next_vertex + n_vertices,) + ds.shape[1:])
+        ds[next_vertex:] = vertices[name]
+    group['offsets'][next_row + 1:next_row + len(counts) + 1] = next_vertex + np.cumsum(counts)
+    group.attrs['next_vertex'] = next_vertex + n_vertices
+
+
+def _vertex_read_columns(group, cols, max_span:int = 1024):
+    '''
+    Rebuilds dense tracks, shape (steps + 1, len(cols), 3), of the photons in cols (sorted) from a vertex tracks group.
+    Between vertices a photon stays where its last vertex was.
+    '''
+    n_steps, _, n_dims = group.attrs['shape']
+    out = np.zeros((n_steps, len(cols), n_dims), dtype=np.float32)
+    if len(cols) == 0:
+        return out
+
+    written = cols < group.attrs['next_writable']
+    cols = cols[written]
+    dense = np.zeros((n_steps, len(cols), n_dims), dtype=np.float32)
+
+    for run in _column_runs(cols, max_span):
+        lo = cols[run[0]]
+        hi = cols[run[-1]] + 1
+        offsets = group['offsets'][lo:hi + 1]
+        pos = group['pos'][offsets[0]:offsets[-1]]
+        step = group['step'][offsets[0]:offsets[-1]].astype(np.int64)
+        photon = np.repeat(np.arange(hi - lo), np.diff(offsets))
+
+        # mark the vertex made at each step, then carry the last vertex forward over the steps without one
+        vertex_at = np.full((n_steps, hi - lo), -1, dtype=np.int64)
+        vertex_at[step, photon] = np.arange(len(step))
+        vertex_at = np.maximum.accumulate(vertex_at, axis=0)[:, cols[run] - lo]
+
+        pos = np.concatenate([pos, np.zeros((1, n_dims), dtype=np.float32)])
+        dense[:, run, :] = np.where((vertex_at >= 0)[:, :, None], pos[vertex_at], 0)
+
+    out[:, written, :] = dense
+    return out
+
+
+def vertices_write(file_path, vertices:dict):
+    '''
+    Appends the vertices of a batch of photons to a results file made with tracks_layout='vertex'
+    :param vertices: vertex table of the tracked photons of the batch, as returned by photons.VertexRecorder.vertices
+    :type vertices: dict
+    '''
+    with profiling.stage('write_vertices'), h5py.File(file_path, 'r+') as f:
+        group = f['tracks']
+        if not isinstance(group, h5py.Group) or group.attrs['codec'] != 'vertex':
+            raise ValueError(f'{file_path} was not made with tracks_layout="vertex"')
+
+        next_row = int(group.attrs['next_writable'])
+        _vertex_tracks_write(group, vertices, next_row)
+        group.attrs['next_writable'] = next_row + len(vertices['counts'])
+
+    return
+
+
+def vertices_read(file_path, start=0, stop=None):
+    '''
+    Reads the vertex table of the tracked photons start to stop from a file made with tracks_layout='vertex'
+    :return: dict with the photon id of every vertex and the vertex fields, and the offset of every photon's first vertex
+    :rtype: dict
+    '''
+    with h5py.File(file_path, 'r') as f:
+        group = f['tracks']
+        if stop is None:
+            stop = int(group.attrs['next_writable'])
+        offsets = group['offsets'][start:stop + 1]
+        vertices = {name: group[name][offsets[0]:offsets[-1]] for name in VERTEX_FIELDS}
+
+    vertices['photon'] = start + np.repeat(np.arange(stop - start), np.diff(offsets))
+    vertices['offsets'] = offsets - offsets[0]
+
+    return vertices
+
+
+def _tracks_shape(tracks):
+    '''
+    Shape of the (decoded) tracks, for both the tracks dataset and the delta and vertex tracks groups
+    '''
+    if isinstance(tracks, h5py.Group):
+        return tuple(int(n) for n in tracks.attrs['shape'])
+    return tracks.shape
+
+
+def _index_rows_below(index_ds, stop:int):
+    '''
+    Returns the photon ids in a sorted index dataset that are smaller than stop,
+    binary searching the dataset so that only the matching prefix is read.
+    '''
+    lo, hi = 0, index_ds.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if index_ds[mid] < stop:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return index_ds[:lo].astype(np.int64)
+
+
+def _column_runs(cols, span:int):
+    '''
+    Splits sorted columns into runs that fall in the same block of span columns (e.g. one chunk of the tracks dataset),
+    returned as index arrays into cols. Each run is read with one slice of at most span columns.
+    '''
+    breaks = np.flatnonzero(np.diff(cols // span) != 0) + 1
+    return [run for run in np.split(np.arange(len(cols)), breaks) if len(run)]
+
+
+def _read_track_columns(tracks_ds, cols, max_span:int = 1024):
     '''
-    Gets tracks from a given hdf5 file and returns them as a numpy array
+    Reads the tracks of the photons in cols (sorted) from the tracks dataset, shape (steps + 1, len(cols), 3).
+
+    The tracks are read chunk by chunk (or max_span columns at a time for unchunked datasets and tracks groups),
+    one slice per chunk holding selected tracks, and the selected columns are gathered into the output.
+    So only the chunks holding selected tracks are touched, and no read is larger than one chunk however spread out cols is.
+    '''
+    cols = np.asarray(cols, dtype=np.int64)
+    if isinstance(tracks_ds, h5py.Group) and tracks_ds.attrs['codec'] == 'vertex':
+        return _vertex_read_columns(tracks_ds, cols, max_span)
+    elif isinstance(tracks_ds, h5py.Group):
+        return _delta_read_columns(tracks_ds, cols, max_span)
+
+    out = np.empty((tracks_ds.shape[0], len(cols), tracks_ds.shape[2]), dtype=tracks_ds.dtype)
+    if len(cols) == 0:
+        return out
+
+    span = tracks_ds.chunks[1] if tracks_ds.chunks is not None else max_span
+    for run in _column_runs(cols, span):
+        lo = cols[run[0]]
+        hi = cols[run[-1]] + 1
+        out[:, run, :] = tracks_ds[:, lo:hi, :][:, cols[run] - lo, :]
+
+    return out
+
+
+def _read_rows(ds, rows):
+    '''
+    Reads the (sorted) rows of a 1D dataset, one slice per run of consecutive rows
     '''
+    rows = np.asarray(rows, dtype=np.int64)
+    out = np.empty(len(rows), dtype=ds.dtype)
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    for run in np.split(np.arange(len(rows)), breaks):
+        if len(run):
+            out[run] = ds[rows[run[0]]:rows[run[-1]] + 1]
+
+    return out
+
+
+def tracks_sidecar_path(file_path):
+    '''
+    Path of the .npy copy of the tracks dataset made by tracks_export_npy
+    '''
+    return os.path.splitext(file_path)[0] + '.tracks.npy'
+
+
+def tracks_export_npy(file_path, block_photons:int = 65536):
+    '''
+    Copies the tracks of a results file into a sidecar .npy file (see tracks_sidecar_path) that can be memory mapped.
+    Use this for files with chunked tracks, files made with tracks_layout='contiguous' can be mapped directly.
+    '''
+    sidecar_path = tracks_sidecar_path(file_path)
+    tmp_path = sidecar_path + '.tmp.npy'
 
     with h5py.File(file_path, 'r') as f:
+        ds = f['tracks']
+        shape = _tracks_shape(ds)
+        arr = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
 
-        arr = f['tracks'][:]
+        # copy in blocks of photons so the whole dataset never has to fit in memory
+        for start in range(0, shape[1], block_photons):
+            stop = min(start + block_photons, shape[1])
+            arr[:, start:stop, :] = _read_track_columns(ds, np.arange(start, stop))
+        arr.flush()
+        del arr
 
-        return arr
+    os.replace(tmp_path, sidecar_path)
 
+    return sidecar_path
 
 
-def tallies_read_to_df(file_path):
+def tracks_memmap(file_path, export_sidecar:bool = True):
     '''
-    Returns tallies as a pandas dataframe
+    Returns the tracks of a results file as a read-only np.memmap, without decompressing or copying anything.
+    Slices of it are views, and every process mapping the same file shares the OS page cache.
+
+    Contiguous tracks datasets (tracks_layout='contiguous') are mapped straight out of the HDF5 file.
+    Otherwise the sidecar .npy file is mapped, and made with tracks_export_npy first if it is missing
+    or older than the HDF5 file and export_sidecar is True.
     '''
     with h5py.File(file_path, 'r') as f:
+        ds = f['tracks']
+        offset = None
+        if isinstance(ds, h5py.Dataset) and ds.chunks is None and ds.compression is None and not ds.is_virtual:
+            # None if nothing has been written to the dataset yet
+            offset = ds.id.get_offset()
+            dtype = ds.dtype
+            shape = ds.shape
+
+    if offset is not None:
+        return np.memmap(file_path, mode='r', dtype=dtype, shape=shape, offset=offset)
 
-        df = pd.DataFrame(f['particle_history'][:])
+    sidecar_path = tracks_sidecar_path(file_path)
+    sidecar_is_stale = not os.path.exists(sidecar_path) or os.path.getmtime(sidecar_path) < os.path.getmtime(file_path)
+    if sidecar_is_stale:
+        if not export_sidecar:
+            raise FileNotFoundError(f'Tracks in {file_path} cannot be mapped directly and there is no up to date {sidecar_path}')
+        tracks_export_npy(file_path)
 
-        return df
+    return np.load(sidecar_path, mmap_mode='r')
+
+
+def tracks_read(file_path, mmap:bool = False, start:int = 0, stop:int = None):
+    '''
+    Gets tracks from a given hdf5 file and returns them as a numpy array, of the tracked photons start to stop (all by default)
+    If mmap is True, returns a read-only memory mapped array instead of reading the tracks into memory, see tracks_memmap
+    '''
+    if mmap:
+        return tracks_memmap(file_path)[:, start:stop]
+
+    with h5py.File(file_path, 'r') as f:
+
+        tracks = f['tracks']
+        if isinstance(tracks, h5py.Group):
+            stop = _tracks_shape(tracks)[1] if stop is None else stop
+            return _read_track_columns(tracks, np.arange(start, stop))
+
+        arr = tracks[:, start:stop]
+
+        return arr
+
+
+
+def tallies_read_to_df(file_path):
+    '''
+    Returns tallies as a pandas dataframe
+    '''
+    return pd.DataFrame(particle_histories_read(file_path))
 
 
 def select_tracks(
     file_path,
     selection_criteria,
     invert_selection = False,
-    return_type = 'indices'
+    return_type = 'indices',
+    mmap = False,
     ):
     '''
     Replaces analysis_manager.preprocess_tracks
@@ -167,48 +757,252 @@ def select_tracks(
     :param invert_selection: If true, takes the indicies which do not meet the selection criteria
     :type invert_selection: bool 
     :param return_type: 'indicies': return indices, 'tracks': return tracks, 'both': return both indicies and tracks (in that order)
+    :param mmap: If true, selected tracks are gathered from the memory mapped tracks (see tracks_memmap) instead of read through h5py
+    :type mmap: bool
     '''
 
+    if return_type not in ('indices', 'tracks', 'both'):
+        raise ValueError('return_type must be "indices", "tracks" or "both"')
+
     with h5py.File(file_path, 'r') as f:
 
         tracks = f['tracks']
-        n_tracks = tracks.shape[1]
-
-        # This assumes that the tracks are the first n rows in tallies
+        n_tracks = _tracks_shape(tracks)[1]
 
-        tallies = f['particle_history'][:n_tracks]
+        # This assumes that the tracks are the first n rows in tallies,
+        # unless the file maps tracks to other rows (e.g. files merged from shards by merge_shards)
+        track_rows = f['track_rows'][:] if 'track_rows' in f else None
 
-        # if selection criteria is callable, run it as a function to get a selection mask (1D array where)
-        if callable(selection_criteria):
-            sel_arr = selection_criteria(tallies)
+        # if selection criteria is a string with a precomputed index, only read the index entries of the tracked photons
+        if isinstance(selection_criteria, str) and 'index' in f and selection_criteria in f['index']:
+            if track_rows is None:
+                sel_inds = _index_rows_below(f['index'][selection_criteria], n_tracks)
+            else:
+                rows = _index_rows_below(f['index'][selection_criteria], track_rows[-1] + 1 if n_tracks else 0)
+                sel_inds = np.flatnonzero(np.isin(track_rows, rows, assume_unique=True))
 
-            #if the returned array is not the same length as the number of tracks, throw an error
-            if len(sel_arr) != n_tracks:
-                raise ValueError("The array provided by selection_criteria does not correspond to the number of tracks")
+            # if specified, invert the selection
+            if invert_selection:
+                sel_inds = np.setdiff1d(np.arange(n_tracks), sel_inds, assume_unique=True)
 
-        # if selection criteria is a string, select from those items in the appropriate column
-        elif isinstance(selection_criteria, str):
-            sel_arr = tallies[selection_criteria][:] > 0
+            inds = (sel_inds,)
 
-        # If neither is true, throw a ValueError
         else:
-            raise ValueError('selection_criteria must be a function or a string')
+            hist_ds = f['particle_history']
+            if track_rows is None:
+                tallies = _unpack_histories(hist_ds, hist_ds[:n_tracks])
+            else:
+                tallies = _unpack_histories(hist_ds, _read_rows(hist_ds, track_rows))
 
-        # if specified, invert the selection
-        if invert_selection:
-            sel_arr = np.logical_not(sel_arr)
+            # if selection criteria is callable, run it as a function to get a selection mask (1D array where)
+            if callable(selection_criteria):
+                sel_arr = selection_criteria(tallies)
 
-        # get the indices of tracks
-        inds = np.where(sel_arr)
+                #if the returned array is not the same length as the number of tracks, throw an error
+                if len(sel_arr) != n_tracks:
+                    raise ValueError("The array provided by selection_criteria does not correspond to the number of tracks")
+
+            # if selection criteria is a string, select from those items in the appropriate column
+            elif isinstance(selection_criteria, str):
+                sel_arr = tallies[selection_criteria][:] > 0
+
+            # If neither is true, throw a ValueError
+            else:
+                raise ValueError('selection_criteria must be a function or a string')
+
+            # if specified, invert the selection
+            if invert_selection:
+                sel_arr = np.logical_not(sel_arr)
+
+            # get the indices of tracks
+            inds = np.where(sel_arr)
 
         if return_type == 'indices':
             return inds
-        elif return_type == 'tracks':
-            return np.take(tracks, inds, axis=1)
-        elif return_type == 'both':
-            return inds, np.take(tracks, inds, axis=1)
+
+        # only read the chunks holding the selected tracks, shape (steps + 1, number selected, 3)
+        if mmap:
+            selected_tracks = tracks_memmap(file_path)[:, inds[0], :]
+        else:
+            selected_tracks = _read_track_columns(tracks, inds[0])
+
+        if return_type == 'tracks':
+            return selected_tracks
         else:
-            raise ValueError('return_type must be "indices", "tracks" or "both"')
+            return inds, selected_tracks
+
+
+### SHARDED OUTPUT
+
+# Parallel workers can't share one HDF5 file, so each worker writes its own shard with make_shard_file
+# and merge_shards stitches the shards together into one file of virtual datasets, without copying the data.
+
+def shard_path(file_path, shard:int):
+    '''
+    Path of shard number shard of the results file file_path
+    '''
+    base, ext = os.path.splitext(file_path)
+    return f'{base}.shard{shard:04d}{ext}'
+
+
+def make_shard_file(
+    file_path,
+    shard:int,
+    photon_id_start:int,
+    attributes:dict,
+    tracks_shape,
+    hist_rows:int,
+    hist_columns,
+    **kwargs
+    ):
+    '''
+    Makes the results file of one parallel worker, see make_HDF5_file for the arguments.
+    :param shard: Number of this worker's shard
+    :type shard: int
+    :param photon_id_start: Global id of the first photon written to this shard
+    :type photon_id_start: int
+    :return: The path of the shard file
+    :rtype: str
+    '''
+    path = shard_path(file_path, shard)
+    attributes = dict(attributes, shard=shard, photon_id_start=photon_id_start)
+    make_HDF5_file(path, attributes, tracks_shape, hist_rows, hist_columns, **kwargs)
+
+    return path
+
+
+def merge_shards(shard_paths, file_path):
+    '''
+    Stitches shard files into one results file whose particle_history and tracks are virtual datasets
+    pointing into the shards, so nothing is copied except the (small) interaction indexes.
+    Only the rows written to each shard (next_writable) are included, in the order of shard_paths.
+
+    The merged file also holds shard_offsets, the first merged row of every shard, and photon_id_start, the global
+    photon id of the first row of every shard, so locate_photons can map photon ids to (shard, row).
+    If the tracks are not the first rows of particle_history, track_rows holds the particle_history row of every track.
+    The shards are referenced by paths relative to the merged file, so keep them in the same place relative to it.
+    '''
+    if len(shard_paths) == 0:
+        raise ValueError('No shards to merge')
+
+    save_dir = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(save_dir, exist_ok=True)
+
+    hist_rows = []
+    track_counts = []
+    photon_id_starts = []
+    with h5py.File(shard_paths[0], 'r') as f:
+        if isinstance(f['tracks'], h5py.Group):
+            raise ValueError('merge_shards does not support delta or vertex tracks')
+        hist_dtype = f['particle_history'].dtype
+        hist_attrs = dict(f['particle_history'].attrs)
+        tracks_shape = f['tracks'].shape
+        tracks_dtype = f['tracks'].dtype
+        root_attrs = dict(f.attrs)
+        index_columns = list(f['index'].keys()) if 'index' in f else []
+
+    for path in shard_paths:
+        with h5py.File(path, 'r') as f:
+            if f['particle_history'].dtype != hist_dtype or f['tracks'].shape[::2] != tracks_shape[::2]:
+                raise ValueError(f'{path} does not have the same layout as {shard_paths[0]}')
+            hist_rows.append(int(f['particle_history'].attrs['next_writable']))
+            track_counts.append(int(f['tracks'].attrs['next_writable']))
+            photon_id_starts.append(int(f.attrs.get('photon_id_start', -1)))
+
+    shard_offsets = np.concatenate([[0], np.cumsum(hist_rows)]).astype(np.int64)
+    track_offsets = np.concatenate([[0], np.cumsum(track_counts)]).astype(np.int64)
+    total_rows = int(shard_offsets[-1])
+    total_tracks = int(track_offsets[-1])
+
+    # without photon ids from make_shard_file, photon ids are the merged row numbers
+    if min(photon_id_starts) < 0:
+        photon_id_starts = shard_offsets[:-1]
+
+    hist_layout = h5py.VirtualLayout(shape=(total_rows,), dtype=hist_dtype)
+    tracks_layout = h5py.VirtualLayout(shape=(tracks_shape[0], total_tracks, tracks_shape[2]), dtype=tracks_dtype)
+    for i, path in enumerate(shard_paths):
+        source_path = os.path.relpath(os.path.abspath(path), save_dir)
+        if hist_rows[i]:
+            source = h5py.VirtualSource(source_path, 'particle_history', shape=(hist_rows[i],), dtype=hist_dtype)
+            hist_layout[shard_offsets[i]:shard_offsets[i + 1]] = source
+        if track_counts[i]:
+            with h5py.File(path, 'r') as f:
+                shard_tracks_shape = f['tracks'].shape
+            source = h5py.VirtualSource(source_path, 'tracks', shape=shard_tracks_shape, dtype=tracks_dtype)
+            tracks_layout[:, track_offsets[i]:track_offsets[i + 1], :] = source[:, :track_counts[i], :]
+
+    with h5py.File(file_path, 'w') as f:
+        hist_ds = f.create_virtual_dataset('particle_history', hist_layout)
+        for key, value in hist_attrs.items():
+            hist_ds.attrs[key] = value
+        hist_ds.attrs['next_writable'] = total_rows
+
+        tracks_ds = f.create_virtual_dataset('tracks', tracks_layout)
+        tracks_ds.attrs['next_writable'] = total_tracks
+
+        # the indexes hold shard rows, so they are copied over shifted to merged rows
+        if index_columns:
+            rows = {name: [] for name in index_columns}
+            for i, path in enumerate(shard_paths):
+                with h5py.File(path, 'r') as shard:
+                    for name in index_columns:
+                        shard_rows = shard['index'][name][:].astype(np.int64)
+                        rows[name].append(shard_rows[shard_rows < hist_rows[i]] + shard_offsets[i])
+
+            index_group = f.create_group('index')
+            for name in index_columns:
+                index_group.create_dataset(name, data=np.concatenate(rows[name]).astype(_uint_dtype(max(total_rows - 1, 0))))
+
+        if 'column_totals' in hist_attrs:
+            totals = np.zeros_like(hist_attrs['column_totals'])
+            for path in shard_paths:
+                with h5py.File(path, 'r') as shard:
+                    totals += shard['particle_history'].attrs['column_totals']
+            hist_ds.attrs['column_totals'] = totals
+
+        # tracks of every shard start at its first row, so they are only the first rows overall if all but the last shard are fully tracked
+        track_rows = np.concatenate([
+            np.arange(track_counts[i], dtype=np.int64) + shard_offsets[i] for i in range(len(shard_paths))
+        ])
+        if not np.array_equal(track_rows, np.arange(total_tracks)):
+            f.create_dataset('track_rows', data=track_rows)
+
+        f.create_dataset('shard_offsets', data=shard_offsets)
+        f.create_dataset('photon_id_start', data=np.asarray(photon_id_starts, dtype=np.int64))
+
+        for key, value in root_attrs.items():
+            if key not in ('shard', 'photon_id_start'):
+                f.attrs[key] = value
+        f.attrs['shard_files'] = [os.path.relpath(os.path.abspath(path), save_dir) for path in shard_paths]
+
+    print(f'Merged {len(shard_paths)} shards into {file_path}')
+
+    return
+
+
+def locate_photons(file_path, photon_ids):
+    '''
+    Maps global photon ids to where they are stored in a file made by merge_shards.
+    :return: shard number, row in the shard, and row in the merged file of every photon id (-1 where the id isn't stored)
+    :rtype: tuple
+    '''
+    photon_ids = np.asarray(photon_ids, dtype=np.int64)
+    with h5py.File(file_path, 'r') as f:
+        shard_offsets = f['shard_offsets'][:]
+        photon_id_start = f['photon_id_start'][:]
+
+    # shards may have been given out of photon id order, so search in sorted order
+    order = np.argsort(photon_id_start, kind='stable')
+    pos = np.searchsorted(photon_id_start[order], photon_ids, side='right') - 1
+    shard = order[np.maximum(pos, 0)]
+    row = photon_ids - photon_id_start[shard]
+
+    found = (pos >= 0) & (row < np.diff(shard_offsets)[shard])
+    shard = np.where(found, shard, -1)
+    row = np.where(found, row, -1)
+    merged_row = np.where(found, shard_offsets[np.maximum(shard, 0)] + row, -1)
+
+    return shard, row, merged_row
 
 
 def create_empty_csv(
@@ -243,27 +1037,31 @@ def csv_append_rows(
     data:dict | pd.DataFrame,
     csv_path:str
 ):
+    '''
+    Appends rows to a CSV file, creating it if needed.
+    Only the header of the existing file is read. For logging many runs, especially from concurrent jobs,
+    use run_ledger.run_ledger instead, which can export the same CSV with run_ledger.to_csv.
+    '''
     if isinstance(data, dict):
         data = pd.DataFrame(data)
 
     columns = data.columns.to_list()
 
-    if os.path.exists(csv_path):
-        csv = pd.read_csv(csv_path)
-    else:
+    if not os.path.exists(csv_path):
         # If the file is not found, create it
         print(f'CSV file {csv_path} not found')
         create_empty_csv(
             csv_path=csv_path, 
             columns=columns)
-        csv = pd.read_csv(csv_path)
+
+    csv_columns = pd.read_csv(csv_path, nrows=0).columns.tolist()
     
-    if set(columns) != set(csv.columns.tolist()):
+    if set(columns) != set(csv_columns):
         raise KeyError ('columns in data do not match columns in csv file')
     
     data.to_csv(csv_path, 
         mode='a', 
-        columns=csv.columns.tolist(), 
+        columns=csv_columns, 
         index=False, 
         header=False
         )
@@ -0,0 +1,57 @@
+'''
+Angular reflectivity tables of the SiPMs, loaded once per process and shared by every empirical SiPM surface.
+
+The reflectivity was measured by another lab, which reported an upper and a lower bound.
+FBK.csv is the average of the two.
+'''
+import numpy as np
+import pandas as pd
+
+from .cache import file_digest
+from .fresnel import property_table
+
+
+SIPM_REFLECTIVITY_FILES = {
+    'mean': '/workspace/FBK.csv',
+    'upper': '/workspace/data_files/FBK reflectivity_upper_bound.csv',
+    'lower': '/workspace/data_files/FBK reflectivity_lower_bound.csv',
+}
+
+_tables = {}
+
+
+def sipm_reflectivity_path(reflectivity):
+    '''
+    Returns the path of a reflectivity file, given as 'mean', 'upper' or 'lower' (see SIPM_REFLECTIVITY_FILES) or as a path
+    '''
+    return SIPM_REFLECTIVITY_FILES.get(reflectivity, reflectivity)
+
+
+def sipm_tables(path, wavelengths):
+    '''
+    Returns the angular reflectivity and relative PDE tables of a reflectivity file, evaluated at wavelengths.
+    Files are parsed once per process, and tables are shared between all callers with the same file contents
+    and wavelengths, so they are read-only.
+
+    :param path: Path of a CSV file with AOI (degrees) and reflectivity columns
+    :type path: str
+    :param wavelengths: Wavelengths of the tables, e.g. chroma.geometry.standard_wavelengths
+    :type wavelengths: np.ndarray
+    :return: The incident angles in radians, the reflectivity table and the relative PDE table,
+        both of shape (n_angles, n_wavelengths, 2) holding (wavelength, value) pairs
+    :rtype: tuple
+    '''
+    wavelengths = np.ascontiguousarray(wavelengths, dtype=np.float32)
+    key = (file_digest(path), wavelengths.tobytes())
+
+    if key not in _tables:
+        data = pd.read_csv(path)
+        theta = np.radians(data['AOI'].to_numpy())
+        reflectivity = property_table(wavelengths, len(theta), data['reflectivity'].to_numpy()[:, None])
+        relative_pde = property_table(wavelengths, len(theta), 1.0)
+
+        for table in (theta, reflectivity, relative_pde):
+            table.flags.writeable = False
+        _tables[key] = (theta, reflectivity, relative_pde)
+
+    return _tables[key]
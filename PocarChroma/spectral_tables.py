@@ -0,0 +1,111 @@
+'''
+Wavelength dependent material properties (dispersion curves, absorption and scattering spectra).
+
+A material property is tabulated in the material CSV through a '<property>_table' column, e.g. refractive_index_table,
+holding either the path of a CSV file with wavelength and value columns (relative paths are relative to the material CSV),
+or the table itself as 'wavelength:value' pairs separated by ';' (e.g. '178:1.69; 300:1.61; 600:1.57').
+Tables are interpolated once onto the simulation wavelengths and shared, keyed by their contents, between every
+material_manager in the process.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+from .cache import digest, file_digest
+
+
+# Material properties that may be given as spectral tables
+SPECTRAL_PROPERTIES = ('refractive_index', 'absorption_length', 'scattering_length')
+
+_tables = {}
+
+
+def is_table(value):
+    '''
+    Returns whether a material property value is a spectral table rather than a scalar
+    '''
+    return isinstance(value, np.ndarray) and value.ndim == 2
+
+
+def table_values(value, wavelengths):
+    '''
+    Returns the values of a material property at wavelengths: the interpolated values of a spectral table,
+    or a scalar unchanged
+    '''
+    if not is_table(value):
+        return value
+    return np.interp(wavelengths, value[:, 0], value[:, 1])
+
+
+def table_source(value):
+    '''
+    Returns the '<property>_table' entry of a material as a string, or None when the property is a plain scalar
+    '''
+    if isinstance(value, str) and value.strip():
+        return value.strip()
+    return None
+
+
+def read_table(source, base_dir = '.'):
+    '''
+    Reads a spectral table given as a file path or as inline 'wavelength:value' pairs.
+
+    :param source: Path of a CSV file with wavelength and value columns (the first two columns), or inline pairs
+    :type source: str
+    :param base_dir: Directory relative paths are relative to
+    :type base_dir: str
+    :return: The wavelengths (nm) and values, sorted by wavelength
+    :rtype: tuple
+    '''
+    path = os.path.join(base_dir, source)
+    if os.path.isfile(path):
+        data = pd.read_csv(path)
+        wavelengths = data.iloc[:, 0].to_numpy(dtype=np.float64)
+        values = data.iloc[:, 1].to_numpy(dtype=np.float64)
+    elif ':' in source:
+        pairs = [pair.split(':') for pair in source.split(';') if pair.strip()]
+        wavelengths = np.array([float(wavelength) for wavelength, value in pairs])
+        values = np.array([float(value) for wavelength, value in pairs])
+    else:
+        raise ValueError(f'Spectral table is neither a file nor wavelength:value pairs: {source}')
+
+    order = np.argsort(wavelengths, kind='stable')
+    return wavelengths[order], values[order]
+
+
+def table_digest(source, base_dir = '.'):
+    '''
+    Returns a digest of the contents of a spectral table, see read_table
+    '''
+    path = os.path.join(base_dir, source)
+    if os.path.isfile(path):
+        return file_digest(path)
+    return digest('inline', source)
+
+
+def spectral_table(source, wavelengths, base_dir = '.'):
+    '''
+    Returns a spectral table interpolated onto wavelengths, in the (wavelength, value) layout of chroma material properties.
+    Values outside the tabulated range are held at the value of the closest tabulated wavelength.
+    Tables are shared between all callers with the same table contents and wavelengths, so they are read-only.
+
+    :param source: The table, see read_table
+    :type source: str
+    :param wavelengths: Wavelengths to interpolate onto, e.g. chroma.geometry.standard_wavelengths
+    :type wavelengths: np.ndarray
+    :return: The table, shape (n_wavelengths, 2)
+    :rtype: np.ndarray
+    '''
+    wavelengths = np.ascontiguousarray(wavelengths, dtype=np.float32)
+    key = (table_digest(source, base_dir), wavelengths.tobytes())
+
+    if key not in _tables:
+        table_wavelengths, values = read_table(source, base_dir)
+        table = np.empty((len(wavelengths), 2), dtype=np.float32)
+        table[:, 0] = wavelengths
+        table[:, 1] = np.interp(wavelengths, table_wavelengths, values)
+        table.flags.writeable = False
+        _tables[key] = table
+
+    return _tables[key]
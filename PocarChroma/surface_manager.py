@@ -7,10 +7,11 @@ from chroma.geometry import (
 )  # Sili: added on 0403/2023 to include the SiPM empirical package
 import chroma.geometry
 import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
 import random
 
+from .fresnel import angle_grid, fresnel_table, property_table
+from .sipm_tables import sipm_reflectivity_path, sipm_tables
+
 # Manage the surface optical model (of the SiPM and other)? Mainly using model 0 which is the standard Fresnel
 
 class surface_manager:
@@ -21,18 +22,18 @@ class surface_manager:
     :type material_manager: MaterialManager
     :param experiment_name: The name of the experiment.
     :type experiment_name: str
+    :param sipm_reflectivity: The SiPM reflectivity to use, 'mean', 'upper' or 'lower' (see sipm_tables), or the path of a reflectivity file.
+    :type sipm_reflectivity: str
     """
 
-    def __init__(self, material_manager, surface_data_path):
+    def __init__(self, material_manager, surface_data_path, sipm_reflectivity = "mean"):
         self.surfaces = {}
         self.surface_props = {}
         self.surface_data_path = surface_data_path
 
         #the sipm reflectivity was determined by another lab experimentally. The lab reported an upperbound and a lower bound for the reflectivites.
         #the FBK.csv file was created by averaging the upper and lower bounds
-        self.SiPMAOIref_path = "/workspace/FBK.csv"
-        # self.SiPMAOIref_path = '/workspace/data_files/FBK reflectivity_upper_bound.csv'
-        # self.SiPMAOIref_path ='/workspace/data_files/FBK reflectivity_lower_bound.csv'
+        self.SiPMAOIref_path = sipm_reflectivity_path(sipm_reflectivity)
 
         self.mat_manager = material_manager
         self.wavelengths = chroma.geometry.standard_wavelengths
@@ -48,46 +49,92 @@ class surface_manager:
         self.surfaces_df = pd.read_csv(self.surface_data_path)
 
         for index, row in self.surfaces_df.iterrows():
-            curr_name = row["name"]
-            curr_inner_mat_name = row["inner_mat"]
-            curr_outer_mat_name = row["outer_mat"]
-            curr_model_id = row["model_id"]
-            curr_reflect_specular = row["reflect_specular"]
-            curr_reflect_diffuse = row["reflect_diffuse"]
-
-            if curr_model_id == 0:
-                curr_surface = Surface(curr_name, model=curr_model_id)
-                curr_surface.set("detect", 1.0)
-
-            elif curr_model_id == 3:
-                curr_surface = self.create_dichroic_surface(
-                    curr_name, curr_inner_mat_name, curr_outer_mat_name
-                )
-            elif curr_model_id == 4:
-                curr_surface = self.create_dielectric_metal_surface(
-                    curr_name, curr_inner_mat_name
-                )
-
-            # Sili: added on 11/17/2022 to build a killing surface
-            elif curr_model_id == 8:
-                curr_surface = Surface(curr_name, model=0)
-                # Photon will be killed(absorbed) when reaching the surface
-                curr_surface.set("absorb", 1)
-            # below try to include the SiPM empirical surface
-            elif curr_model_id == 5:
-                curr_surface = self.SiPMEmpirical_surface(curr_name)
-            # for teflon
-            elif curr_model_id == 9:
-                curr_surface = Surface(curr_name, model=0)
-                # curr_surface.set('absorb',0.05)
-            else:
-                curr_surface = None
-
-            if curr_surface is not None:
-                curr_surface.set("reflect_specular", curr_reflect_specular)
-                curr_surface.set("reflect_diffuse", curr_reflect_diffuse)
-
-            self.surfaces[curr_name] = curr_surface
+            self.surfaces[row["name"]] = self.build_surface(row)
+
+    def build_surface(self, row, material_props = None):
+        """
+        Constructs the surface object described by one row of the surface table.
+
+        :param row: A row of the surface table.
+        :type row: pd.Series
+        :param material_props: Material properties to build the surface from, like mat_manager.material_props.
+            If given, they are used exactly, without the random perturbation of dichroic surfaces.
+        :type material_props: dict
+        :return: The surface object, None for surfaces without a model.
+        :rtype: Surface
+        """
+        curr_name = row["name"]
+        curr_inner_mat_name = row["inner_mat"]
+        curr_outer_mat_name = row["outer_mat"]
+        curr_model_id = row["model_id"]
+        curr_reflect_specular = row["reflect_specular"]
+        curr_reflect_diffuse = row["reflect_diffuse"]
+
+        if curr_model_id == 0:
+            curr_surface = Surface(curr_name, model=curr_model_id)
+            curr_surface.set("detect", 1.0)
+
+        elif curr_model_id == 3:
+            curr_surface = self.create_dichroic_surface(
+                curr_name, curr_inner_mat_name, curr_outer_mat_name, material_props
+            )
+        elif curr_model_id == 4:
+            curr_surface = self.create_dielectric_metal_surface(
+                curr_name, curr_inner_mat_name, material_props
+            )
+
+        # Sili: added on 11/17/2022 to build a killing surface
+        elif curr_model_id == 8:
+            curr_surface = Surface(curr_name, model=0)
+            # Photon will be killed(absorbed) when reaching the surface
+            curr_surface.set("absorb", 1)
+        # below try to include the SiPM empirical surface
+        elif curr_model_id == 5:
+            curr_surface = self.SiPMEmpirical_surface(curr_name)
+        # for teflon
+        elif curr_model_id == 9:
+            curr_surface = Surface(curr_name, model=0)
+            # curr_surface.set('absorb',0.05)
+        else:
+            curr_surface = None
+
+        if curr_surface is not None:
+            curr_surface.set("reflect_specular", curr_reflect_specular)
+            curr_surface.set("reflect_diffuse", curr_reflect_diffuse)
+
+        return curr_surface
+
+    def rebuild_surfaces(self, material_name):
+        """
+        Rebuilds the surfaces computed from the properties of a material (dichroic and dielectric-metal surfaces),
+        after those properties changed in the material manager. All other surfaces are left alone.
+
+        :param material_name: The name of the material whose properties changed.
+        :type material_name: str
+        :return: The replaced surfaces, as a dict of surface name to (old surface, new surface).
+        :rtype: dict
+        """
+        replaced = {}
+        for index, row in self.surfaces_using([material_name]).iterrows():
+            old_surface = self.surfaces[row["name"]]
+            self.surfaces[row["name"]] = self.build_surface(row)
+            replaced[row["name"]] = (old_surface, self.surfaces[row["name"]])
+
+        return replaced
+
+    def surfaces_using(self, material_names):
+        """
+        Finds the surfaces computed from the properties of any of the given materials (dichroic and dielectric-metal surfaces).
+
+        :param material_names: Names of materials.
+        :type material_names: list
+        :return: The rows of the surface table of those surfaces.
+        :rtype: pd.DataFrame
+        """
+        return self.surfaces_df[
+            self.surfaces_df["model_id"].isin([3, 4])
+            & (self.surfaces_df["inner_mat"].isin(material_names) | self.surfaces_df["outer_mat"].isin(material_names))
+        ]
 
     def get_surface(self, surface_name):
         """
@@ -106,7 +153,7 @@ class surface_manager:
         else:
             raise Exception("Surface does not exist: " + surface_name)
 
-    def create_dielectric_metal_surface(self, name, inner_mat):
+    def create_dielectric_metal_surface(self, name, inner_mat, material_props = None):
         """
         Creates a dielectric-metal surface with given properties.
 
@@ -114,12 +161,15 @@ class surface_manager:
         :type name: str
         :param inner_mat: The name of the inner material.
         :type inner_mat: str
+        :param material_props: Material properties to use instead of mat_manager.material_props.
+        :type material_props: dict
         :return: The dielectric-metal surface object.
         :rtype: Surface
         """
+        props = self.mat_manager.material_props if material_props is None else material_props
         dielectric_metal_surface = Surface(name, model=4)
-        eta2 = float(self.mat_manager.material_props[inner_mat]["eta"])
-        k2 = float(self.mat_manager.material_props[inner_mat]["k"])
+        eta2 = float(props[inner_mat]["eta"])
+        k2 = float(props[inner_mat]["k"])
         dielectric_metal_surface.set("eta", eta2)
         dielectric_metal_surface.set("k", k2)
 
@@ -137,29 +187,17 @@ class surface_manager:
 
         sipmEmpirical_surface = Surface(name, model=5)
 
-        self.SiPMreflctivity = pd.read_csv(self.SiPMAOIref_path)
-        ref = []
-        rela_PDE = []
-        inci_theta_csv = self.SiPMreflctivity["AOI"].tolist()
-        inci_theta = np.radians(inci_theta_csv)
-        ref_csv = self.SiPMreflctivity["reflectivity"].tolist()
-
-        for i in range(0, len(inci_theta_csv)):
-            r_SiPM = np.zeros((self.num_wavelengths, 2), dtype=np.float32)
-            r_SiPM[:, 0] = self.wavelengths
-            r_SiPM[:, 1] = ref_csv[i]
-            ref.append(r_SiPM)
-            relative_PDE = np.zeros((self.num_wavelengths, 2), dtype=np.float32)
-            relative_PDE[:, 0] = self.wavelengths
-            relative_PDE[:, 1] = 1.0
-            rela_PDE.append(relative_PDE)
+        # the tables are read once per process and shared (read-only) by every SiPM surface
+        inci_theta, ref_table, rela_PDE_table = sipm_tables(self.SiPMAOIref_path, self.wavelengths)
+        ref = list(ref_table)
+        rela_PDE = list(rela_PDE_table)
 
         SiPM_props = SiPMEmpiricalProps(inci_theta, ref, rela_PDE)
         sipmEmpirical_surface.sipmEmpirical_props = SiPM_props
 
         return sipmEmpirical_surface
 
-    def create_dichroic_surface(self, name, inner_mat, outer_mat):
+    def create_dichroic_surface(self, name, inner_mat, outer_mat, material_props = None):
         """
         Creates a dichroic surface with given properties.
 
@@ -169,91 +207,59 @@ class surface_manager:
         :type inner_mat: str
         :param outer_mat: The name of the outer material.
         :type outer_mat: str
+        :param material_props: Material properties to use exactly, instead of randomly perturbing those of mat_manager.
+            Used by ensemble to build seeded variants.
+        :type material_props: dict
         :return: The dichroic surface object.
         :rtype: Surface
         """
         dichroic_surface = Surface(name, model=3)
-        n1 = self.mat_manager.material_props[outer_mat]["refractive_index"]
-        # Sili: the eta2 and k2 are randomize with some uncertainty
-        eta2 = self.mat_manager.material_props[inner_mat]["eta"] + random.uniform(
-            -self.mat_manager.material_props[inner_mat]["abs(eta_error)"],
-            self.mat_manager.material_props[inner_mat]["abs(eta_error)"],
-        )
-        k2 = self.mat_manager.material_props[inner_mat]["k"] + random.uniform(
-            -self.mat_manager.material_props[inner_mat]["abs(k_error)"],
-            self.mat_manager.material_props[inner_mat]["abs(k_error)"],
-        )
+        if material_props is not None:
+            eta2 = material_props[inner_mat]["eta"]
+            k2 = material_props[inner_mat]["k"]
+        else:
+            # Sili: the eta2 and k2 are randomize with some uncertainty
+            eta2 = self.mat_manager.material_props[inner_mat]["eta"] + random.uniform(
+                -self.mat_manager.material_props[inner_mat]["abs(eta_error)"],
+                self.mat_manager.material_props[inner_mat]["abs(eta_error)"],
+            )
+            k2 = self.mat_manager.material_props[inner_mat]["k"] + random.uniform(
+                -self.mat_manager.material_props[inner_mat]["abs(k_error)"],
+                self.mat_manager.material_props[inner_mat]["abs(k_error)"],
+            )
         # Sili
         self.get_eta2_k2(eta2, k2)
-        theta, reflectance, transmittance = self.calc_R_T(n1, eta2, k2, num_angles=500)
-        R = []
-        T = []
-        for idx in range(len(theta)):
-            curr_R = np.zeros((self.num_wavelengths, 2), dtype=np.float32)
-            curr_R[:, 0] = self.wavelengths
-            # curr_R[:, 1] = reflectance[idx]
-            curr_R[:, 1] = 1
-            R.append(curr_R)
-
-            curr_T = np.zeros((self.num_wavelengths, 2), dtype=np.float32)
-            curr_T[:, 0] = self.wavelengths
-            curr_T[:, 1] = 0
-            # curr_T[:, 1] = transmittance[idx]
-            T.append(curr_T)
+        theta = angle_grid(500)
+        # one table per property, handed to DichroicProps as a list of per-angle views
+        # the surface reflects everything; calc_R_T gives the Fresnel values if they are wanted instead of 1 and 0
+        R = list(property_table(self.wavelengths, len(theta), 1))
+        T = list(property_table(self.wavelengths, len(theta), 0))
         dichroic_props = DichroicProps(theta, R, T)
         dichroic_surface.dichroic_props = dichroic_props
         return dichroic_surface
 
-    def calc_R_T(self, n1, eta2, k2, num_angles):
+    def calc_R_T(self, n1, eta2, k2, num_angles, cache = True):
         """
         Calculates the reflectance and transmittance for a range of incident angles.
 
-        :param n1: The refractive index of the outer material.
-        :type n1: float
+        :param n1: The refractive index of the outer material, or its values at every wavelength.
+        :type n1: float or np.ndarray
         :param eta2: The real part of the refractive index of the inner material.
         :type eta2: float
         :param k2: The imaginary part of the refractive index of the inner material.
         :type k2: float
         :param num_angles: The number of angles to calculate.
         :type num_angles: int
+        :param cache: Whether to cache the tables, see fresnel_table.
+        :type cache: bool
         :return: A tuple containing the angles, reflectance, and transmittance.
         :rtype: tuple
         """
-        n2 = np.complex(eta2, k2)
-        theta_deg = np.linspace(0, 90, num_angles, dtype=np.float32)
-        theta = np.radians(theta_deg)
-
-        def r_s(theta):
-            numerator = n1 * np.cos(theta) - n2 * np.sqrt(
-                1 - np.square(n1 * np.sin(theta) / n2)
-            )
-            denominator = n1 * np.cos(theta) + n2 * np.sqrt(
-                1 - np.square(n1 * np.sin(theta) / n2)
-            )
-            return np.divide(numerator, denominator)
-
-        def R_s(theta):
-            rs = r_s(theta)
-            return np.square(np.absolute(rs))
-
-        def r_p(theta):
-            numerator = n1 * np.sqrt(
-                1 - np.square(n1 * np.sin(theta) / n2)
-            ) - n2 * np.cos(theta)
-            denominator = n1 * np.sqrt(
-                1 - np.square(n1 * np.sin(theta) / n2)
-            ) + n2 * np.cos(theta)
-            return np.divide(numerator, denominator)
-
-        def R_p(theta):
-            rp = r_p(theta)
-            return np.square(np.absolute(rp))
-
-        def R(theta):
-            return 0.5 * (R_s(theta) + R_p(theta))
-
-        reflectance = R(theta)
-        transmittance = np.zeros(len(reflectance), dtype=np.float32)
+        theta = angle_grid(num_angles)
+        reflectance, transmittance = fresnel_table(n1, eta2, k2, theta, cache=cache)
+        if reflectance.shape[1] == 1:
+            # a single wavelength, keep the per-angle arrays of the scalar case
+            reflectance, transmittance = reflectance[:, 0], transmittance[:, 0]
         # absorption = 1 - reflectance
         return (theta, reflectance, transmittance)
 
@@ -0,0 +1,270 @@
+import os
+import glob
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .cache import digest, file_digest
+from .batch_sizing import available_memory
+from .run_ledger import run_ledger
+
+
+_code_version = None
+
+
+def code_version():
+    '''
+    Returns a digest of the source of the PocarChroma package, so results made by different code are never mixed up
+    '''
+    global _code_version
+    if _code_version is None:
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        paths = sorted(glob.glob(os.path.join(package_dir, '*.py')))
+        _code_version = digest('code', *[(os.path.basename(path), file_digest(path)) for path in paths])
+    return _code_version
+
+
+def grid_points(grid):
+    '''
+    Returns every point of a parameter grid, {name: list of values}, as a list of {name: value} dicts
+    '''
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def _canonical(value):
+    '''
+    Converts a parameter value into a form with a stable repr, for hashing
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((str(k), _canonical(v)) for k, v in value.items())
+    return value
+
+
+def split_point(point):
+    '''
+    Splits the parameters of a sweep point into what they change:
+
+    - 'seed': the seed of the run
+    - 'material:<material>:<property>': a material property, see geometry_manager.apply_changes
+    - 'surface:<surface>:<property>': a surface property
+    - 'displacement:<solid>': the (x, y, z) displacement of a solid
+    - anything else is a keyword argument of photon_generator, e.g. source_location
+
+    :return: The seed (None if not given), the changes as keyword arguments of geometry_manager.apply_changes, and the generator arguments
+    :rtype: tuple
+    '''
+    seed = None
+    changes = {'material_properties': {}, 'surface_properties': {}, 'displacements': {}}
+    generator_args = {}
+    for name, value in point.items():
+        kind, _, target = name.partition(':')
+        if name == 'seed':
+            seed = value
+        elif kind == 'material':
+            material, prop = target.rsplit(':', 1)
+            changes['material_properties'].setdefault(material, {})[prop] = value
+        elif kind == 'surface':
+            surface, prop = target.rsplit(':', 1)
+            changes['surface_properties'].setdefault(surface, {})[prop] = value
+        elif kind == 'displacement':
+            changes['displacements'][target] = value
+        else:
+            generator_args[name] = value
+
+    return seed, {key: value for key, value in changes.items() if value}, generator_args
+
+
+def _run_point(task):
+    '''
+    Runs one sweep point in a worker process and returns its summary row
+    '''
+    from .geometry_manager import geometry_manager
+    from .run_manager import run_manager
+
+    seed, changes, generator_args = split_point(task['point'])
+    gm = geometry_manager(task['geometry_data_path'], task['material_data_path'], task['surface_data_path'])
+    if changes:
+        gm.apply_changes(**changes)
+
+    rm = run_manager(
+        geometry_manager=gm,
+        experiment_name=task['experiment_name'],
+        random_seed=seed if seed is not None else task['seed'],
+        num_particles=task['num_particles'],
+        generator_args={**task['generator_args'], **generator_args},
+        output_path=task['output_path'],
+        **task['run_args'],
+    )
+
+    row = rm.summary()
+    row.update({name: str(_canonical(value)) if np.ndim(value) else value for name, value in task['point'].items()})
+    row['config_hash'] = task['config_hash']
+    row['code_version'] = task['code_version']
+    row['output_path'] = task['output_path']
+    return row
+
+
+class sweep:
+    '''
+    Memoized parameter sweep: runs every point of a parameter grid that has no results yet, and collects all of them into one summary table.
+
+    Every point is identified by a hash of its full configuration: the contents of the geometry, material and surface tables,
+    the generator arguments, the seed, the run settings, the point's own parameters and the version of the PocarChroma code
+    (see code_version). Points whose hash is already in the results store (a run_ledger, column config_hash) are skipped,
+    so a sweep can be extended or rerun after an interruption without repeating anything.
+    The remaining points run on a bounded pool of local processes, each building its own geometry (from the geometry cache)
+    and recording its run summary in the store as soon as it finishes. Unless run_args set a memory_budget, the memory
+    available when the sweep starts is split evenly between the workers, so their batches fit in memory together.
+
+    :param experiment_name: Name of the experiment
+    :type experiment_name: str
+    :param grid: {parameter: list of values}, see split_point for the parameter names
+    :type grid: dict
+    :param store_path: Path of the run_ledger database holding the results
+    :type store_path: str
+    :param geometry_data_path: Path of the geometry table
+    :type geometry_data_path: str
+    :param material_data_path: Path of the material table
+    :type material_data_path: str
+    :param surface_data_path: Path of the surface table
+    :type surface_data_path: str
+    :param num_particles: Photons per point
+    :type num_particles: int
+    :param seed: Seed of the points that don't sweep it
+    :type seed: int
+    :param generator_args: photon_generator arguments shared by every point
+    :type generator_args: dict
+    :param output_dir: Directory for the results file of every point, None to only keep the summaries
+    :type output_dir: str
+    :param max_workers: Number of points run at once
+    :type max_workers: int
+    :param run_args: Further keyword arguments of run_manager, e.g. batch_size, memory_budget or num_steps
+    '''
+
+    def __init__(self,
+                 experiment_name,
+                 grid,
+                 store_path,
+                 geometry_data_path,
+                 material_data_path,
+                 surface_data_path,
+                 num_particles = 1_000_000,
+                 seed = 1042,
+                 generator_args = None,
+                 output_dir = None,
+                 max_workers = 1,
+                 **run_args,
+                 ):
+        self.experiment_name = experiment_name
+        self.grid = grid
+        self.store = run_ledger(store_path)
+        self.geometry_data_path = geometry_data_path
+        self.material_data_path = material_data_path
+        self.surface_data_path = surface_data_path
+        self.num_particles = num_particles
+        self.seed = seed
+        self.generator_args = {} if generator_args is None else generator_args
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.run_args = run_args
+
+        self.points = grid_points(grid)
+        self.config_hashes = [self.config_hash(point) for point in self.points]
+
+    def config_hash(self, point):
+        '''
+        Returns the hash of the full configuration of a sweep point, see the class description
+        '''
+        return digest(
+            'sweep',
+            self.experiment_name,
+            file_digest(self.geometry_data_path),
+            file_digest(self.material_data_path),
+            file_digest(self.surface_data_path),
+            self.num_particles,
+            self.seed,
+            _canonical(self.generator_args),
+            _canonical(self.run_args),
+            _canonical(point),
+            code_version(),
+        )
+
+    def pending(self):
+        '''
+        Returns the indices of the points without results in the store
+        '''
+        done = set(self.store.read(columns=['config_hash'], config_hash=self.config_hashes)['config_hash'])
+        return [i for i, config_hash in enumerate(self.config_hashes) if config_hash not in done]
+
+    def run(self):
+        '''
+        Runs every pending point and returns the summary table of the whole grid
+        '''
+        pending = self.pending()
+        print(f'Sweep of {len(self.points)} points: {len(self.points) - len(pending)} done before, running {len(pending)}')
+
+        # the workers share the memory, the budget is left out of the config hash as it doesn't change the results
+        memory_budget = None
+        if 'memory_budget' not in self.run_args:
+            available = available_memory()
+            if available is not None:
+                memory_budget = available // self.max_workers
+        tasks = [self.task(i, memory_budget) for i in pending]
+        if tasks:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(_run_point, task): task for task in tasks}
+                for future in as_completed(futures):
+                    task = futures[future]
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        print(f'Sweep point {task["point"]} failed: {e!r}')
+                        continue
+                    self.store.append(row)
+                    print(f'Finished sweep point {task["point"]}')
+
+        return self.summary()
+
+    def task(self, i, memory_budget = None):
+        '''
+        Returns everything a worker needs to run point i, with memory_budget added to its run arguments if given
+        '''
+        config_hash = self.config_hashes[i]
+        output_path = None
+        if self.output_dir is not None:
+            output_path = os.path.join(self.output_dir, f'{self.experiment_name}_{config_hash[:16]}.h5')
+        return {
+            'point': self.points[i],
+            'config_hash': config_hash,
+            'code_version': code_version(),
+            'experiment_name': self.experiment_name,
+            'geometry_data_path': self.geometry_data_path,
+            'material_data_path': self.material_data_path,
+            'surface_data_path': self.surface_data_path,
+            'num_particles': self.num_particles,
+            'seed': self.seed,
+            'generator_args': self.generator_args,
+            'output_path': output_path,
+            'run_args': self.run_args if memory_budget is None else {**self.run_args, 'memory_budget': memory_budget},
+        }
+
+    def summary(self, csv_path = None):
+        '''
+        Returns one table with the latest results of every point of the grid (in grid order), and writes it to csv_path if given
+        '''
+        df = self.store.read(config_hash=self.config_hashes)
+        df = df.drop_duplicates('config_hash', keep='last')
+        order = {config_hash: i for i, config_hash in enumerate(self.config_hashes)}
+        df = df.sort_values('config_hash', key=lambda column: column.map(order)).reset_index(drop=True)
+        if csv_path is not None:
+            df.to_csv(csv_path, index=False)
+            print(f'Sweep summary of {len(df)} points written to {csv_path}')
+        return df
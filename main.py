@@ -4,9 +4,10 @@ import sys, getopt
 import numpy as np
 
 from PocarChroma.geometry_manager import geometry_manager
-from PocarChroma.run_manager import run_manager
+from PocarChroma.run_manager import run_manager, experiment_paths
 from PocarChroma.material_manager import material_manager
 from PocarChroma.surface_manager import surface_manager
+from PocarChroma import profiling
 
 import time
 
@@ -18,12 +19,19 @@ def usage():
     print ("  	(2) '-n' <#>	            number of photons to be simulated.") 
     print ("  	(3) '-s' <#>                choose the seed number")
     print ("    (4) '-p' <Str1,Str2,...>    choose which plots to run")
+    print ("    (5) '-b' <#>                number of photons per batch, by default as many as fit in memory")
+    print ("    (6) '-o' <Str>              path of the HDF5 results file")
+    print ("    (7) '--resume'              continue the results file from its last checkpoint")
+    print ("    (8) '--profile' <Str>       time the stages of the run and write a JSON report to this path")
+    print ("    (9) '--cprofile' <Str1,...> run these stages under cProfile (with '--profile')")
+    print ("    (10) '--memory-budget' <#>  GiB of memory the batches are sized for, by default the memory available")
+    print ("    (11) '--results-only'       only write the results file (with '-o'), without keeping every photon for analysis and plots")
     print ("=====================================================================")
 
 def main():
     args = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(args, "n:s:r:e:p:")
+        opts, args = getopt.getopt(args, "n:s:r:e:p:b:o:", ["resume", "profile=", "cprofile=", "memory-budget=", "results-only"])
     except getopt.GetoptError as err:
         print(f"Error: {err}")
         usage()
@@ -35,7 +43,13 @@ def main():
     run_id = 1
     visualize = False
     plots = []
-    write = False
+    batch_size = None
+    memory_budget = None
+    output_path = None
+    resume = False
+    keep_photons = True
+    profile_path = None
+    cprofile_stages = []
 
     for opt, arg in opts:
         if opt == '-e':
@@ -46,6 +60,20 @@ def main():
             seed = int(arg)
         elif opt == '-p':
             plots = [i.strip() for i in arg.split(',')]
+        elif opt == '-b':
+            batch_size = int(arg)
+        elif opt == '-o':
+            output_path = str(arg)
+        elif opt == '--resume':
+            resume = True
+        elif opt == '--profile':
+            profile_path = str(arg)
+        elif opt == '--cprofile':
+            cprofile_stages = [i.strip() for i in arg.split(',')]
+        elif opt == '--memory-budget':
+            memory_budget = int(float(arg) * 2**30)
+        elif opt == '--results-only':
+            keep_photons = False
 
 
     if not experiment_name:
@@ -61,12 +89,33 @@ def main():
         print('Plots:                   ' + ', '.join(plots))
     else:
         print('Plots:                   ' + 'None')
-    print('Saving Data:             ' + str(write))
+    print('Batch size:              ' + (str(batch_size) if batch_size is not None else 'automatic'))
+    print('Saving Data:             ' + str(output_path))
+    if resume and output_path is None:
+        print("--resume needs a results file, give one with '-o'")
+        usage()
+        sys.exit()
+    if not keep_photons and output_path is None:
+        print("--results-only needs a results file, give one with '-o'")
+        usage()
+        sys.exit()
+
+    if profile_path is not None:
+        profiling.enable(profile_path, cprofile=cprofile_stages)
+
+    geometry_data_path, material_data_path, surface_data_path = experiment_paths(experiment_name)
+    mm = material_manager(material_data_path)
+    sm = surface_manager(material_manager = mm, surface_data_path = surface_data_path)
+    gm = geometry_manager(geometry_data_path, material_data_path, surface_data_path, surf_manager = sm)
+    rm = run_manager(geometry_manager=gm, experiment_name=experiment_name, random_seed=seed, num_particles=num_particles, plots=plots,
+                     batch_size=batch_size, memory_budget=memory_budget, output_path=output_path,
+                     keep_photons=keep_photons, resume=resume)
 
-    mm = material_manager(experiment_name=experiment_name)
-    sm = surface_manager(material_manager = mm, experiment_name = experiment_name)
-    gm = geometry_manager(experiment_name=experiment_name,surf_manager = sm)
-    rm = run_manager(geometry_manager=gm, experiment_name=experiment_name, random_seed=seed, num_particles=num_particles,plots=plots)
+    profiler = profiling.disable()
+    if profiler is not None:
+        profiler.print_summary()
+    if rm.ana_man is None:
+        return time.time()
     return rm.ana_man.get_end_time()
 
 
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+from PocarChroma.import_check import HEAVY_MODULES, IMPORT_BUDGETS, measure_import
+
+
+# Modules that import chroma when they are imported
+CHROMA_MODULES = {
+    'PocarChroma.material_manager',
+    'PocarChroma.surface_manager',
+    'PocarChroma.geometry_manager',
+    'PocarChroma.photons',
+}
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('module', list(IMPORT_BUDGETS))
+def test_import_within_budget(module, monkeypatch):
+    if module in CHROMA_MODULES:
+        pytest.importorskip('chroma')
+    # the fresh interpreters import PocarChroma from the repository
+    monkeypatch.chdir(REPO_DIR)
+
+    seconds, heavy = measure_import(module, repeat=3)
+
+    assert seconds is not None, f'{module} failed to import: {heavy}'
+    assert not heavy, f'{module} imports {", ".join(heavy)}, which belong in the functions that use them ({HEAVY_MODULES})'
+    assert seconds <= IMPORT_BUDGETS[module], f'{module} took {seconds:.3f} s to import, over its {IMPORT_BUDGETS[module]} s budget'
@@ -0,0 +1,46 @@
+import io
+import contextlib
+
+import numpy as np
+import pytest
+
+from PocarChroma import save_load_sim
+from PocarChroma.result_catalog import result_catalog
+
+
+N_STEPS = 4
+N_PHOTONS = 50
+N_TRACKS = 20
+
+
+def make_results_file(path, tracks_layout):
+    rng = np.random.default_rng(0)
+    tracks = np.cumsum(rng.normal(size=(N_STEPS, N_TRACKS, 3)), axis=0).astype(np.float32)
+    flags = rng.integers(0, 2**12, (N_STEPS, N_TRACKS))
+    last_hit_triangles = rng.integers(-1, 1000, (N_STEPS, N_TRACKS))
+    bounds = (tracks.reshape(-1, 3).min(axis=0) - 1, tracks.reshape(-1, 3).max(axis=0) + 1)
+    histories = {'SURFACE_DETECT': rng.random(N_PHOTONS) < 0.3, 'REFLECT_SPECULAR': rng.integers(0, N_STEPS, N_PHOTONS)}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        save_load_sim.make_HDF5_file(str(path), {'seed': 7}, tracks.shape, N_PHOTONS, histories,
+                                     max_count=N_STEPS, tracks_layout=tracks_layout, bounds=bounds)
+    save_load_sim.particle_histories_write(str(path), histories)
+    if tracks_layout == 'vertex':
+        save_load_sim.vertices_write(str(path), save_load_sim._vertices_from_tracks(tracks, flags, last_hit_triangles))
+    else:
+        save_load_sim.tracks_write(str(path), tracks)
+    return histories
+
+
+@pytest.mark.parametrize('tracks_layout', ['chunked', 'contiguous', 'delta', 'vertex'])
+def test_scan_indexes_every_tracks_layout(tmp_path, tracks_layout):
+    histories = make_results_file(tmp_path / f'{tracks_layout}.hdf5', tracks_layout)
+
+    catalog = result_catalog(str(tmp_path / 'catalog.json'))
+    assert catalog.scan(str(tmp_path)) == 1
+
+    entry = catalog.entries[str(tmp_path / f'{tracks_layout}.hdf5')]
+    assert entry['n_tracks'] == N_TRACKS
+    assert entry['tracks_written'] == N_TRACKS
+    assert entry['rows_written'] == N_PHOTONS
+    assert entry['nonzero']['SURFACE_DETECT'] == np.count_nonzero(histories['SURFACE_DETECT'])
@@ -0,0 +1,193 @@
+import io
+import contextlib
+
+import h5py
+import numpy as np
+import pytest
+
+from PocarChroma import save_load_sim
+
+
+N_STEPS = 6
+N_PHOTONS = 40
+N_TRACKS = 16
+MAX_COUNT = 10
+
+
+def make_tracks(rng):
+    '''
+    Random walks of which every other photon stops moving partway, so the delta and vertex layouts store short tracks
+    '''
+    tracks = np.cumsum(rng.normal(size=(N_STEPS, N_TRACKS, 3)), axis=0).astype(np.float32)
+    stop = rng.integers(1, N_STEPS, N_TRACKS)
+    for photon in range(0, N_TRACKS, 2):
+        tracks[stop[photon]:, photon] = tracks[stop[photon] - 1, photon]
+    return tracks
+
+
+def make_histories(rng):
+    return {
+        'SURFACE_DETECT': rng.random(N_PHOTONS) < 0.3,
+        'BULK_ABSORB': rng.random(N_PHOTONS) < 0.5,
+        'REFLECT_SPECULAR': rng.integers(0, MAX_COUNT + 1, N_PHOTONS),
+    }
+
+
+def make_file(path, histories, tracks_layout = 'chunked', bounds = None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        save_load_sim.make_HDF5_file(str(path), {'seed': 7}, (N_STEPS, N_TRACKS, 3), N_PHOTONS, histories,
+                                     max_count=MAX_COUNT, tracks_layout=tracks_layout, bounds=bounds)
+    return str(path)
+
+
+def write_tracks(path, tracks, tracks_layout, flags = None, last_hit_triangles = None):
+    '''
+    Writes the tracks in two batches, so appending to the layouts is tested as well
+    '''
+    half = N_TRACKS // 2
+    for batch in (slice(0, half), slice(half, None)):
+        if tracks_layout == 'vertex':
+            save_load_sim.vertices_write(path, save_load_sim._vertices_from_tracks(
+                tracks[:, batch], flags[:, batch], last_hit_triangles[:, batch]))
+        else:
+            save_load_sim.tracks_write(path, tracks[:, batch])
+
+
+def test_histories_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    histories = make_histories(rng)
+    path = make_file(tmp_path / 'histories.hdf5', histories)
+
+    half = N_PHOTONS // 2
+    save_load_sim.particle_histories_write(path, {name: value[:half] for name, value in histories.items()})
+    save_load_sim.particle_histories_write(path, {name: value[half:] for name, value in histories.items()})
+
+    with h5py.File(path, 'r') as f:
+        ds = f['particle_history']
+        # the boolean columns share one bit field, the counter gets the smallest dtype holding MAX_COUNT
+        assert set(ds.dtype.names) == {'REFLECT_SPECULAR', save_load_sim.PACKED_FIELD}
+        assert ds.dtype['REFLECT_SPECULAR'] == np.uint8
+        assert list(ds.attrs['packed_columns']) == ['SURFACE_DETECT', 'BULK_ABSORB']
+
+    read = save_load_sim.particle_histories_read(path)
+    assert read.dtype['SURFACE_DETECT'] == np.bool_
+    for name, value in histories.items():
+        np.testing.assert_array_equal(read[name], value)
+
+    np.testing.assert_array_equal(save_load_sim.particle_histories_read(path, 5, 12)['BULK_ABSORB'],
+                                  histories['BULK_ABSORB'][5:12])
+
+
+def test_histories_counter_overflow_raises(tmp_path):
+    rng = np.random.default_rng(1)
+    histories = make_histories(rng)
+    path = make_file(tmp_path / 'overflow.hdf5', histories)
+
+    histories['REFLECT_SPECULAR'][3] = 256
+    with pytest.raises(ValueError, match='REFLECT_SPECULAR'):
+        save_load_sim.particle_histories_write(path, histories)
+
+
+def test_index_holds_nonzero_photons(tmp_path):
+    rng = np.random.default_rng(2)
+    histories = make_histories(rng)
+    path = make_file(tmp_path / 'index.hdf5', histories)
+
+    half = N_PHOTONS // 2
+    save_load_sim.particle_histories_write(path, {name: value[:half] for name, value in histories.items()})
+    save_load_sim.particle_histories_write(path, {name: value[half:] for name, value in histories.items()})
+
+    with h5py.File(path, 'r') as f:
+        for name, value in histories.items():
+            np.testing.assert_array_equal(f['index'][name][:], np.flatnonzero(value))
+
+
+@pytest.mark.parametrize('tracks_layout', ['chunked', 'contiguous', 'delta', 'vertex'])
+def test_tracks_round_trip(tmp_path, tracks_layout):
+    rng = np.random.default_rng(3)
+    tracks = make_tracks(rng)
+    flags = rng.integers(0, 2**12, (N_STEPS, N_TRACKS))
+    last_hit_triangles = rng.integers(-1, 1000, (N_STEPS, N_TRACKS))
+    bounds = (tracks.reshape(-1, 3).min(axis=0) - 1, tracks.reshape(-1, 3).max(axis=0) + 1)
+    path = make_file(tmp_path / f'{tracks_layout}.hdf5', make_histories(rng), tracks_layout, bounds)
+
+    write_tracks(path, tracks, tracks_layout, flags, last_hit_triangles)
+
+    read = save_load_sim.tracks_read(path)
+    assert read.shape == tracks.shape
+    if tracks_layout == 'delta':
+        # positions are quantized to the precision of the file, 1 um by default
+        np.testing.assert_allclose(read, tracks, rtol=0, atol=1e-3)
+    else:
+        np.testing.assert_array_equal(read, tracks)
+
+    np.testing.assert_array_equal(save_load_sim.tracks_read(path, start=3, stop=11), read[:, 3:11])
+    np.testing.assert_array_equal(save_load_sim.tracks_read(path, mmap=True), read)
+
+
+def test_vertices_round_trip(tmp_path):
+    rng = np.random.default_rng(4)
+    tracks = make_tracks(rng)
+    flags = rng.integers(0, 2**12, (N_STEPS, N_TRACKS))
+    last_hit_triangles = rng.integers(-1, 1000, (N_STEPS, N_TRACKS))
+    path = make_file(tmp_path / 'vertex.hdf5', make_histories(rng), 'vertex')
+
+    write_tracks(path, tracks, 'vertex', flags, last_hit_triangles)
+
+    vertices = save_load_sim.vertices_read(path)
+    photon, step = vertices['photon'], vertices['step']
+    np.testing.assert_array_equal(vertices['pos'], tracks[step, photon])
+    np.testing.assert_array_equal(vertices['flags'], flags[step, photon])
+    np.testing.assert_array_equal(vertices['last_hit_triangles'], last_hit_triangles[step, photon])
+
+    # every photon has a vertex where it starts and one at every step it moved
+    moved = np.any(tracks[1:] != tracks[:-1], axis=2)
+    np.testing.assert_array_equal(np.diff(vertices['offsets']), 1 + moved.sum(axis=0))
+
+    partial = save_load_sim.vertices_read(path, start=5, stop=9)
+    np.testing.assert_array_equal(np.unique(partial['photon']), np.arange(5, 9))
+
+
+def test_tracks_write_refuses_vertex_files(tmp_path):
+    rng = np.random.default_rng(5)
+    path = make_file(tmp_path / 'vertex.hdf5', make_histories(rng), 'vertex')
+
+    with pytest.raises(ValueError, match='vertices_write'):
+        save_load_sim.tracks_write(path, make_tracks(rng))
+
+
+@pytest.mark.parametrize('tracks_layout', ['chunked', 'delta', 'vertex'])
+def test_select_tracks(tmp_path, tracks_layout):
+    rng = np.random.default_rng(6)
+    tracks = make_tracks(rng)
+    flags = rng.integers(0, 2**12, (N_STEPS, N_TRACKS))
+    last_hit_triangles = rng.integers(-1, 1000, (N_STEPS, N_TRACKS))
+    bounds = (tracks.reshape(-1, 3).min(axis=0) - 1, tracks.reshape(-1, 3).max(axis=0) + 1)
+    histories = make_histories(rng)
+    path = make_file(tmp_path / f'{tracks_layout}.hdf5', histories, tracks_layout, bounds)
+    save_load_sim.particle_histories_write(path, histories)
+    write_tracks(path, tracks, tracks_layout, flags, last_hit_triangles)
+    stored = save_load_sim.tracks_read(path)
+
+    # only the tracked photons, the first N_TRACKS rows, can be selected
+    detected = histories['SURFACE_DETECT'][:N_TRACKS]
+    expected = {
+        (False, 'name'): np.flatnonzero(detected),
+        (True, 'name'): np.flatnonzero(~detected),
+    }
+    criteria = {
+        'name': 'SURFACE_DETECT',
+        'callable': lambda tallies: tallies['REFLECT_SPECULAR'] > 4,
+    }
+    expected[(False, 'callable')] = np.flatnonzero(histories['REFLECT_SPECULAR'][:N_TRACKS] > 4)
+    expected[(True, 'callable')] = np.flatnonzero(histories['REFLECT_SPECULAR'][:N_TRACKS] <= 4)
+
+    for (invert, kind), inds in expected.items():
+        sel_inds, selected = save_load_sim.select_tracks(path, criteria[kind], invert_selection=invert, return_type='both')
+        np.testing.assert_array_equal(sel_inds[0], inds)
+        assert selected.shape == (N_STEPS, len(inds), 3)
+        np.testing.assert_array_equal(selected, stored[:, inds, :])
+
+    indices = save_load_sim.select_tracks(path, 'SURFACE_DETECT')
+    np.testing.assert_array_equal(indices[0], expected[(False, 'name')])
+    assert save_load_sim.select_tracks(path, 'SURFACE_DETECT', return_type='tracks').shape == (N_STEPS, len(indices[0]), 3)